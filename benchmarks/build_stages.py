@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Times and memory profiles each stage of building the lookups and flags stages which
+have regressed against a baseline.
+
+The species come from the metadata fixtures in tests/data and the taxonomy is a
+synthetic NCBI-like tree (2.6M nodes by default, as NCBI's) so the taxonomy stages
+run at production scale. The pipeline is run --repeat times and each stage's
+median time and peak RSS are compared with the baseline file. A stage regresses when
+it is more than --tolerance slower (and at least --min-seconds slower) or uses more
+than --tolerance more memory. The exit status is 1 if any stage regressed.
+
+    python -m benchmarks.build_stages                  # compare with the baseline
+    python -m benchmarks.build_stages --save-baseline  # record a new baseline
+"""
+
+from typing import Callable, Dict, List, Optional
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+import duckdb as duckdb_module
+import orjson
+
+from benchmarks.measure import RssSampler, git_commit, rss_bytes
+from src.db import DuckDb, SQLiteDb
+from src.hot_clades import HotClades
+from src.species import Species, SpeciesFts, SpeciesTrigramFts
+from src.taxonomy import Taxonomy, TaxonomySQLiteFts
+from tests.util import DatabaseFixture
+
+BASELINE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "build_baseline.json"
+)
+RANKS = [
+    "no rank",
+    "species",
+    "genus",
+    "family",
+    "order",
+    "class",
+    "phylum",
+    "subspecies",
+    "clade",
+    "strain",
+]
+
+
+def synthetic_taxonomy(duckdb: DuckDb, schema: str, nodes: int) -> None:
+    """
+    Create ncbi_taxa_node and ncbi_taxa_name in schema holding a tree of the given
+    number of nodes with IDs 1 to nodes, so the metadata fixtures' organisms are found
+    in it. Each node's parent is drawn from the preceding 80% of IDs, giving lineages
+    around 12 to 25 deep like NCBI's. Every node has a scientific name and some have
+    common or equivalent names. Deterministic for a given size
+    """
+    con = duckdb.con
+    con.execute(f"create schema {schema}")
+    con.execute(
+        f"""
+        create table {schema}.ncbi_taxa_node as
+        select
+            i::INTEGER as taxon_id,
+            (case when i = 1 then 1 else i - 1 - hash(i) % ceil(0.8 * (i - 1))::BIGINT end)::INTEGER as parent_id,
+            (?::VARCHAR[])[(1 + hash(i * 7) % {len(RANKS)})::BIGINT] as rank,
+            (hash(i * 13) % 50 = 0)::TINYINT as genbank_hidden_flag
+        from range(1, ? + 1) t(i)
+        """,
+        (RANKS, nodes),
+    )
+    con.execute(
+        f"""
+        create table {schema}.ncbi_taxa_name as
+        select i::INTEGER as taxon_id, 'Taxon ' || i as name, 'scientific name' as name_class
+        from range(1, $nodes + 1) t(i)
+        union all
+        select i, 'common taxon ' || i, 'genbank common name'
+        from range(1, $nodes + 1) t(i) where hash(i * 3) % 20 = 0
+        union all
+        select i, 'vernacular taxon ' || i, 'common name'
+        from range(1, $nodes + 1) t(i) where hash(i * 5) % 10 = 0
+        union all
+        select i, 'Synonym ' || i, 'equivalent name'
+        from range(1, $nodes + 1) t(i) where hash(i * 11) % 50 = 0
+        """,
+        {"nodes": nodes},
+    )
+
+
+def run_pipeline(nodes: int, workdir: str, sampler: RssSampler) -> Dict[str, dict]:
+    """
+    Build the lookups in memory (and the FTS tables in workdir) timing each stage
+    """
+    results = {}
+    duckdb = DuckDb.create()
+    sqlite = SQLiteDb.create(os.path.join(workdir, "search_fts.sqlite"), "sqlitedb")
+    sqlite.remove_sqlite()
+    duckdb.connect_to_sqlite("sqlitedb", sqlite.path)
+
+    def timed(stage: str, func: Callable[[], object]) -> None:
+        sampler.reset()
+        start_rss = rss_bytes()
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+        results[stage] = {
+            "seconds": seconds,
+            "peak_rss_bytes": sampler.reset(),
+            "rss_growth_bytes": (rss_bytes() or 0) - (start_rss or 0),
+            "duckdb_memory_bytes": duckdb.con.execute(
+                "select sum(memory_usage_bytes) from duckdb_memory()"
+            ).fetchone()[0],
+        }
+
+    def load():
+        # The metadata goes in its own schema as Taxonomy copies organism from it
+        duckdb.con.execute("create schema metadata")
+        DatabaseFixture(duckdb=duckdb).load_tables(schema="metadata")
+        synthetic_taxonomy(duckdb, "taxonomy_source", nodes)
+
+    taxonomy = Taxonomy(
+        duckdb=duckdb,
+        taxonomy_source="taxonomy_source",
+        source_schema="metadata",
+        build_taxonomy_fts=True,
+        build_taxonomy_tree=True,
+    )
+    timed("load", load)
+    timed("Species.run", Species(duckdb=duckdb, source_schema="metadata").run)
+    timed(
+        "SpeciesFts.run",
+        SpeciesFts(duckdb=duckdb, sqlite=sqlite, indexed_table="species").run,
+    )
+    timed("SpeciesTrigramFts.run", SpeciesTrigramFts(duckdb=duckdb, sqlite=sqlite).run)
+    timed("Taxonomy._copy_tables", taxonomy._copy_tables)
+    timed(
+        "Taxonomy._create_ncbi_hierarchy_lookup",
+        taxonomy._create_ncbi_hierarchy_lookup,
+    )
+    timed("Taxonomy._create_taxonomy_ancestors", taxonomy._create_taxonomy_ancestors)
+    timed("Taxonomy._create_taxonomy_nested_set", taxonomy._create_taxonomy_nested_set)
+    timed("Taxonomy._create_taxonomy_names", taxonomy._create_taxonomy_names)
+    timed("Taxonomy._create_taxonomy_tree", taxonomy._create_taxonomy_tree)
+    taxonomy._cleanup()
+    timed(
+        "TaxonomySQLiteFts.run",
+        TaxonomySQLiteFts(
+            duckdb=duckdb, sqlite=sqlite, indexed_table="taxonomy_names"
+        ).run,
+    )
+    timed("HotClades.run", HotClades(duckdb=duckdb, hot_taxa=[9606]).run)
+    duckdb.con.close()
+    sqlite.con.close()
+    sqlite.remove_sqlite()
+    return results
+
+
+def summarise(runs: List[Dict[str, dict]]) -> Dict[str, dict]:
+    """
+    Median time and the largest memory figures of each stage over the runs
+    """
+    return {
+        stage: {
+            "seconds": round(
+                statistics.median(run[stage]["seconds"] for run in runs), 4
+            ),
+            "min_seconds": round(min(run[stage]["seconds"] for run in runs), 4),
+            "max_seconds": round(max(run[stage]["seconds"] for run in runs), 4),
+            "peak_rss_bytes": max(run[stage]["peak_rss_bytes"] or 0 for run in runs),
+            "rss_growth_bytes": max(run[stage]["rss_growth_bytes"] for run in runs),
+            "duckdb_memory_bytes": max(
+                run[stage]["duckdb_memory_bytes"] or 0 for run in runs
+            ),
+        }
+        for stage in runs[0]
+    }
+
+
+def compare(
+    stages: Dict[str, dict],
+    baseline: dict,
+    tolerance: float,
+    min_seconds: float,
+) -> List[dict]:
+    """
+    Stages slower or using more memory than the baseline by more than the tolerance
+    """
+    regressions = []
+    for stage, current in stages.items():
+        previous = baseline["stages"].get(stage)
+        if previous is None:
+            continue
+        slower = current["seconds"] - previous["seconds"]
+        if (
+            current["seconds"] > previous["seconds"] * (1 + tolerance)
+            and slower >= min_seconds
+        ):
+            regressions.append(
+                {
+                    "stage": stage,
+                    "measure": "seconds",
+                    "baseline": previous["seconds"],
+                    "current": current["seconds"],
+                    "change": round(current["seconds"] / previous["seconds"] - 1, 3),
+                }
+            )
+        if current["peak_rss_bytes"] > previous["peak_rss_bytes"] * (1 + tolerance):
+            regressions.append(
+                {
+                    "stage": stage,
+                    "measure": "peak_rss_bytes",
+                    "baseline": previous["peak_rss_bytes"],
+                    "current": current["peak_rss_bytes"],
+                    "change": round(
+                        current["peak_rss_bytes"] / previous["peak_rss_bytes"] - 1, 3
+                    ),
+                }
+            )
+    return regressions
+
+
+def load_baseline(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as fh:
+        return orjson.loads(fh.read())
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--taxonomy-nodes", type=int, default=2_600_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Write the results to the baseline file rather than comparing",
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25, help="Allowed fractional increase"
+    )
+    parser.add_argument(
+        "--min-seconds",
+        type=float,
+        default=0.05,
+        help="Ignore slowdowns smaller than this, which are noise on short stages",
+    )
+    parser.add_argument("--output", help="Write the JSON report here, not stdout")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="species_search_build_bench_")
+    sampler = RssSampler(interval=0.01)
+    runs = []
+    for run in range(args.repeat):
+        runs.append(run_pipeline(args.taxonomy_nodes, workdir, sampler))
+        total = sum(stage["seconds"] for stage in runs[-1].values())
+        print(f"Run {run + 1}/{args.repeat} took {total:.2f}s", file=sys.stderr)
+    sampler.stop()
+
+    report = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "duckdb": duckdb_module.__version__,
+        "cpus": os.cpu_count(),
+        "taxonomy_nodes": args.taxonomy_nodes,
+        "repeat": args.repeat,
+        "stages": summarise(runs),
+    }
+    status = 0
+    if args.save_baseline:
+        with open(args.baseline, "wb") as fh:
+            fh.write(orjson.dumps(report, option=orjson.OPT_INDENT_2) + b"\n")
+        print(f"Saved the baseline to {args.baseline}", file=sys.stderr)
+    else:
+        baseline = load_baseline(args.baseline)
+        if baseline is None:
+            print(f"No baseline found at {args.baseline}", file=sys.stderr)
+        elif baseline["taxonomy_nodes"] != args.taxonomy_nodes:
+            print(
+                f"The baseline was recorded with {baseline['taxonomy_nodes']} taxonomy nodes so is not compared",
+                file=sys.stderr,
+            )
+        else:
+            report["baseline_commit"] = baseline.get("commit")
+            report["regressions"] = compare(
+                report["stages"], baseline, args.tolerance, args.min_seconds
+            )
+            for regression in report["regressions"]:
+                print(
+                    f"REGRESSION {regression['stage']} {regression['measure']}: {regression['baseline']} -> {regression['current']} ({regression['change']:+.0%})",
+                    file=sys.stderr,
+                )
+            if report["regressions"]:
+                status = 1
+
+    output = orjson.dumps(report, option=orjson.OPT_INDENT_2)
+    if args.output:
+        with open(args.output, "wb") as fh:
+            fh.write(output)
+    else:
+        sys.stdout.buffer.write(output + b"\n")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+from typing import Dict
+from src.db import DuckDb, SQLiteDb
+from src.hot_clades import HotClades
+from src.species import Species, SpeciesFts, SpeciesTrigramFts
+from src.taxonomy import Taxonomy, TaxonomySQLiteFts
+from tests.util import DatabaseFixture, TaxonomyFixture
+import os
+import time
+
+DUCKDB_SEARCH = "search.duckdb"
+SQLITE_FTS = "search_fts.sqlite"
+
+
+def build_lookups(directory: str) -> Dict[str, float]:
+    """
+    Build search.duckdb and search_fts.sqlite in directory as generate_lookups.py does,
+    from the metadata parquet fixtures in tests/data and the hand-built taxonomy of
+    TaxonomyFixture. Returns the seconds taken by each stage
+    """
+    timings = {}
+
+    def timed(stage, func):
+        start = time.perf_counter()
+        func()
+        timings[stage] = time.perf_counter() - start
+
+    os.makedirs(directory, exist_ok=True)
+    duckdb = DuckDb.create()
+    sqlite = SQLiteDb.create(os.path.join(directory, SQLITE_FTS), "sqlitedb")
+    sqlite.remove_sqlite()
+    duckdb.connect_to_sqlite("sqlitedb", sqlite.path)
+    taxonomy = TaxonomyFixture(duckdb=duckdb)
+
+    def load():
+        # The metadata goes in its own schema as Taxonomy copies organism
+        duckdb.con.execute("create schema metadata")
+        DatabaseFixture(duckdb=duckdb).load_tables(schema="metadata")
+        taxonomy.load_tables()
+
+    timed("load", load)
+    timed("species", Species(duckdb=duckdb, source_schema="metadata").run)
+    timed(
+        "species_fts",
+        SpeciesFts(duckdb=duckdb, sqlite=sqlite, indexed_table="species").run,
+    )
+    timed("species_trigram_fts", SpeciesTrigramFts(duckdb=duckdb, sqlite=sqlite).run)
+    timed(
+        "taxonomy",
+        Taxonomy(
+            duckdb=duckdb,
+            taxonomy_source=taxonomy.schema,
+            source_schema=taxonomy.schema,
+            build_taxonomy_fts=True,
+            build_taxonomy_tree=True,
+        ).run,
+    )
+    timed(
+        "taxonomy_fts",
+        TaxonomySQLiteFts(
+            duckdb=duckdb, sqlite=sqlite, indexed_table="taxonomy_names"
+        ).run,
+    )
+    timed("hot_clades", HotClades(duckdb=duckdb, hot_taxa=[9443, 9606]).run)
+
+    def persist():
+        duckdb.con.execute("drop schema metadata cascade")
+        duckdb.con.execute(f"drop schema {taxonomy.schema} cascade")
+        duckdb.detach("sqlitedb")
+        duckdb.persist_database(os.path.join(directory, DUCKDB_SEARCH))
+
+    timed("persist", persist)
+    duckdb.con.close()
+    sqlite.con.close()
+    return timings
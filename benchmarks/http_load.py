@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+End-to-end HTTP load test of the server against lookups built from the test fixtures.
+
+The app runs in this process under uvicorn with OLS replaced by a local stub. A
+realistic mix of search, typeahead, taxonomy, intersect and hierarchy requests is
+sent from a separate process (so the load generator does not compete with the
+server for the GIL) at each concurrency level. Throughput, latency percentiles and
+the server's RSS are reported as JSON so builds can be compared. Requests are sent
+with httpx, installed from requirements-dev.txt.
+
+    python -m benchmarks.http_load --concurrency 1 8 32 --requests 2000 --output results.json
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import orjson
+
+from benchmarks.fixture import DUCKDB_SEARCH, SQLITE_FTS, build_lookups
+from benchmarks.measure import RssSampler, git_commit, peak_rss_bytes, rss_bytes
+
+# Relative weight of each kind of request in the mix
+MIX = {
+    "search": 35,
+    "search_fuzzy": 5,
+    "typeahead": 20,
+    "taxonomy": 15,
+    "intersect": 15,
+    "hierarchy": 7,
+    "hierarchy_ols": 3,
+}
+
+# Taxa of TaxonomyFixture with genomes beneath them, and taxa it does not hold which
+# are looked up in (the stub of) OLS
+TAXA = [7742, 40674, 9443, 9604, 9605, 9606, 9596, 9598, 9989, 10088, 10090, 7955]
+SPECIES_TAXA = [9606, 9598, 10090, 7955]
+OLS_TAXA = [9597, 9544, 10116]
+
+_word = re.compile(r"\w+")
+
+
+def percentile(ordered: Sequence[float], fraction: float) -> Optional[float]:
+    """
+    Nearest rank percentile of already sorted values
+    """
+    if not ordered:
+        return None
+    rank = max(1, int(round(fraction * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarise(latencies: Sequence[float]) -> dict:
+    ordered = sorted(latencies)
+    return {
+        "requests": len(ordered),
+        "p50_ms": _ms(percentile(ordered, 0.5)),
+        "p95_ms": _ms(percentile(ordered, 0.95)),
+        "p99_ms": _ms(percentile(ordered, 0.99)),
+        "max_ms": _ms(ordered[-1] if ordered else None),
+    }
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def request_mix(lookups_dir: str, count: int, seed: int) -> List[Tuple[str, str]]:
+    """
+    Build count (kind, path) requests drawn from MIX. Search terms are names of
+    genomes in the lookups, misspelt for fuzzy searches and cut short for typeahead
+    """
+    import duckdb
+
+    con = duckdb.connect(os.path.join(lookups_dir, DUCKDB_SEARCH), read_only=True)
+    names = [
+        row[0]
+        for row in con.execute(
+            "select distinct scientific_name from species where scientific_name is not null order by 1"
+        ).fetchall()
+    ]
+    names += [
+        row[0]
+        for row in con.execute(
+            "select distinct common_name from species where common_name is not null order by 1"
+        ).fetchall()
+    ]
+    con.close()
+    # Searches take FTS5 syntax so names are reduced to their words
+    names = [" ".join(_word.findall(name)) for name in names]
+    names = [name for name in names if len(name) >= 3]
+    rng = random.Random(seed)
+    kinds = list(MIX)
+    weights = [MIX[kind] for kind in kinds]
+    requests = []
+    for kind in rng.choices(kinds, weights, k=count):
+        name = rng.choice(names)
+        if kind == "search":
+            path = "/species/search?" + urllib.parse.urlencode({"q": name, "limit": 20})
+        elif kind == "search_fuzzy":
+            # Swap two neighbouring letters
+            i = rng.randrange(1, max(2, len(name) - 1))
+            typo = name[: i - 1] + name[i] + name[i - 1] + name[i + 1 :]
+            path = "/species/search?" + urllib.parse.urlencode({"q": typo, "limit": 20})
+        elif kind == "typeahead":
+            typed = name[: rng.randint(3, max(3, len(name)))]
+            path = "/species/typeahead?" + urllib.parse.urlencode({"q": typed})
+        elif kind == "taxonomy":
+            path = f"/species/taxonomy/{rng.choice(TAXA)}?limit=100"
+        elif kind == "intersect":
+            path = f"/species/intersect/{rng.choice(SPECIES_TAXA)}"
+        elif kind == "hierarchy":
+            path = f"/taxonomy/hierarchy/{rng.choice(TAXA)}"
+        else:
+            path = f"/taxonomy/hierarchy/{rng.choice(OLS_TAXA)}"
+        requests.append((kind, path))
+    return requests
+
+
+def drive(
+    url: str, requests: List[Tuple[str, str]], concurrency: int
+) -> Tuple[float, List[Tuple[str, float, int]]]:
+    """
+    Send the requests with concurrency in flight at once. Runs in the load generator
+    process and returns the elapsed seconds and (kind, seconds, status) per request
+    """
+    import httpx
+
+    async def run():
+        results = []
+        pending = iter(requests)
+        limits = httpx.Limits(
+            max_connections=concurrency, max_keepalive_connections=concurrency
+        )
+        async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+
+            async def worker():
+                for kind, path in pending:
+                    start = time.perf_counter()
+                    try:
+                        response = await client.get(path)
+                        await response.aread()
+                        status = response.status_code
+                    except httpx.HTTPError:
+                        status = 0
+                    results.append((kind, time.perf_counter() - start, status))
+
+            start = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            return time.perf_counter() - start, results
+
+    return asyncio.run(run())
+
+
+def start_server(lookups_dir: str, workdir: str, cache: bool, ols_latency: float):
+    """
+    Import the app configured to serve the lookups, stub OLS and run it under uvicorn
+    on a free local port. Returns the server, its thread and its URL
+    """
+    with open(os.path.join(workdir, "config.toml"), "w") as fh:
+        fh.write(
+            f"""
+[lookups]
+duckdb_search = "{os.path.join(lookups_dir, DUCKDB_SEARCH)}"
+sqlite_fts = "{os.path.join(lookups_dir, SQLITE_FTS)}"
+ols_fallback = true
+
+[cache]
+enabled = {"true" if cache else "false"}
+"""
+        )
+    # The config is read from the working directory when main is imported
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import main
+    finally:
+        os.chdir(cwd)
+    import uvicorn
+
+    def ols_stub(taxonomy_id: int, include_root: bool):
+        time.sleep(ols_latency)
+        items = [
+            {
+                "id": 9605,
+                "iri": f"{main._purl_prefix}9605",
+                "label": "Homo",
+                "rank": "genus",
+                "distance": 1,
+            }
+        ]
+        return {"meta": {"status": "success", "items": len(items)}, "items": items}
+
+    main._get_ols_hierarchy = ols_stub
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(
+        uvicorn.Config(
+            main.app, host="127.0.0.1", port=port, log_level="warning", access_log=False
+        )
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{port}"
+    import httpx
+
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        try:
+            if httpx.get(f"{url}/probes/readiness").status_code == 200:
+                return server, thread, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.05)
+    raise RuntimeError("Server did not become ready")
+
+
+def main(argv=None) -> dict:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per level")
+    parser.add_argument("--warmup", type=int, default=200, help="Unmeasured requests")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Enable the result cache. Off by default so queries are measured",
+    )
+    parser.add_argument("--ols-latency-ms", type=float, default=50)
+    parser.add_argument("--lookups", help="Use prebuilt lookups in this directory")
+    parser.add_argument("--output", help="Write the JSON report here, not stdout")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="species_search_bench_")
+    build = None
+    lookups_dir = args.lookups
+    if not lookups_dir:
+        lookups_dir = os.path.join(workdir, "lookups")
+        build = build_lookups(lookups_dir)
+    rss_before_start = rss_bytes()
+    server, thread, url = start_server(
+        lookups_dir, workdir, args.cache, args.ols_latency_ms / 1000
+    )
+    report = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "cpus": os.cpu_count(),
+        "settings": vars(args),
+        "mix": MIX,
+        "build_seconds": build,
+        "rss_bytes": {"before_start": rss_before_start, "ready": rss_bytes()},
+        "levels": [],
+    }
+    sampler = RssSampler()
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as generator:
+        warmup = request_mix(lookups_dir, args.warmup, args.seed + 1)
+        generator.submit(drive, url, warmup, max(args.concurrency)).result()
+        for concurrency in args.concurrency:
+            requests = request_mix(lookups_dir, args.requests, args.seed)
+            sampler.reset()
+            elapsed, results = generator.submit(
+                drive, url, requests, concurrency
+            ).result()
+            errors = sum(1 for _, _, status in results if status != 200)
+            by_kind: Dict[str, List[float]] = {}
+            for kind, seconds, _ in results:
+                by_kind.setdefault(kind, []).append(seconds)
+            level = {
+                "concurrency": concurrency,
+                "seconds": round(elapsed, 3),
+                "throughput_rps": round(len(results) / elapsed, 1),
+                "errors": errors,
+                **summarise([seconds for _, seconds, _ in results]),
+                "peak_rss_bytes": sampler.reset(),
+                "endpoints": {
+                    kind: summarise(latencies)
+                    for kind, latencies in sorted(by_kind.items())
+                },
+            }
+            report["levels"].append(level)
+            print(
+                f"concurrency {concurrency}: {level['throughput_rps']} req/s, p50 {level['p50_ms']}ms, p95 {level['p95_ms']}ms, p99 {level['p99_ms']}ms, {errors} errors",
+                file=sys.stderr,
+            )
+    sampler.stop()
+    report["rss_bytes"]["peak"] = peak_rss_bytes()
+    server.should_exit = True
+    thread.join()
+
+    output = orjson.dumps(report, option=orjson.OPT_INDENT_2)
+    if args.output:
+        with open(args.output, "wb") as fh:
+            fh.write(output)
+    else:
+        sys.stdout.buffer.write(output + b"\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,35 @@
 #!/usr/bin/env python3
 import logging
+import os
 
-from src.db import DuckDb, SQLiteDb
-from src.species import Species, SpeciesFts
-from src.taxonomy import Taxonomy, TaxonomySQLiteFts
+from src.db import DuckDb, SQLiteDb, new_file
+from src.species import Species, SpeciesFts, SpeciesTrigramFts
+from src.taxonomy import Taxonomy
+from src.hot_clades import HotClades
+from src.incremental import IncrementalBuild
+from src.pipeline import Pipeline, Stage, lookup_stages
 from src.config import get_config
 
-
 config = get_config()
 config.enable_logging()
 
 db = config.source_database
 
-duckdb = DuckDb.create()
+# An incremental build updates a copy of the previous build rather than building in
+# memory and persisting it. Servers open the files immutable, so the copies replace
+# them once updated
+incremental = config.lookups.incremental and IncrementalBuild.possible(
+    config.lookups.duckdb_search, config.lookups.sqlite_fts
+)
+if config.lookups.incremental and not incremental:
+    logging.getLogger().info(
+        "No previous build with fingerprints found. Running a full build"
+    )
+
+duckdb_path = ":memory:"
+if incremental:
+    duckdb_path = new_file(config.lookups.duckdb_search)
+duckdb = DuckDb.create(duckdb_path)
 
 duckdb.load_extension("mysql")
 duckdb.load_extension("sqlite")
@@ -26,25 +43,84 @@ duckdb.connect_to_mysql(
 
 duckdb.connect_to_duckdb("taxonomy", config.lookups.local_taxonomy)
 
-# Create the SQLite DB, switch to it and populate
+# Create the SQLite DB and populate. Full builds keep the SQLite tables of stages
+# which are up to date when reusing the previous build
 sqlite_db_name = "sqlitedb"
 sqlite = SQLiteDb.create(config.lookups.sqlite_fts, sqlite_db_name)
-sqlite.remove_sqlite()
-duckdb.connect_to_sqlite(sqlite_db_name, sqlite.path)
-
-Species(duckdb=duckdb).run()
-SpeciesFts(duckdb=duckdb, sqlite=sqlite, indexed_table="species").run()
-
-Taxonomy(
-    duckdb=duckdb,
-    taxonomy_source="taxonomy",
-    build_taxonomy_fts=config.lookups.build_taxonomy_fts,
-).run()
-if config.lookups.build_taxonomy_fts:
-    TaxonomySQLiteFts(
-        duckdb=duckdb, sqlite=sqlite, indexed_table="taxonomy_names"
-    ).run()
-else:
-    logging.getLogger().info("Skipping building the Taxonomy FTS")
 
-duckdb.persist_database(config.lookups.duckdb_search)
+if incremental:
+    # Only incremental builds write to SQLite through DuckDB. Full builds run stages
+    # concurrently so write to it only over their own SQLite connections
+    with sqlite.replacing():
+        duckdb.connect_to_sqlite(sqlite_db_name, sqlite.path)
+        IncrementalBuild(
+            duckdb=duckdb,
+            sqlite=sqlite,
+            species=Species(duckdb=duckdb),
+            species_fts=SpeciesFts(
+                duckdb=duckdb,
+                sqlite=sqlite,
+                indexed_table="species",
+                prefix_lengths=config.lookups.species_fts_prefix,
+                bulk_load=config.lookups.fts_bulk_load,
+                unindexed_columns=config.lookups.species_fts_unindexed,
+                column_weights=config.lookups.species_fts_weights,
+            ),
+            taxonomy=Taxonomy(
+                duckdb=duckdb,
+                taxonomy_source="taxonomy",
+                build_taxonomy_fts=config.lookups.build_taxonomy_fts,
+                build_taxonomy_tree=config.lookups.build_taxonomy_tree,
+            ),
+            hot_clades=HotClades(
+                duckdb=duckdb,
+                hot_taxa=config.lookups.hot_taxa,
+                top=config.lookups.hot_taxa_top,
+                intersect_levels=config.lookups.hot_intersect_levels,
+            ),
+            species_trigram_fts=(
+                SpeciesTrigramFts(
+                    duckdb=duckdb, sqlite=sqlite, bulk_load=config.lookups.fts_bulk_load
+                )
+                if config.lookups.build_species_trigram_fts
+                else None
+            ),
+        ).run()
+        duckdb.con.close()
+    os.replace(duckdb_path, config.lookups.duckdb_search)
+else:
+    previous = None
+    if config.lookups.reuse_previous_build and os.path.exists(
+        config.lookups.duckdb_search
+    ):
+        previous = "previous"
+        duckdb.connect_to_duckdb(previous, config.lookups.duckdb_search, read_only=True)
+    stages = lookup_stages(
+        taxonomy_source="taxonomy",
+        species_fts_prefix=config.lookups.species_fts_prefix,
+        species_fts_unindexed=config.lookups.species_fts_unindexed,
+        species_fts_weights=config.lookups.species_fts_weights,
+        build_species_trigram_fts=config.lookups.build_species_trigram_fts,
+        build_taxonomy_fts=config.lookups.build_taxonomy_fts,
+        build_taxonomy_tree=config.lookups.build_taxonomy_tree,
+        hot_taxa=config.lookups.hot_taxa,
+        hot_taxa_top=config.lookups.hot_taxa_top,
+        hot_intersect_levels=config.lookups.hot_intersect_levels,
+        fts_bulk_load=config.lookups.fts_bulk_load,
+    )
+    stages.append(
+        Stage(
+            "persist",
+            lambda duckdb, sqlite: duckdb.persist_database(
+                config.lookups.duckdb_search
+            ),
+            depends_on=[stage.name for stage in stages],
+        )
+    )
+    Pipeline(
+        duckdb=duckdb,
+        sqlite=sqlite,
+        stages=stages,
+        workers=config.lookups.build_workers,
+        previous=previous,
+    ).run()
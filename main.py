@@ -1,9 +1,35 @@
-from fastapi import FastAPI, Path, Query
-from starlette.responses import FileResponse
-from typing import Optional
+import time
+
+# Start of the cold start, which ends once the lookups are warm and ready to serve
+_started = time.perf_counter()
+
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from fastapi import FastAPI, Header, Path, Query
+from starlette.responses import FileResponse, Response, StreamingResponse
+from pydantic import BaseModel
+from typing import List, Optional
+import asyncio
+import hmac
+import logging
 import os
-from src.db import DuckDb, SQLiteDb
-import requests
+import signal
+from src.cache import ResultCache
+from src.db import QueryExecutor
+from src.fuzzy import similarity, trigram_match, trigrams
+from src.hierarchy import HierarchyUnavailable, ancestors_up_to
+from src.lookups import LookupManager, LookupsUnavailable
+from src.profiling import configure_slow_query_log, profiling
+from src.pagination import InvalidCursor, decode_cursor, encode_cursor
+from src.queries import (
+    INTERSECTING_ITEMS_KEYSET,
+    hot_intersecting_items_query,
+    hot_nearest_items_query,
+    intersecting_items_query,
+    nearest_items_query,
+)
+from src.metrics import Metrics, MetricsMiddleware, stage
+from src.responses import FastJSONResponse, ndjson_lines, query_to_hash_list
 import urllib
 from src.config import get_config
 
@@ -11,12 +37,121 @@ from src.config import get_config
 config = get_config()
 config.enable_logging()
 
-# Build the app
-app = FastAPI()
+# Global variables to hold the lookups and the executor. Requests take the active
+# build of the lookups from the manager for their duration. Queries take a connection
+# from the build's pools and are run on the executor's threads. The lookups are opened
+# and warmed once the server has started
+executor = QueryExecutor(config.server.query_threads)
+result_cache = ResultCache(
+    max_entries=config.cache.max_entries if config.cache.enabled else 0,
+    max_bytes=config.cache.max_bytes,
+)
+lookup_manager = LookupManager(
+    config,
+    on_switch=lambda lookups: result_cache.set_version(lookups.version),
+    warm_up=lambda lookups: _warm_up(lookups),
+)
+metrics = Metrics()
+configure_slow_query_log(
+    config.server.slow_query_log,
+    config.server.slow_query_ms,
+    config.server.slow_query_log_bytes,
+    config.server.slow_query_log_backups,
+)
+
+
+def _cache_metrics(field):
+    return lambda: [((), result_cache.stats()[field])]
+
+
+def _pool_metrics(field):
+    def collect():
+        lookups = lookup_manager.current
+        if lookups is None:
+            return []
+        return [
+            (("duckdb",), lookups.duckdb_pool.stats()[field]),
+            (("sqlite",), lookups.sqlite_pool.stats()[field]),
+        ]
 
-# Global variables to hold the database connection
-duckdb = DuckDb.create(config.lookups.duckdb_search)
-sqlite = SQLiteDb.create(config.lookups.sqlite_fts, config.lookups.sqlite_fts)
+    return collect
+
+
+metrics.collect(
+    "cache_hits_total", "Result cache hits", "counter", _cache_metrics("hits")
+)
+metrics.collect(
+    "cache_misses_total", "Result cache misses", "counter", _cache_metrics("misses")
+)
+metrics.collect(
+    "cache_entries",
+    "Responses held by the result cache",
+    "gauge",
+    _cache_metrics("entries"),
+)
+metrics.collect(
+    "cache_bytes", "Bytes held by the result cache", "gauge", _cache_metrics("bytes")
+)
+metrics.collect(
+    "pool_connections",
+    "Size of the connection pool",
+    "gauge",
+    _pool_metrics("size"),
+    ("pool",),
+)
+metrics.collect(
+    "pool_connections_in_use",
+    "Connections taken from the pool",
+    "gauge",
+    _pool_metrics("in_use"),
+    ("pool",),
+)
+metrics.collect(
+    "pool_waits_total",
+    "Times a connection was requested while all were in use. Reset when the lookups are swapped",
+    "counter",
+    _pool_metrics("waits"),
+    ("pool",),
+)
+
+
+async def _start_lookups():
+    # Retried as the lookups may still be being published. If they cannot be opened
+    # the server shuts down to be restarted, rather than running without ever being ready
+    attempts = config.lookups.start_attempts
+    for attempt in range(1, attempts + 1):
+        try:
+            await asyncio.to_thread(lookup_manager.start)
+            break
+        except Exception:
+            logging.exception(
+                f"Failed to open the lookups (attempt {attempt}/{attempts})"
+            )
+        if attempt == attempts:
+            logging.critical("Could not open the lookups. Shutting down")
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+        await asyncio.sleep(config.lookups.start_retry_interval)
+    logging.info(
+        f"Ready to serve after a {time.perf_counter() - _started:.2f}s cold start"
+    )
+    if lookup_manager.versioned and config.lookups.watch_interval > 0:
+        await lookup_manager.watch(config.lookups.watch_interval)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Opening the lookups runs in the background so probes are answered meanwhile
+    starting = asyncio.create_task(_start_lookups())
+    yield
+    starting.cancel()
+    executor.shutdown()
+    lookup_manager.close()
+
+
+# Build the app
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+app.add_middleware(MetricsMiddleware, metrics=metrics)
 
 
 @app.get("/", include_in_schema=False)
@@ -24,36 +159,337 @@ async def read_index():
     return FileResponse("static/index.html")
 
 
+@app.exception_handler(LookupsUnavailable)
+async def lookups_unavailable(request, exc: LookupsUnavailable):
+    return FastJSONResponse(
+        {"meta": {"status": "error", "error": str(exc)}}, status_code=503
+    )
+
+
 @app.get("/probes/readiness")
 async def readiness():
+    """
+    Ready once the lookups have been opened and warmed
+    """
+    if not lookup_manager.ready:
+        return FastJSONResponse({"readiness": False}, status_code=503)
     return {"readiness": True}
 
 
 @app.get("/probes/liveness")
-async def readiness():
+async def liveness():
     return {"liveness": True}
 
 
+@app.get("/cache/stats", include_in_schema=False)
+async def cache_stats():
+    return result_cache.stats()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """
+    Metrics in the Prometheus text format
+    """
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/lookups/version", summary="Report the build of the lookups being served")
+async def get_lookups_version():
+    with lookup_manager.acquire() as lookups:
+        return {
+            "version": lookups.version,
+            "loaded_at": datetime.fromtimestamp(
+                lookups.loaded_at, timezone.utc
+            ).isoformat(),
+            "hot_swap": lookup_manager.versioned,
+            "taxonomy_tree": {
+                "taxa": lookups.taxonomy_tree.taxa,
+                "bytes": lookups.taxonomy_tree.nbytes,
+            },
+        }
+
+
+@app.post("/admin/lookups/reload", include_in_schema=False)
+async def reload_lookups(
+    version: Optional[str] = None, x_admin_token: Optional[str] = Header(None)
+):
+    """
+    Switch to the given or latest build in lookups.directory. Returns once the new
+    build is serving and the previous one has drained
+    """
+    token = config.server.admin_token
+    if not token or not hmac.compare_digest(x_admin_token or "", token):
+        return FastJSONResponse(
+            {"meta": {"status": "error", "error": "Forbidden"}}, status_code=403
+        )
+    try:
+        switched = await asyncio.to_thread(lookup_manager.reload, version)
+    except (ValueError, FileNotFoundError) as e:
+        return {"meta": {"status": "error", "error": str(e)}}
+    return {
+        "meta": {"status": "success"},
+        "version": lookup_manager.current.version,
+        "switched": switched,
+    }
+
+
+_profiling_disabled = {
+    "meta": {
+        "status": "error",
+        "error": "Profiling is disabled. Set server.allow_profile to enable it",
+    }
+}
+
+
+def _cached_response(key):
+    body = result_cache.get(key)
+    if body is not None:
+        return Response(content=body, media_type="application/json")
+    return None
+
+
+def _cache_response(key, response: FastJSONResponse, lookups):
+    result_cache.put(key, response.body, version=lookups.version)
+    return response
+
+
+_ndjson_media_type = "application/x-ndjson"
+
+
+def _hidden(keyset):
+    return [column for column in keyset if column.startswith("_")]
+
+
+def _paginate(endpoint: str, items: list, limit, keyset) -> Optional[str]:
+    """
+    Make the cursor for the page following items from the sort key of the last one
+    and remove the columns only selected for pagination. A full page may be followed
+    by an empty one
+    """
+    next_cursor = None
+    if limit and len(items) == limit:
+        next_cursor = encode_cursor(endpoint, *(items[-1][column] for column in keyset))
+    hidden = _hidden(keyset)
+    for item in items:
+        for column in hidden:
+            del item[column]
+    return next_cursor
+
+
 @app.get("/species/search", summary="Find a species using Full Text Search (FTS)")
-async def search_species(q: str = Query(..., min_length=3), limit: Optional[int] = 100):
+async def search_species(
+    q: str = Query(..., min_length=3),
+    limit: Optional[int] = 100,
+    cursor: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    profile: bool = False,
+):
     """
-    For a given string search for genomes held within Ensembl
+    For a given string search for genomes held within Ensembl. Pass the cursor from a
+    page's meta to fetch the next page. The ndjson format streams one genome per line.
+    Setting profile (when allowed) reports the plan and timing of each query
     """
-    query = f"""
-    SELECT s.name, s.accession, s.scientific_name, s.assembly_default, s.tol_id, s.common_name, s.biosample_id, s.strain, s.genome_uuid, s.release_label, s.release_type, s.taxonomy_id, bm25(species_fts) AS score, search_boost
+    if profile and not config.server.allow_profile:
+        return _profiling_disabled
+    try:
+        after = decode_cursor(cursor, "search", 3) if cursor else None
+    except InvalidCursor as e:
+        return {"meta": {"status": "error", "error": str(e)}}
+    if format == "ndjson":
+        return StreamingResponse(
+            _stream_search_species(q, limit, after), media_type=_ndjson_media_type
+        )
+    key = ResultCache.key("search", q=" ".join(q.split()), limit=limit, cursor=cursor)
+    cached = None if profile else _cached_response(key)
+    if cached:
+        return cached
+    with lookup_manager.acquire() as lookups, profiling(profile) as queries:
+        items = await executor.run(_search_species, lookups, q, limit, after)
+        exclude = {item["_rowid"] for item in items}
+        next_cursor = _paginate("search", items, limit, _search_species_keyset)
+        # Top up the first page with near matches when there are too few exact hits
+        fallback = (
+            lookups.species_trigram_fts_available
+            and not after
+            and len(items) < config.server.fuzzy_min_hits
+            and (not limit or len(items) < limit)
+        )
+        if fallback:
+            remaining = limit - len(items) if limit else None
+            items.extend(
+                await executor.run(
+                    _fuzzy_search_species, lookups, q, remaining, exclude
+                )
+            )
+        json = {
+            "meta": {
+                "status": "success",
+                "items": len(items),
+                "limit": limit,
+                "next_cursor": next_cursor,
+                "fallback": fallback,
+            },
+            "items": items,
+        }
+        if profile:
+            json["meta"]["profile"] = queries
+            return json
+        return _cache_response(key, FastJSONResponse(json), lookups)
+
+
+# Columns results are sorted by. Those starting with _ are selected for pagination only
+_search_species_keyset = ("search_boost", "score", "_rowid")
+
+
+def _search_species_query(q: str, limit, after):
+    # rank is bm25 with the column weights species_fts was built with and is lower
+    # for better matches
+    query = """
+    SELECT s.name, s.accession, s.scientific_name, s.assembly_default, s.tol_id, s.common_name, s.biosample_id, s.strain, s.genome_uuid, s.release_label, s.release_type, s.taxonomy_id, s.rank AS score, NULL AS similarity, 'exact' AS match, search_boost, s.rowid AS _rowid
     FROM species_fts s
     WHERE s.species_fts MATCH ?
-    order by s.search_boost desc, score desc
-    limit {limit}
 """
-    cursor = sqlite.con.cursor()
-    results = cursor.execute(query, (q,)).fetchall()
-    items = results_to_hash_list(results, cursor)
-    json = {
-        "meta": {"status": "success", "items": len(items), "limit": limit},
-        "items": items,
-    }
-    return json
+    params = [q]
+    if after:
+        search_boost, score, rowid = after
+        query = f"""{query}
+    AND (s.search_boost < ? OR (s.search_boost = ? AND (s.rank > ? OR (s.rank = ? AND s.rowid > ?))))
+"""
+        params.extend([search_boost, search_boost, score, score, rowid])
+    query = f"{query}    order by s.search_boost desc, score, s.rowid\n"
+    if limit:
+        query = f"{query}    limit ?\n"
+        params.append(limit)
+    return query, params
+
+
+def _search_species(lookups, q: str, limit, after=None):
+    query, params = _search_species_query(q, limit, after)
+    with lookups.sqlite_pool.connection() as con:
+        cursor = con.cursor()
+        items = query_to_hash_list(cursor, query, params)
+        cursor.close()
+    return items
+
+
+def _fuzzy_search_species(lookups, q: str, limit, exclude):
+    """
+    Find near matches to a misspelt search. The best trigram matches are scored by
+    their similarity to the query and ordered by it then search_boost. Fuzzy matches
+    have the fields of exact ones, with match set to fuzzy and their similarity in
+    place of a score
+    """
+    match = trigram_match(q)
+    if not match:
+        return []
+    query_trigrams = trigrams(q)
+    query = """
+    SELECT s.name, s.accession, s.scientific_name, s.assembly_default, s.tol_id, s.common_name, s.biosample_id, s.strain, s.genome_uuid, s.release_label, s.release_type, s.taxonomy_id, NULL AS score, NULL AS similarity, 'fuzzy' AS match, s.search_boost, s.rowid AS _rowid
+    FROM (
+        SELECT t.rowid
+        FROM species_trigram_fts t
+        WHERE t.species_trigram_fts MATCH ?
+        ORDER BY t.rank
+        LIMIT ?
+    ) t
+    JOIN species_fts s ON s.rowid = t.rowid
+"""
+    with lookups.sqlite_pool.connection() as con:
+        cursor = con.cursor()
+        candidates = query_to_hash_list(
+            cursor, query, (match, config.server.fuzzy_candidates)
+        )
+        cursor.close()
+    items = []
+    for item in candidates:
+        if item["_rowid"] in exclude:
+            continue
+        item["similarity"] = round(
+            similarity(
+                query_trigrams,
+                (
+                    item["scientific_name"],
+                    item["common_name"],
+                    item["strain"],
+                    item["tol_id"],
+                ),
+            ),
+            3,
+        )
+        if item["similarity"] >= config.server.fuzzy_min_similarity:
+            items.append(item)
+    items.sort(
+        key=lambda item: (-item["similarity"], -item["search_boost"], item["_rowid"])
+    )
+    if limit:
+        items = items[:limit]
+    for item in items:
+        del item["_rowid"]
+    return items
+
+
+def _stream_search_species(q: str, limit, after):
+    query, params = _search_species_query(q, limit, after)
+    with lookup_manager.acquire() as lookups, lookups.sqlite_pool.connection() as con:
+        cursor = con.cursor()
+        with stage("query"):
+            cursor.execute(query, params)
+        yield from ndjson_lines(cursor, exclude=_hidden(_search_species_keyset))
+        cursor.close()
+
+
+@app.get(
+    "/species/typeahead",
+    summary="Suggest species as a search is typed. The last word is treated as a prefix",
+)
+async def typeahead_species(
+    q: str = Query(..., min_length=1), limit: int = Query(10, ge=1, le=50)
+):
+    """
+    For a partially typed string return the display names and identifiers of the top
+    matching genomes held within Ensembl. Matches are returned boosted genomes first
+    """
+    match = _typeahead_match(q)
+    key = ResultCache.key("typeahead", match=match, limit=limit)
+    cached = _cached_response(key)
+    if cached:
+        return cached
+    with lookup_manager.acquire() as lookups:
+        items = []
+        if match:
+            items = await executor.run(_typeahead_species, lookups, match, limit)
+        json = {
+            "meta": {"status": "success", "items": len(items), "limit": limit},
+            "items": items,
+        }
+        return _cache_response(key, FastJSONResponse(json), lookups)
+
+
+def _typeahead_match(q: str) -> str:
+    """
+    Quote each typed word so FTS5 treats it as text rather than query syntax and
+    make the last one a prefix query
+    """
+    terms = ['"{}"'.format(term.replace('"', '""')) for term in q.lower().split()]
+    if not terms:
+        return ""
+    return " ".join(terms) + "*"
+
+
+def _typeahead_species(lookups, match: str, limit: int):
+    query = """
+    SELECT s.scientific_name, s.common_name, s.name, s.accession, s.genome_uuid, s.taxonomy_id
+    FROM species_fts s
+    WHERE s.species_fts MATCH ?
+    order by s.rowid
+    limit ?
+"""
+    with lookups.sqlite_pool.connection() as con:
+        cursor = con.cursor()
+        items = query_to_hash_list(cursor, query, (match, limit))
+        cursor.close()
+    return items
 
 
 @app.get(
@@ -61,33 +497,182 @@ async def search_species(q: str = Query(..., min_length=3), limit: Optional[int]
     summary="Find species in Ensembl that are a descendent of a taxonomic node",
 )
 async def intersect_taxonomy_by_taxon_id(
-    taxonomy_id: int = Path(..., ge=1), limit: Optional[int] = 100
+    taxonomy_id: int = Path(..., ge=1),
+    limit: Optional[int] = 100,
+    cursor: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    profile: bool = False,
 ):
     """
     For a given taxonomy ID, bring back the species in Ensembl that intersect that
-    identifier i.e. they are children bound by that taxonomic node
+    identifier i.e. they are children bound by that taxonomic node. Pass the cursor
+    from a page's meta to fetch the next page. The ndjson format streams one genome
+    per line, keeping memory flat however large the clade. Setting profile (when
+    allowed) reports the plan and timing of each query
     """
-    items = _get_intersecting_items(taxonomy_id, limit)
+    if profile and not config.server.allow_profile:
+        return _profiling_disabled
+    try:
+        after = decode_cursor(cursor, "taxonomy", 2) if cursor else None
+    except InvalidCursor as e:
+        return {"meta": {"status": "error", "error": str(e)}}
+    if format == "ndjson":
+        return StreamingResponse(
+            _stream_intersecting_items(taxonomy_id, limit, after),
+            media_type=_ndjson_media_type,
+        )
+    key = ResultCache.key(
+        "taxonomy", taxonomy_id=taxonomy_id, limit=limit, cursor=cursor
+    )
+    cached = None if profile else _cached_response(key)
+    if cached:
+        return cached
+    with lookup_manager.acquire() as lookups, profiling(profile) as queries:
+        items = await executor.run(
+            _get_intersecting_items, lookups, taxonomy_id, limit, after
+        )
+        next_cursor = _paginate("taxonomy", items, limit, INTERSECTING_ITEMS_KEYSET)
+        json = {
+            "meta": {
+                "status": "success",
+                "items": len(items),
+                "limit": limit,
+                "next_cursor": next_cursor,
+            },
+            "items": items,
+        }
+        if profile:
+            json["meta"]["profile"] = queries
+            return json
+        return _cache_response(key, FastJSONResponse(json), lookups)
+
+
+def _intersecting_query(lookups, cursor, taxonomy_id: int, limit, after):
+    # Hot clades have their results precomputed
+    if taxonomy_id in lookups.hot_clades:
+        return hot_intersecting_items_query(taxonomy_id, limit, after)
+    return intersecting_items_query(cursor, taxonomy_id, limit, after)
+
+
+def _get_intersecting_items(lookups, taxonomy_id: int, limit, after=None):
+    with lookups.duckdb_pool.connection() as cursor:
+        with stage("query"):
+            query = _intersecting_query(lookups, cursor, taxonomy_id, limit, after)
+        if query is None:
+            return []
+        return query_to_hash_list(cursor, *query)
+
+
+def _stream_intersecting_items(taxonomy_id: int, limit, after):
+    with lookup_manager.acquire() as lookups, lookups.duckdb_pool.connection() as cursor:
+        with stage("query"):
+            query = _intersecting_query(lookups, cursor, taxonomy_id, limit, after)
+            if query is None:
+                return
+            cursor.execute(*query)
+        yield from ndjson_lines(cursor, exclude=_hidden(INTERSECTING_ITEMS_KEYSET))
+
+
+class BatchLookup(BaseModel):
+    taxonomy_ids: List[int] = []
+    genome_uuids: List[str] = []
+    accessions: List[str] = []
+
+
+@app.post(
+    "/species/batch",
+    summary="Find the species in Ensembl for many taxonomy IDs, genome UUIDs and accessions at once",
+)
+async def batch_lookup(batch: BatchLookup):
+    """
+    Resolve every key given in a single query. Taxonomy IDs bring back the species that
+    are a descendent of the node as /species/taxonomy does, genome UUIDs and accessions
+    the matching genomes. Results are grouped by the keys given, which are always reported
+    """
+    keys = len(batch.taxonomy_ids) + len(batch.genome_uuids) + len(batch.accessions)
+    if keys > config.server.batch_max_keys:
+        return {
+            "meta": {
+                "status": "error",
+                "error": f"{keys} keys given but at most {config.server.batch_max_keys} are allowed",
+            }
+        }
+    grouped = {
+        "taxonomy_id": {str(key): [] for key in batch.taxonomy_ids},
+        "genome_uuid": {key: [] for key in batch.genome_uuids},
+        "accession": {key: [] for key in batch.accessions},
+    }
+    with lookup_manager.acquire() as lookups:
+        items = await executor.run(
+            _batch_lookup,
+            lookups,
+            batch.taxonomy_ids,
+            batch.genome_uuids,
+            batch.accessions,
+        )
+    for item in items:
+        grouped[item.pop("key_type")][item.pop("key")].append(item)
     json = {
-        "meta": {"status": "success", "items": len(items), "limit": limit},
-        "items": items,
+        "meta": {"status": "success", "keys": keys, "items": len(items)},
+        "taxonomy_ids": grouped["taxonomy_id"],
+        "genome_uuids": grouped["genome_uuid"],
+        "accessions": grouped["accession"],
     }
-    return json
+    return FastJSONResponse(json)
 
 
-def _get_intersecting_items(taxonomy_id: int, limit):
-    query = """
-      SELECT s.name, s.accession, s.scientific_name, s.assembly_default, s.tol_id, s.common_name, s.biosample_id, s.strain, s.taxonomy_id, s.species_taxonomy_id, s.is_current, s.release_label, s.release_type, s.genome_uuid, coalesce(list_position(ch.ancestor_taxon_ids, ?), 0) as taxonomy_step
-from species s
-join computed_hierarchy ch on s.taxonomy_id = ch.organism_taxonomy_id
-where list_contains(ch.ancestor_taxon_ids, ?)
-or s.taxonomy_id =?
+def _batch_lookup(
+    lookups, taxonomy_ids: List[int], genome_uuids: List[str], accessions: List[str]
+):
+    """
+    Load the keys into a temporary table, private to the pooled cursor, and join it
+    against the lookups. Taxonomy IDs go through their nested set interval and genome
+    UUIDs and accessions are equi-joins onto species
+    """
+    columns = "s.name, s.accession, s.scientific_name, s.assembly_default, s.tol_id, s.common_name, s.biosample_id, s.strain, s.taxonomy_id, s.species_taxonomy_id, s.is_current, s.release_label, s.release_type, s.genome_uuid"
+    query = f"""
+    SELECT k.key_type, k.key, {columns}, ch.depth - ns.depth AS taxonomy_step, ch.left_index AS sort_index, s.species_id
+    FROM batch_keys k
+    JOIN taxonomy_nested_set ns ON ns.taxon_id = k.taxonomy_id
+    JOIN computed_hierarchy ch ON ch.left_index BETWEEN ns.left_index AND ns.right_index
+    JOIN species s ON s.taxonomy_id = ch.organism_taxonomy_id
+    WHERE k.key_type = 'taxonomy_id'
+    UNION ALL
+    SELECT k.key_type, k.key, {columns}, NULL, NULL, s.species_id
+    FROM batch_keys k
+    JOIN species s ON s.genome_uuid = k.key
+    WHERE k.key_type = 'genome_uuid'
+    UNION ALL
+    SELECT k.key_type, k.key, {columns}, NULL, NULL, s.species_id
+    FROM batch_keys k
+    JOIN species s ON s.accession = k.key
+    WHERE k.key_type = 'accession'
+    ORDER BY key_type, key, sort_index, species_id
 """
-    if limit:
-        query = f"{query} limit {limit}"
-    cursor = duckdb.con.cursor()
-    results = cursor.execute(query, (taxonomy_id, taxonomy_id, taxonomy_id)).fetchall()
-    return results_to_hash_list(results, cursor)
+    with lookups.duckdb_pool.connection() as cursor:
+        cursor.execute(
+            "CREATE OR REPLACE TEMP TABLE batch_keys (key_type VARCHAR, key VARCHAR, taxonomy_id BIGINT)"
+        )
+        try:
+            with stage("query"):
+                cursor.execute(
+                    """
+                INSERT INTO batch_keys
+                SELECT DISTINCT 'taxonomy_id', CAST(id AS VARCHAR), id FROM (SELECT unnest(?::BIGINT[]) AS id)
+                UNION ALL
+                SELECT DISTINCT 'genome_uuid', id, NULL FROM (SELECT unnest(?::VARCHAR[]) AS id)
+                UNION ALL
+                SELECT DISTINCT 'accession', id, NULL FROM (SELECT unnest(?::VARCHAR[]) AS id)
+                """,
+                    (taxonomy_ids, genome_uuids, accessions),
+                )
+            items = query_to_hash_list(cursor, query)
+        finally:
+            cursor.execute("DROP TABLE IF EXISTS batch_keys")
+    for item in items:
+        del item["sort_index"]
+        del item["species_id"]
+    return items
 
 
 # Types of taxon to limit to and not ascend higher. Or we keep ascending until we bust out
@@ -114,49 +699,171 @@ async def intersect_taxonomy(
     max_taxon_level="order",
     integrated_only: bool = False,
     limit: Optional[int] = 100,
+    profile: bool = False,
 ):
     """
     For a taxonomic identifier, bring back all genomes in Ensembl that intersect it and
     ascend the taxonomic tree for other possible hits. Best used to give a species of interest
-    and find the nearest relative to it in Ensembl
-    """
-    hierarchy = get_hierarchy(taxonomy_id=taxonomy_id)
-    break_loop = False
-    seen_genome = {}
-    genomes = []
-    for taxon in hierarchy["items"]:
-        if break_loop:
-            break
-        # Stop processing on the next iteration
-        if taxon["rank"] == max_taxon_level:
-            break_loop = True
-
-        taxons = _get_intersecting_items(taxonomy_id=taxon["id"], limit=None)
-        for candidate in taxons:
-            if candidate["genome_uuid"] in seen_genome:
-                continue
-            if integrated_only and candidate["release_type"] != "integrated":
-                continue
-            seen_genome[candidate["genome_uuid"]] = True
-            candidate["intersecting_taxon"] = taxon
-            candidate["total_distance"] = candidate["taxonomy_step"] + taxon["distance"]
-            genomes.append(
-                dict(
-                    {
-                        "total_distance": (
-                            candidate["taxonomy_step"] + taxon["distance"]
-                        )
-                    },
-                    **candidate,
-                )
+    and find the nearest relative to it in Ensembl. Setting profile (when allowed) reports
+    the plan and timing of each query
+    """
+    if profile and not config.server.allow_profile:
+        return _profiling_disabled
+    key = ResultCache.key(
+        "intersect",
+        taxonomy_id=taxonomy_id,
+        max_taxon_level=max_taxon_level,
+        integrated_only=integrated_only,
+        limit=limit,
+    )
+    cached = None if profile else _cached_response(key)
+    if cached:
+        return cached
+    with lookup_manager.acquire() as lookups, profiling(profile) as queries:
+        try:
+            genomes = await executor.run(
+                _intersect_taxonomy,
+                lookups,
+                taxonomy_id,
+                max_taxon_level,
+                integrated_only,
+                limit,
             )
+        except HierarchyUnavailable as e:
+            # Not cached as OLS may only be unavailable for a moment
+            return {"meta": e.meta}
+        json = {"meta": {"status": "success", "items": len(genomes)}, "items": genomes}
+        if profile:
+            json["meta"]["profile"] = queries
+            return json
+        return _cache_response(key, FastJSONResponse(json), lookups)
+
+
+def _intersect_taxonomy(
+    lookups, taxonomy_id: int, max_taxon_level: str, integrated_only: bool, limit
+):
+    if (taxonomy_id, max_taxon_level, integrated_only) in lookups.hot_intersects:
+        with stage("hierarchy"):
+            ancestors = lookups.taxonomy_hierarchy.ancestors(taxonomy_id)
+        query = hot_nearest_items_query(
+            taxonomy_id, max_taxon_level, integrated_only, limit
+        )
+        return _get_nearest_items(lookups, ancestors, query)
+    hierarchy = _get_hierarchy(lookups, taxonomy_id, include_root=False)
+    if hierarchy["meta"]["status"] != "success":
+        raise HierarchyUnavailable(hierarchy["meta"])
+    ancestors = ancestors_up_to(hierarchy["items"], max_taxon_level)
+    if not ancestors:
+        return []
+    query = nearest_items_query(ancestors, integrated_only, limit)
+    return _get_nearest_items(lookups, ancestors, query)
+
+
+def _get_nearest_items(lookups, ancestors, query):
+    """
+    Run a nearest items query and report the ancestor each genome intersects
+    """
+    taxa = {taxon["id"]: taxon for taxon in ancestors}
+    with lookups.duckdb_pool.connection() as cursor:
+        items = query_to_hash_list(cursor, *query)
+    for item in items:
+        del item["_position"]
+        item["intersecting_taxon"] = taxa[item.pop("intersecting_taxon_id")]
+    return items
+
+
+@app.get(
+    "/taxonomy/search",
+    summary="Find a taxon by its scientific, common or equivalent names using Full Text Search (FTS)",
+)
+async def search_taxonomy(
+    q: str = Query(..., min_length=3),
+    limit: int = Query(10, ge=1, le=100),
+    intersect: bool = False,
+    max_taxon_level="order",
+    integrated_only: bool = False,
+    intersect_limit: Optional[int] = 100,
+):
+    """
+    For a given string search the NCBI taxonomy names and return the best matching taxa.
+    Setting intersect also returns the nearest relatives in Ensembl of the top hit,
+    as given by /species/intersect, saving a second call
+    """
+    key = ResultCache.key(
+        "taxonomy_search",
+        q=" ".join(q.split()),
+        limit=limit,
+        intersect=intersect,
+        max_taxon_level=max_taxon_level if intersect else None,
+        integrated_only=integrated_only if intersect else None,
+        intersect_limit=intersect_limit if intersect else None,
+    )
+    cached = _cached_response(key)
+    if cached:
+        return cached
+    with lookup_manager.acquire() as lookups:
+        if not lookups.taxonomy_fts_available:
+            return {
+                "meta": {
+                    "status": "error",
+                    "error": "Taxonomy search is not available. Lookups were built without build_taxonomy_fts",
+                }
+            }
+        items = await executor.run(_search_taxonomy, lookups, q, limit)
+        json = {
+            "meta": {"status": "success", "items": len(items), "limit": limit},
+            "items": items,
+        }
+        if intersect:
+            genomes = []
+            taxonomy_id = None
+            if items:
+                taxonomy_id = items[0]["taxonomy_id"]
+                try:
+                    genomes = await executor.run(
+                        _intersect_taxonomy,
+                        lookups,
+                        taxonomy_id,
+                        max_taxon_level,
+                        integrated_only,
+                        intersect_limit,
+                    )
+                except HierarchyUnavailable as e:
+                    # Not cached as OLS may only be unavailable for a moment
+                    json["intersect"] = {"meta": {**e.meta, "taxonomy_id": taxonomy_id}}
+                    return json
+            json["intersect"] = {
+                "meta": {
+                    "status": "success",
+                    "taxonomy_id": taxonomy_id,
+                    "items": len(genomes),
+                },
+                "items": genomes,
+            }
+        return _cache_response(key, FastJSONResponse(json), lookups)
 
-    genomes.sort(key=lambda x: (x["total_distance"], x["accession"]))
-    if len(genomes) > limit:
-        genomes = genomes[slice(0, (limit))]
 
-    json = {"meta": {"status": "success", "items": len(genomes)}, "items": genomes}
-    return json
+def _search_taxonomy(lookups, q: str, limit: int):
+    # taxonomy_fts holds a row per combination of a taxon's names. Report each taxon
+    # once using its best scoring row. rank (bm25 by default) is lower for better matches
+    # and unlike bm25() can be used from within an aggregated CTE
+    query = """
+    WITH hits AS (
+        SELECT t.taxonomy_id, t.scientific_name, t.genbank_common_name, t.common_name, t.equivalent_name, t.rank AS score
+        FROM taxonomy_fts t
+        WHERE t.taxonomy_fts MATCH ?
+    )
+    SELECT CAST(taxonomy_id AS INTEGER) AS taxonomy_id, scientific_name, genbank_common_name, common_name, equivalent_name, min(score) AS score
+    FROM hits
+    GROUP BY taxonomy_id
+    order by score, taxonomy_id
+    limit ?
+"""
+    with lookups.sqlite_pool.connection() as con:
+        cursor = con.cursor()
+        items = query_to_hash_list(cursor, query, (q, limit))
+        cursor.close()
+    return items
 
 
 @app.get(
@@ -165,13 +872,42 @@ async def intersect_taxonomy(
 )
 def get_hierarchy(taxonomy_id: int = Path(..., ge=1), include_root: bool = False):
     """
-    Get the hierarchy of a taxonomic node. Uses OLSv4 from EMBL-EBI in the background
+    Get the hierarchy of a taxonomic node. Served from the precomputed lookups and falls back
+    to OLSv4 from EMBL-EBI for nodes outside of them (when enabled)
     """
+    with lookup_manager.acquire() as lookups:
+        return _get_hierarchy(lookups, taxonomy_id, include_root)
+
+
+def _get_hierarchy(lookups, taxonomy_id: int, include_root: bool):
+    with stage("hierarchy"):
+        output = lookups.taxonomy_hierarchy.ancestors(
+            taxonomy_id, include_root=include_root
+        )
+        if output is None and taxonomy_id in lookups.taxonomy_tree:
+            with lookups.duckdb_pool.connection() as cursor:
+                output = lookups.taxonomy_tree.ancestors(
+                    cursor, taxonomy_id, include_root=include_root
+                )
+        if output is not None:
+            return {
+                "meta": {"status": "success", "items": len(output)},
+                "items": output,
+            }
+        if config.lookups.ols_fallback:
+            return _get_ols_hierarchy(taxonomy_id, include_root)
+    return {"meta": {"status": "error", "error": f"Unknown taxonomy ID {taxonomy_id}"}}
+
+
+def _get_ols_hierarchy(taxonomy_id: int, include_root: bool):
     iri = f"http://purl.obolibrary.org/obo/NCBITaxon_{taxonomy_id}"
     encoded_iri = urllib.parse.quote_plus(iri)
     encoded_iri = urllib.parse.quote_plus(encoded_iri)
     url = f"https://www.ebi.ac.uk/ols4/api/ontologies/ncbitaxon/terms/{encoded_iri}/hierarchicalAncestors"
     params = {"lang": "en"}
+    # Imported on first use as most requests are served locally
+    import requests
+
     resp = requests.get(url, params=params)
     if resp:
         json = resp.json()
@@ -201,16 +937,30 @@ def get_hierarchy(taxonomy_id: int = Path(..., ge=1), include_root: bool = False
         return {"meta": {"status": "error", "error": resp.content}}
 
 
-def results_to_hash_list(results, cursor):
-    items = []
-    for row in results:
-        item = {}
-        iter_num = 0
-        for key in cursor.description:
-            item[key[0]] = row[iter_num]
-            iter_num += 1
-        items.append(item)
-    return items
+def _warm_up(lookups):
+    """
+    Run representative requests against a build of the lookups before it takes traffic,
+    so the pages and buffers they need are loaded. Uses config.lookups.warm_up_queries
+    and warm_up_taxa
+    """
+    for q in config.lookups.warm_up_queries:
+        _search_species(lookups, q, 10)
+        if lookups.species_trigram_fts_available:
+            _fuzzy_search_species(lookups, q, 10, set())
+        match = _typeahead_match(q)
+        if match:
+            _typeahead_species(lookups, match, 10)
+        if lookups.taxonomy_fts_available:
+            _search_taxonomy(lookups, q, 10)
+    for taxonomy_id in config.lookups.warm_up_taxa:
+        _get_intersecting_items(lookups, taxonomy_id, 100)
+        # Taxa outside of the lookups would be looked up in OLS
+        local = (
+            lookups.taxonomy_hierarchy.ancestors(taxonomy_id) is not None
+            or taxonomy_id in lookups.taxonomy_tree
+        )
+        if local:
+            _intersect_taxonomy(lookups, taxonomy_id, "order", False, 100)
 
 
 if __name__ == "__main__":
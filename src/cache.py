@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from typing import Hashable, Optional
+import hashlib
+import logging
+import os
+import threading
+
+
+def lookups_version(*paths: str) -> str:
+    """
+    Identify a build of the lookups from the size and modification time of their files
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(
+            f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode()
+        )
+    return digest.hexdigest()[:12]
+
+
+class ResultCache:
+    """
+    Bounded LRU cache of encoded responses. The cache is limited both by the number
+    of entries and by their total size in bytes. It is tagged with the version of the
+    lookups the entries were computed from, and setting a new version drops every entry
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, version: str = ""):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = version
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(endpoint: str, **params) -> tuple:
+        return (endpoint, tuple(sorted(params.items())))
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: bytes, version: Optional[str] = None) -> None:
+        """
+        Store a value. Values computed from a version of the lookups other than the
+        cache's (given by version) are not stored
+        """
+        if len(value) > self.max_bytes or self.max_entries == 0:
+            return
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._entries[key] = value
+            self.size += len(value)
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def set_version(self, version: str) -> None:
+        """
+        Move the cache to a new lookups version, dropping all entries if it changed
+        """
+        with self._lock:
+            if version == self.version:
+                return
+            logging.info(
+                f"Result cache moving from version {self.version} to {version}"
+            )
+            self.version = version
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "version": self.version,
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -1,4 +1,4 @@
-from typing import Tuple, Type, Optional
+from typing import Dict, List, Tuple, Type, Optional
 
 import os
 import logging
@@ -12,6 +12,8 @@ from pydantic_settings import (
     TomlConfigSettingsSource,
 )
 
+from .species import SpeciesFts
+
 
 class DatabaseSettings(BaseModel):
     host: str
@@ -26,12 +28,61 @@ class LookupSettings(BaseModel):
     sqlite_fts: str = "search_fts.sqlite"
     local_taxonomy: str = "local_taxonomy.duckdb"
     build_taxonomy_fts: bool = False
+    build_taxonomy_tree: bool = True
+    incremental: bool = False
+    build_workers: PositiveInt = 4
+    reuse_previous_build: bool = True
+    species_fts_prefix: List[PositiveInt] = [2, 3, 4]
+    species_fts_unindexed: List[str] = list(SpeciesFts._default_unindexed)
+    species_fts_weights: Dict[str, float] = SpeciesFts._default_weights
+    build_species_trigram_fts: bool = True
+    fts_bulk_load: bool = True
+    hot_taxa: List[PositiveInt] = [40674, 7742, 9443, 9606]
+    hot_taxa_top: int = 0
+    hot_intersect_levels: List[str] = ["order"]
+    ols_fallback: bool = True
+    sqlite_read_only: bool = True
+    sqlite_mmap_size: int = 268435456
+    sqlite_cache_size: int = -16000
+    directory: Optional[str] = None
+    watch_interval: int = 0
+    drain_timeout: PositiveInt = 60
+    warm_up: bool = True
+    warm_up_queries: List[str] = ["homo sapiens", "mus musculus", "danio", "primates"]
+    warm_up_taxa: List[PositiveInt] = [9606, 10090, 40674]
+    start_attempts: PositiveInt = 5
+    start_retry_interval: PositiveInt = 10
+
+
+class ServerSettings(BaseModel):
+    query_threads: PositiveInt = 8
+    duckdb_pool_size: PositiveInt = 8
+    sqlite_pool_size: PositiveInt = 8
+    sqlite_cached_statements: PositiveInt = 128
+    batch_max_keys: PositiveInt = 10000
+    fuzzy_min_hits: int = 3
+    fuzzy_candidates: PositiveInt = 200
+    fuzzy_min_similarity: float = 0.3
+    admin_token: Optional[str] = None
+    allow_profile: bool = False
+    slow_query_ms: int = 0
+    slow_query_log: str = "slow_queries.log"
+    slow_query_log_bytes: PositiveInt = 10485760
+    slow_query_log_backups: int = 5
+
+
+class CacheSettings(BaseModel):
+    enabled: bool = True
+    max_entries: PositiveInt = 1024
+    max_bytes: PositiveInt = 67108864
 
 
 class TomlSettings(BaseSettings):
     model_config = SettingsConfigDict(toml_file="config.toml")
     source_database: Optional[DatabaseSettings] = None
     lookups: LookupSettings = LookupSettings()
+    server: ServerSettings = ServerSettings()
+    cache: CacheSettings = CacheSettings()
     log_config: Optional[str] = None
 
     @classmethod
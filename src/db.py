@@ -1,20 +1,149 @@
-from typing import Optional, Sequence, Any
+from typing import Optional, Sequence, Any, Callable
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import asyncio
 import collections.abc
+import contextvars
+import functools
 import duckdb
+import queue
+import shutil
 import sqlite3
 import logging
 import os
+import threading
+import time
+import urllib.parse
+
+
+class ConnectionPool:
+    """
+    Bounded pool of database connections. Connections are created on demand up to
+    the pool size; once all are in use callers block until one is returned
+    """
+
+    def __init__(self, factory: Callable[[], Any], size: int):
+        self.factory = factory
+        self.size = size
+        self._available = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._waits = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        con = self._acquire()
+        try:
+            yield con
+        finally:
+            self._available.put(con)
+
+    def _acquire(self):
+        try:
+            return self._available.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return self.factory()
+            self._waits += 1
+        return self._available.get()
+
+    def fill(self) -> None:
+        """
+        Create any connections not yet made so requests do not pay for opening them
+        """
+        while True:
+            with self._lock:
+                if self._created >= self.size:
+                    return
+                self._created += 1
+            self._available.put(self.factory())
+
+    def stats(self) -> dict:
+        """
+        Size of the pool, connections in use and how many times callers had to wait
+        for one as they were all in use
+        """
+        with self._lock:
+            return {
+                "size": self.size,
+                "in_use": self._created - self._available.qsize(),
+                "waits": self._waits,
+            }
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._available.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class QueryExecutor:
+    """
+    Runs blocking database calls on a bounded thread pool so they do not stall
+    the event loop
+    """
+
+    def __init__(self, max_workers: int):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="query"
+        )
+
+    async def run(self, func: Callable, *args, **kwargs):
+        # Run in a copy of the caller's context so the call sees its context variables
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(context.run, func, *args, **kwargs)
+        )
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+def new_file(path: str, copy: bool = True) -> str:
+    """
+    Path of a new file to build in place of the one at path, starting from a copy of
+    it unless copy is unset. Files left by an interrupted build of it, such as a DuckDB
+    WAL, are removed first. Once built it replaces the file at path (os.replace), as
+    the lookups are served from immutable connections whose files must not change
+    """
+    new_path = f"{path}.new"
+    for stale in (new_path, f"{new_path}.wal", f"{new_path}.building"):
+        if os.path.exists(stale):
+            os.remove(stale)
+    if copy and os.path.exists(path):
+        logging.info(f"Copying {path} to {new_path}")
+        shutil.copyfile(path, new_path)
+    return new_path
 
 
 class SQLiteDb:
     @staticmethod
-    def create(name, path: str = ":memory:"):
-        return SQLiteDb(path, name)
+    def create(name, path: str = ":memory:", **kwargs):
+        return SQLiteDb(path, name, **kwargs)
 
-    def __init__(self, name: str, path: str):
+    def __init__(
+        self,
+        name: str,
+        path: str,
+        check_same_thread: bool = True,
+        cached_statements: int = 128,
+        read_only: bool = False,
+        mmap_size: int = 0,
+        cache_size: Optional[int] = None,
+    ):
         self.name = name
         self.path = path
+        self.check_same_thread = check_same_thread
+        self.cached_statements = cached_statements
+        self.read_only = read_only
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
         self._con = None
         self._con_loaded = False
 
@@ -26,27 +155,125 @@ class SQLiteDb:
         return self._con
 
     def create_sqlite_connection(self):
+        """
+        Connect to the database. In read-only mode the file is opened as an immutable
+        URI, meaning SQLite skips all locking and change detection, and the connection
+        can be shared across threads as nothing will write to it
+        """
         logging.info(f"Connecting to SQLite at {self.path}")
-        sqlite3_con = sqlite3.connect(self.path)
+        if self.read_only:
+            path = urllib.parse.quote(os.path.abspath(self.path))
+            sqlite3_con = sqlite3.connect(
+                f"file:{path}?mode=ro&immutable=1",
+                uri=True,
+                check_same_thread=False,
+                cached_statements=self.cached_statements,
+            )
+        else:
+            sqlite3_con = sqlite3.connect(
+                self.path,
+                check_same_thread=self.check_same_thread,
+                cached_statements=self.cached_statements,
+            )
+        if self.mmap_size:
+            sqlite3_con.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        if self.cache_size is not None:
+            sqlite3_con.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
         logging.info("Connected to SQLite")
         return sqlite3_con
 
+    def close(self) -> None:
+        if self._con_loaded:
+            self._con.close()
+            self._con = None
+            self._con_loaded = False
+
+    def connection_pool(self, size: int) -> ConnectionPool:
+        """
+        Pool of independent connections to the database. Connections must allow
+        use from other threads if the pool is shared between threads
+        """
+        return ConnectionPool(self.create_sqlite_connection, size)
+
+    def has_table(self, table: str) -> bool:
+        cursor = self.con.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (table,),
+        )
+        return cursor.fetchone()[0] > 0
+
     def remove_sqlite(self):
         if os.path.exists(self.path):
             logging.info(f"Removing {self.path} SQLite database")
             os.remove(self.path)
 
+    def building_path(self) -> str:
+        return f"{self.path}.building"
+
+    def interrupted(self) -> bool:
+        """
+        True if a build of the file was started and did not finish. Bulk loads write
+        with the journal off, so the file may be corrupt and nothing in it reused
+        """
+        return os.path.exists(self.building_path())
+
+    @contextmanager
+    def building(self):
+        """
+        Mark the file as being built until the block completes. The marker is left in
+        place if the block fails
+        """
+        with open(self.building_path(), "w"):
+            pass
+        yield
+        os.remove(self.building_path())
+
+    @contextmanager
+    def replacing(self, copy: bool = True):
+        """
+        Write to a new file (see new_file) until the block completes, then replace the
+        file with it. Readers with the file open keep reading the old one. The new file
+        is left in place if the block fails
+        """
+        path = self.path
+        self.close()
+        self.path = new_file(path, copy)
+        try:
+            yield
+            self.close()
+            os.replace(self.path, path)
+        finally:
+            self.close()
+            self.path = path
+
+    def vacuum(self):
+        """
+        Vacuum the file if it holds free pages, such as those of FTS segments merged by
+        optimize or of tables dropped by the build
+        """
+        free_pages = self.con.execute("PRAGMA freelist_count").fetchone()[0]
+        if free_pages:
+            logging.info(f"Vacuuming {free_pages} free pages of {self.path}")
+            self.con.execute("VACUUM")
+
 
 class DuckDb:
     @staticmethod
-    def create(db: str = ":memory:"):
-        con = duckdb.connect(db)
+    def create(db: str = ":memory:", read_only: bool = False):
+        con = duckdb.connect(db, read_only=read_only)
         return DuckDb(con, db)
 
     def __init__(self, con, name: str):
         self.con = con
         self.name = name
 
+    def cursor_pool(self, size: int) -> ConnectionPool:
+        """
+        Pool of cursors on this database. Each cursor is a separate connection to
+        the same database so they can be used concurrently from different threads
+        """
+        return ConnectionPool(self.con.cursor, size)
+
     def current_catalog(self) -> str:
         results = self.con.sql("select current_catalog()").fetchall()
         return results[0][0]
@@ -92,9 +319,11 @@ class DuckDb:
         self.con.execute(connection_string)
         logging.info(f"SQLite attached as {name}")
 
-    def connect_to_duckdb(self, name: str, path: str) -> None:
+    def connect_to_duckdb(self, name: str, path: str, read_only: bool = False) -> None:
         logging.info(f"Connecting to DuckDb as {name}")
         connection_string = f"ATTACH '{path}' as {name}"
+        if read_only:
+            connection_string = connection_string + " (READ_ONLY)"
         self.con.execute(connection_string)
         logging.info(f"DuckDb attached as {name}")
 
@@ -234,37 +463,145 @@ class CopyTable:
 
 
 class CreateSQLiteFTS(ABC):
-    def __init__(self, duckdb: DuckDb, sqlite: SQLiteDb, indexed_table):
+    # Name of the FTS5 table created. Used to report the size of its index
+    fts_table = None
+    # Connection settings while bulk loading. The journal and syncs are turned off as
+    # an interrupted build is built again rather than recovered
+    bulk_pragmas = {"journal_mode": "OFF", "synchronous": "OFF", "cache_size": -262144}
+    # FTS5 merge settings while bulk loading and those restored afterwards (FTS5's
+    # defaults). Segments are left unmerged until the load is done and then merged
+    # into one by optimize
+    bulk_merge = {"automerge": 0, "crisismerge": 64}
+    default_merge = {"automerge": 4, "crisismerge": 16}
+
+    def __init__(
+        self, duckdb: DuckDb, sqlite: SQLiteDb, indexed_table, bulk_load: bool = False
+    ):
         self.duckdb = duckdb
         self.sqlite = sqlite
         self.indexed_table = indexed_table
+        self.bulk_load = bulk_load
 
-    def run(self):
+    def run(self) -> dict:
+        """
+        Build the FTS table. When indexed_table is set it is first copied from DuckDB
+        into a staging SQLite file for fts_sql to read from, otherwise fts_sql reads
+        tables already held in SQLite. In bulk load mode the load runs with
+        bulk_pragmas and bulk_merge, after which the index is optimised. The pages
+        freed by optimize are left for the caller to vacuum once every FTS table is
+        built (see SQLiteDb.vacuum). Returns the build time, rows loaded per second
+        and size of the index
+        """
         logging.info(f"Building SQLite full-text search for {self.__class__.__name__}")
-        current_catalog = self.duckdb.current_catalog()
-        logging.info("Creating FTS schema in SQLite")
+        start = time.perf_counter()
         indexed_table = self.indexed_table
-        CopyTable(
-            self.duckdb.con,
-            current_catalog,
-            self.sqlite.name,
-            indexed_table,
-            indexed_table,
-            index_columns=[],
-        ).run()
         sqlite_con = self.sqlite.con
-        ddl = self.fts_ddl()
-        logging.debug(f"{self.__class__.__name__} FTS DDL {ddl}")
-        sqlite_con.execute(ddl)
-        logging.info("Populating FTS schema from DuckDB")
-        sql = self.fts_sql()
-        logging.debug(f"{self.__class__.__name__} FTS population SQL: {sql}")
-        sqlite_con.execute(sql)
-        logging.info("Dropping the source table from SQLite")
-        sqlite_con.execute(f"DROP TABLE {indexed_table}")
-        logging.info("Committing")
-        sqlite_con.commit()
+        previous_pragmas = self.set_pragmas(self.bulk_pragmas) if self.bulk_load else {}
+        try:
+            if indexed_table:
+                logging.info("Creating FTS schema in SQLite")
+                self.copy_indexed_table()
+            ddl = self.fts_ddl()
+            logging.debug(f"{self.__class__.__name__} FTS DDL {ddl}")
+            sqlite_con.execute(ddl)
+            self.configure_fts(self.fts_options())
+            if self.bulk_load:
+                self.configure_fts(self.bulk_merge)
+            logging.info("Populating FTS schema from DuckDB")
+            sql = self.fts_sql()
+            logging.debug(f"{self.__class__.__name__} FTS population SQL: {sql}")
+            sqlite_con.execute(sql)
+            logging.info("Committing")
+            sqlite_con.commit()
+            if self.bulk_load:
+                logging.info("Merging the FTS index segments")
+                sqlite_con.execute(
+                    f"INSERT INTO {self.fts_table}({self.fts_table}) VALUES('optimize')"
+                )
+                self.configure_fts(self.default_merge)
+                sqlite_con.commit()
+            if indexed_table:
+                logging.info("Removing the staging copy of the source table")
+                sqlite_con.execute("DETACH DATABASE staging")
+                os.remove(self.staging_path())
+        finally:
+            # The pragmas cannot be changed inside the transaction of a failed load
+            if sqlite_con.in_transaction:
+                sqlite_con.rollback()
+            self.set_pragmas(previous_pragmas)
+        stats = self.report(time.perf_counter() - start)
         logging.info("Finished")
+        return stats
+
+    def set_pragmas(self, pragmas: dict) -> dict:
+        """
+        Set the pragmas on the SQLite connection, returning their previous values
+        """
+        previous = {}
+        for pragma, value in pragmas.items():
+            previous[pragma] = self.sqlite.con.execute(f"PRAGMA {pragma}").fetchone()[0]
+            self.sqlite.con.execute(f"PRAGMA {pragma} = {value}").fetchall()
+        return previous
+
+    def configure_fts(self, options: dict):
+        for option, value in options.items():
+            self.sqlite.con.execute(
+                f"INSERT INTO {self.fts_table}({self.fts_table}, rank) VALUES(?, ?)",
+                (option, value),
+            )
+
+    def copy_indexed_table(self):
+        """
+        Copy indexed_table from DuckDB into a staging SQLite file attached to the SQLite
+        connection, where fts_sql finds it by name. DuckDB never opens the FTS file and
+        detaches the staging file before SQLite opens it: two copies of SQLite in one
+        process using the same file at once break each other's locks
+        """
+        table = self.indexed_table
+        path = self.staging_path()
+        if os.path.exists(path):
+            os.remove(path)
+        catalog = f"{table}_staging"
+        current_catalog = self.duckdb.current_catalog()
+        self.duckdb.con.execute(f"ATTACH '{path}' AS {catalog} (TYPE sqlite)")
+        try:
+            CopyTable(
+                self.duckdb.con,
+                current_catalog,
+                catalog,
+                table,
+                table,
+                index_columns=[],
+            ).run()
+        finally:
+            self.duckdb.detach(catalog)
+        self.sqlite.con.execute("ATTACH DATABASE ? AS staging", (path,))
+
+    def staging_path(self) -> str:
+        return f"{self.sqlite.path}.{self.indexed_table}.staging"
+
+    def report(self, seconds: float) -> dict:
+        """
+        Log how long the build took and how large the index is. The index size is the
+        size of the FTS5 segment blocks, leaving out any copy of the indexed content
+        """
+        stats = {"table": self.fts_table, "seconds": round(seconds, 3)}
+        if self.fts_table:
+            cursor = self.sqlite.con.execute(
+                f"SELECT (SELECT count(*) FROM {self.fts_table}), (SELECT sum(length(block)) FROM {self.fts_table}_data)"
+            )
+            stats["rows"], stats["index_bytes"] = cursor.fetchone()
+            stats["rows_per_second"] = round(stats["rows"] / seconds) if seconds else 0
+            logging.info(
+                f"Built {self.fts_table} in {stats['seconds']}s: {stats['rows']} rows ({stats['rows_per_second']} rows/s), index of {stats['index_bytes'] / 1048576:.1f} MiB"
+            )
+        return stats
+
+    def fts_options(self) -> dict:
+        """
+        FTS5 configuration options, such as rank, set on the table once created
+        """
+        return {}
 
     @abstractmethod
     def fts_ddl(self):
@@ -0,0 +1,42 @@
+from typing import Iterable, Optional, Set
+import re
+
+_word = re.compile(r"\w+")
+
+
+def trigrams(text: Optional[str], padded: bool = True) -> Set[str]:
+    """
+    Lowercased three character substrings of each word in the text. As with pg_trgm
+    words are padded with two spaces before and one after, which weights the start
+    and end of words and keeps similarity up for words with transposed letters
+    """
+    if not text:
+        return set()
+    grams = set()
+    for word in _word.findall(text.lower()):
+        if padded:
+            word = f"  {word} "
+        grams.update(word[i : i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+def trigram_match(q: str) -> str:
+    """
+    FTS5 query matching any of the trigrams within the words of the query. Used against
+    a trigram tokenized table this finds candidates sharing at least one trigram with it
+    """
+    return " OR ".join(f'"{gram}"' for gram in sorted(trigrams(q, padded=False)))
+
+
+def similarity(query_trigrams: Set[str], values: Iterable[Optional[str]]) -> float:
+    """
+    Best Jaccard similarity between the query's trigrams and those of any of the values
+    """
+    best = 0.0
+    for value in values:
+        value_trigrams = trigrams(value)
+        if not value_trigrams:
+            continue
+        shared = len(query_trigrams & value_trigrams)
+        best = max(best, shared / len(query_trigrams | value_trigrams))
+    return best
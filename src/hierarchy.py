@@ -0,0 +1,199 @@
+from array import array
+from typing import Dict, List, Optional, Sequence
+from .db import DuckDb
+import logging
+import sys
+
+
+class TaxonomyHierarchy:
+    """
+    Serves taxonomy ancestors from memory using the taxonomy_ancestors table
+    precomputed by Taxonomy. Items are returned in the same format as OLS'
+    hierarchicalAncestors endpoint, nearest ancestor first.
+    """
+
+    purl_prefix = "http://purl.obolibrary.org/obo/NCBITaxon_"
+
+    @staticmethod
+    def create(duckdb: DuckDb):
+        cursor = duckdb.con.cursor()
+        cursor.execute(
+            "select count(*) from duckdb_tables() where table_name = 'taxonomy_ancestors'"
+        )
+        if cursor.fetchone()[0] == 0:
+            logging.warning(
+                "No taxonomy_ancestors table found. Hierarchy lookups will not be served locally"
+            )
+            return TaxonomyHierarchy({})
+        cursor.execute(
+            """
+            select taxonomy_id, ancestor_id, rank, label, distance, is_root
+            from taxonomy_ancestors
+            order by taxonomy_id, distance
+            """
+        )
+        lineages = {}
+        for (
+            taxonomy_id,
+            ancestor_id,
+            rank,
+            label,
+            distance,
+            is_root,
+        ) in cursor.fetchall():
+            item = {
+                "iri": f"{TaxonomyHierarchy.purl_prefix}{ancestor_id}",
+                "id": ancestor_id,
+                "rank": rank,
+                "label": label,
+                "distance": distance,
+            }
+            lineages.setdefault(taxonomy_id, []).append((item, is_root))
+        cursor.close()
+        logging.info(f"Loaded taxonomy hierarchy for {len(lineages)} taxa")
+        return TaxonomyHierarchy(lineages)
+
+    def __init__(self, lineages: Dict[int, List]):
+        self.lineages = lineages
+
+    def __contains__(self, taxonomy_id: int) -> bool:
+        return taxonomy_id in self.lineages
+
+    def ancestors(
+        self, taxonomy_id: int, include_root: bool = False
+    ) -> Optional[List[dict]]:
+        """
+        Return the ancestors of the given taxon or None if it is not known locally
+        """
+        lineage = self.lineages.get(taxonomy_id)
+        if lineage is None:
+            return None
+        return [dict(item) for item, is_root in lineage if include_root or not is_root]
+
+
+class TaxonomyTree:
+    """
+    Serves the ancestors of any NCBI taxon, in the same format as TaxonomyHierarchy,
+    from the taxonomy_parents and taxonomy_tree tables built by Taxonomy. The parent of
+    every taxon is held in memory in an array indexed by taxon ID, which is walked to
+    find a lineage. The ranks and labels of its taxa are then fetched from taxonomy_tree
+    with a single indexed query
+    """
+
+    # Deeper lineages than this can only come from a cycle
+    max_lineage_depth = 1000
+
+    @staticmethod
+    def create(duckdb: DuckDb):
+        cursor = duckdb.con.cursor()
+        cursor.execute(
+            "select count(*) from duckdb_tables() where table_name = 'taxonomy_parents'"
+        )
+        if cursor.fetchone()[0] == 0:
+            logging.info(
+                "No taxonomy_parents table found. Taxa outside of the organism lineages will not be served locally"
+            )
+            cursor.close()
+            return TaxonomyTree(array("i"))
+        cursor.execute("select parents from taxonomy_parents")
+        tree = TaxonomyTree(decode_parents(cursor.fetchone()[0]))
+        cursor.close()
+        logging.info(
+            f"Loaded taxonomy tree of {tree.taxa} taxa using {tree.nbytes / 1048576:.1f}MiB"
+        )
+        return tree
+
+    def __init__(self, parents: array):
+        self.parents = parents
+        self.taxa = len(parents) - parents.count(0)
+
+    @property
+    def nbytes(self) -> int:
+        return self.parents.itemsize * len(self.parents)
+
+    def __contains__(self, taxonomy_id: int) -> bool:
+        return 0 < taxonomy_id < len(self.parents) and self.parents[taxonomy_id] != 0
+
+    def lineage(self, taxonomy_id: int) -> List[int]:
+        """
+        IDs of the ancestors of a taxon in the tree, nearest first and ending with the
+        root
+        """
+        lineage = []
+        parent = self.parents[taxonomy_id]
+        while parent != taxonomy_id and parent in self:
+            lineage.append(parent)
+            if len(lineage) > self.max_lineage_depth:
+                raise ValueError(f"The lineage of taxon {taxonomy_id} has a cycle")
+            taxonomy_id, parent = parent, self.parents[parent]
+        return lineage
+
+    def ancestors(
+        self, cursor, taxonomy_id: int, include_root: bool = False
+    ) -> Optional[List[dict]]:
+        """
+        Return the ancestors of the given taxon, looking up their ranks and labels with
+        the DuckDB cursor, or None if it is not in the tree
+        """
+        if taxonomy_id not in self:
+            return None
+        lineage = self.lineage(taxonomy_id)
+        if not include_root:
+            lineage = lineage[:-1]
+        if not lineage:
+            return []
+        cursor.execute(
+            "select taxon_id, rank, label from taxonomy_tree where taxon_id = any(?::INTEGER[])",
+            [lineage],
+        )
+        taxa = {taxon_id: (rank, label) for taxon_id, rank, label in cursor.fetchall()}
+        return [
+            {
+                "iri": f"{TaxonomyHierarchy.purl_prefix}{ancestor_id}",
+                "id": ancestor_id,
+                "rank": taxa[ancestor_id][0],
+                "label": taxa[ancestor_id][1],
+                "distance": distance,
+            }
+            for distance, ancestor_id in enumerate(lineage, 1)
+        ]
+
+
+def encode_parents(parents: Sequence[int]) -> bytes:
+    """
+    Encode parent taxon IDs, indexed by taxon ID, as 32-bit little endian integers
+    """
+    encoded = array("i", parents)
+    if sys.byteorder == "big":
+        encoded.byteswap()
+    return encoded.tobytes()
+
+
+def decode_parents(encoded: bytes) -> array:
+    parents = array("i")
+    parents.frombytes(encoded)
+    if sys.byteorder == "big":
+        parents.byteswap()
+    return parents
+
+
+class HierarchyUnavailable(Exception):
+    """
+    The ancestors of a taxon could not be found. Holds the meta of the error response
+    """
+
+    def __init__(self, meta: dict):
+        super().__init__(meta.get("error"))
+        self.meta = meta
+
+
+def ancestors_up_to(ancestors: List[dict], max_taxon_level: str) -> List[dict]:
+    """
+    Nearest first ancestors, stopping once the requested rank has been reached
+    """
+    selected = []
+    for taxon in ancestors:
+        selected.append(taxon)
+        if taxon["rank"] == max_taxon_level:
+            break
+    return selected
@@ -0,0 +1,160 @@
+from typing import Sequence, Set, Tuple
+from .db import DuckDb
+from .hierarchy import TaxonomyHierarchy, ancestors_up_to
+from .queries import intersecting_items_query, nearest_items_query
+import logging
+
+
+class HotClades:
+    """
+    Precompute the results of /species/taxonomy and /species/intersect for the most
+    requested taxa into hot_clade_results and hot_intersect_results. Hot taxa are
+    those configured plus the given number with the most genomes beneath them. The
+    server answers requests for these with a single key lookup. Must run after
+    Species and Taxonomy
+    """
+
+    def __init__(
+        self,
+        duckdb: DuckDb,
+        hot_taxa: Sequence[int] = (),
+        top: int = 0,
+        intersect_levels: Sequence[str] = ("order",),
+    ):
+        self.duckdb = duckdb
+        self.hot_taxa = hot_taxa
+        self.top = top
+        self.intersect_levels = intersect_levels
+
+    @staticmethod
+    def served(duckdb: DuckDb) -> Tuple[Set[int], Set[Tuple[int, str, bool]]]:
+        """
+        Taxa with precomputed taxonomy results and the (taxon, max_taxon_level, integrated_only)
+        keys with precomputed intersect results
+        """
+        cursor = duckdb.con.cursor()
+        cursor.execute(
+            "select table_name from duckdb_tables() where table_name in ('hot_clade_results', 'hot_intersect_results')"
+        )
+        tables = {row[0] for row in cursor.fetchall()}
+        taxa, intersects = set(), set()
+        if "hot_clade_results" in tables:
+            cursor.execute("select distinct hot_taxonomy_id from hot_clade_results")
+            taxa = {row[0] for row in cursor.fetchall()}
+        if "hot_intersect_results" in tables:
+            cursor.execute(
+                "select distinct hot_taxonomy_id, max_taxon_level, integrated_only from hot_intersect_results"
+            )
+            intersects = set(cursor.fetchall())
+        cursor.close()
+        logging.info(
+            f"Serving precomputed results for {len(taxa)} hot clades and {len(intersects)} hot intersects"
+        )
+        return taxa, intersects
+
+    def run(self):
+        logging.info("Selecting hot taxa")
+        taxa = self._select_hot_taxa()
+        logging.info(f"Precomputing results for {len(taxa)} hot taxa")
+        self._create_hot_clade_results(taxa)
+        self._create_hot_intersect_results(taxa)
+        logging.info("Finished building hot clades")
+
+    def _select_hot_taxa(self):
+        con = self.duckdb.con
+        con.execute(
+            """
+            select taxon_id from taxonomy_nested_set
+            where taxon_id in (select unnest(?::BIGINT[]))
+            order by taxon_id
+            """,
+            (list(self.hot_taxa),),
+        )
+        taxa = [row[0] for row in con.fetchall()]
+        missing = set(self.hot_taxa) - set(taxa)
+        if missing:
+            logging.warning(
+                f"Hot taxa {sorted(missing)} are not in the lookups. Skipping"
+            )
+        if self.top:
+            con.execute(
+                """
+                select ns.taxon_id, count(*) as genomes
+                from taxonomy_nested_set ns
+                join computed_hierarchy ch on ch.left_index between ns.left_index and ns.right_index
+                join species s on s.taxonomy_id = ch.organism_taxonomy_id
+                group by ns.taxon_id
+                order by genomes desc, ns.taxon_id
+                limit ?
+                """,
+                (self.top,),
+            )
+            for taxon_id, genomes in con.fetchall():
+                if taxon_id not in taxa:
+                    logging.info(f"Taxon {taxon_id} with {genomes} genomes is hot")
+                    taxa.append(taxon_id)
+        return taxa
+
+    def _create_hot_clade_results(self, taxa):
+        con = self.duckdb.con
+        selects = []
+        for taxon_id in taxa:
+            query, params = intersecting_items_query(con, taxon_id, None)
+            selects.append(
+                (
+                    f"select ?::BIGINT as hot_taxonomy_id, * from ({query})",
+                    [taxon_id, *params],
+                )
+            )
+        self._create_table(
+            "hot_clade_results", selects, "hot_taxonomy_id, _left_index, _species_id"
+        )
+
+    def _create_hot_intersect_results(self, taxa):
+        hierarchy = TaxonomyHierarchy.create(self.duckdb)
+        selects = []
+        for taxon_id in taxa:
+            for max_taxon_level in self.intersect_levels:
+                ancestors = ancestors_up_to(
+                    hierarchy.ancestors(taxon_id) or [], max_taxon_level
+                )
+                if not ancestors:
+                    continue
+                for integrated_only in (False, True):
+                    query, params = nearest_items_query(
+                        ancestors, integrated_only, None
+                    )
+                    selects.append(
+                        (
+                            f"select ?::BIGINT as hot_taxonomy_id, ?::VARCHAR as max_taxon_level, ?::BOOLEAN as integrated_only, * from ({query})",
+                            [taxon_id, max_taxon_level, integrated_only, *params],
+                        )
+                    )
+        self._create_table(
+            "hot_intersect_results",
+            selects,
+            "hot_taxonomy_id, max_taxon_level, integrated_only, _position",
+        )
+
+    def _create_table(self, table: str, selects, order: str):
+        """
+        Create the table from the union of the selects. Rows are sorted so those of
+        a key are stored together and min/max zonemaps limit a lookup to the few row
+        groups holding them. This is faster than an ART index scan, which fetches
+        matching rows one at a time
+        """
+        con = self.duckdb.con
+        con.execute(f"drop table if exists {table}")
+        if not selects:
+            logging.info(f"No results to store in {table}")
+            return
+        union = "\nunion all\n".join(
+            f"select * from ({query})" for query, params in selects
+        )
+        params = [param for query, query_params in selects for param in query_params]
+        con.execute(
+            f"create table {table} as select * from ({union}) order by {order}",
+            params,
+        )
+        con.execute(f"select count(*) from {table}")
+        logging.info(f"Stored {con.fetchone()[0]} rows in {table}")
@@ -0,0 +1,326 @@
+from typing import Dict, List, Optional, Tuple
+from .db import CopyTable, DuckDb, SQLiteDb
+from .hot_clades import HotClades
+from .species import Species, SpeciesFts, SpeciesTrigramFts
+from .taxonomy import Taxonomy
+import logging
+import os
+import time
+import duckdb as duckdb_module
+
+
+class SourceFingerprints:
+    """
+    Fingerprints of the metadata a build of the lookups was made from. Each source
+    table is fingerprinted by its row count and the sum of the hashes of its rows, and
+    each species row by the hash of the columns taken from the metadata. Recorded in
+    the build_fingerprints and species_fingerprints tables so the next build can find
+    what changed
+    """
+
+    tables = ("assembly", "genome", "organism", "genome_release", "ensembl_release")
+    species_columns = (
+        "accession",
+        "name",
+        "assembly_default",
+        "tol_id",
+        "ensembl_name",
+        "assembly_uuid",
+        "url_name",
+        "genome_uuid",
+        "production_name",
+        "common_name",
+        "scientific_name",
+        "biosample_id",
+        "strain",
+        "is_current",
+        "release_label",
+        "release_type",
+        "taxonomy_id",
+        "species_taxonomy_id",
+    )
+
+    def __init__(self, duckdb: DuckDb, source_schema: str = "mysqldb"):
+        self.duckdb = duckdb
+        self.source_schema = source_schema
+
+    @classmethod
+    def species_fingerprint(cls) -> str:
+        return f"hash({', '.join(cls.species_columns)})"
+
+    @staticmethod
+    def table_fingerprint(duckdb: DuckDb, table: str) -> Tuple[int, int]:
+        return duckdb.con.execute(
+            f"select count(*), coalesce(sum(hash(t)), 0) from {table} t"
+        ).fetchone()
+
+    def compute(self) -> Dict[str, Tuple[int, int]]:
+        return {
+            table: self.table_fingerprint(self.duckdb, f"{self.source_schema}.{table}")
+            for table in self.tables
+        }
+
+    def previous(self) -> Dict[str, Tuple[int, int]]:
+        rows = self.duckdb.con.execute(
+            "select source_table, row_count, fingerprint from build_fingerprints"
+        ).fetchall()
+        return {table: (count, fingerprint) for table, count, fingerprint in rows}
+
+    def record(self, fingerprints: Optional[Dict[str, Tuple[int, int]]] = None):
+        """
+        Record the fingerprints of the source tables (computing them unless given) and
+        of every row of species
+        """
+        if fingerprints is None:
+            fingerprints = self.compute()
+        con = self.duckdb.con
+        con.execute(
+            "create or replace table build_fingerprints (source_table VARCHAR, row_count BIGINT, fingerprint HUGEINT)"
+        )
+        con.executemany(
+            "insert into build_fingerprints values (?, ?, ?)",
+            [(table, count, fp) for table, (count, fp) in fingerprints.items()],
+        )
+        con.execute(
+            f"create or replace table species_fingerprints AS SELECT species_id, {self.species_fingerprint()} AS fingerprint FROM species"
+        )
+
+
+class IncrementalBuild:
+    """
+    Update a previous build of the lookups in place with the changes made to the
+    metadata since it was built. Source tables whose fingerprint is unchanged are
+    skipped. Otherwise species rows are rebuilt from the metadata and compared with the
+    previous rows by fingerprint: rows which have gone are deleted and new or changed
+    rows inserted into species, species_fts and species_trigram_fts, leaving the other
+    rows and their IDs untouched. The organism lineages are rebuilt when organism
+    changes and the hot clades whenever species does. New rows are appended to the FTS
+    tables, so if any of them are boosted (which must come first in rowid order) the
+    FTS tables are rebuilt instead
+    """
+
+    def __init__(
+        self,
+        duckdb: DuckDb,
+        sqlite: SQLiteDb,
+        species: Species,
+        species_fts: SpeciesFts,
+        taxonomy: Taxonomy,
+        hot_clades: HotClades,
+        species_trigram_fts: Optional[SpeciesTrigramFts] = None,
+    ):
+        self.duckdb = duckdb
+        self.sqlite = sqlite
+        self.species = species
+        self.species_fts = species_fts
+        self.taxonomy = taxonomy
+        self.hot_clades = hot_clades
+        self.species_trigram_fts = species_trigram_fts
+        self.fingerprints = SourceFingerprints(duckdb, species.source_schema)
+
+    @staticmethod
+    def possible(duckdb_path: str, sqlite_path: str) -> bool:
+        """
+        True if the previous build at the paths recorded its fingerprints and finished
+        writing to SQLite
+        """
+        if not (os.path.exists(duckdb_path) and os.path.exists(sqlite_path)):
+            return False
+        if SQLiteDb("sqlitedb", sqlite_path).interrupted():
+            return False
+        con = duckdb_module.connect(duckdb_path, read_only=True)
+        try:
+            found = con.execute(
+                "select count(*) from duckdb_tables() where table_name in ('build_fingerprints', 'species_fingerprints')"
+            ).fetchone()[0]
+        finally:
+            con.close()
+        return found == 2
+
+    def run(self) -> dict:
+        start = time.perf_counter()
+        fingerprints = self.fingerprints.compute()
+        previous = self.fingerprints.previous()
+        changed = [
+            t for t in SourceFingerprints.tables if fingerprints[t] != previous.get(t)
+        ]
+        stats = {"changed_tables": changed, "inserted": 0, "deleted": 0}
+        if not changed:
+            logging.info("The metadata is unchanged since the previous build")
+            stats["seconds"] = round(time.perf_counter() - start, 3)
+            return stats
+        logging.info(f"Changed since the previous build: {', '.join(changed)}")
+        # The stage keys recorded by the full build no longer describe the tables
+        self.duckdb.con.execute("drop table if exists build_stages")
+        self.sqlite.con.execute("DROP TABLE IF EXISTS build_stages")
+        self.sqlite.con.commit()
+
+        deleted, inserted = self._update_species()
+        stats["deleted"], stats["inserted"] = len(deleted), len(inserted)
+        if deleted or inserted:
+            with self.sqlite.building():
+                stats["fts"] = self._update_fts(deleted, inserted)
+                if stats["fts"] == "rebuilt":
+                    self.sqlite.vacuum()
+        if "organism" in changed:
+            self._update_lineages()
+        if deleted or inserted or "organism" in changed:
+            self.hot_clades.run()
+        self.fingerprints.record(fingerprints)
+        self.duckdb.con.execute("checkpoint")
+        stats["seconds"] = round(time.perf_counter() - start, 3)
+        logging.info(
+            f"Incremental build deleted {stats['deleted']} and inserted {stats['inserted']} species rows in {stats['seconds']}s"
+        )
+        return stats
+
+    def _update_species(self) -> Tuple[List[int], List[int]]:
+        """
+        Apply the difference between the species rows in the metadata and in the
+        previous build to species. Rows are matched by fingerprint, and by occurrence
+        for identical rows. Returns the species IDs deleted and inserted
+        """
+        con = self.duckdb.con
+        fingerprint = SourceFingerprints.species_fingerprint()
+        columns = ", ".join(SourceFingerprints.species_columns)
+        con.execute(
+            f"create or replace temp table species_source AS SELECT {columns} FROM species LIMIT 0"
+        )
+        con.execute(
+            f"insert into species_source {self.species.species_select(self.species.source_schema)}"
+        )
+        con.execute(
+            f"""
+    create or replace temp table species_delta AS
+    WITH Previous AS (
+        SELECT species_id, fingerprint, row_number() OVER (PARTITION BY fingerprint ORDER BY species_id) AS occurrence
+        FROM species_fingerprints
+    ),
+    Current AS (
+        SELECT *, {fingerprint} AS fingerprint, row_number() OVER (PARTITION BY {fingerprint}) AS occurrence
+        FROM species_source
+    )
+    SELECT p.species_id, c.* EXCLUDE (fingerprint, occurrence)
+    FROM Previous p
+    FULL OUTER JOIN Current c ON (c.fingerprint = p.fingerprint AND c.occurrence = p.occurrence)
+    WHERE p.species_id IS NULL OR c.fingerprint IS NULL
+"""
+        )
+        deleted = [
+            row[0]
+            for row in con.execute(
+                "select species_id from species_delta where species_id is not null order by 1"
+            ).fetchall()
+        ]
+        if deleted:
+            con.execute(
+                "delete from species where species_id in (select species_id from species_delta)"
+            )
+        inserted = con.execute(
+            f"""
+    insert into species
+    SELECT (SELECT coalesce(max(species_id), 0) FROM species) + row_number() OVER (ORDER BY {columns}), {columns}, 0
+    FROM species_delta
+    WHERE species_id IS NULL
+    RETURNING species_id
+"""
+        ).fetchall()
+        inserted = sorted(row[0] for row in inserted)
+        if inserted:
+            self.species.apply_boost()
+        con.execute("drop table species_source")
+        con.execute("drop table species_delta")
+        logging.info(
+            f"Deleted {len(deleted)} and inserted {len(inserted)} species rows"
+        )
+        return deleted, inserted
+
+    def _update_fts(self, deleted: List[int], inserted: List[int]) -> str:
+        """
+        Delete and insert the changed rows in the species FTS tables. Returns how
+        they were updated
+        """
+        sqlite_con = self.sqlite.con
+        trigram = self.species_trigram_fts and self.sqlite.has_table(
+            self.species_trigram_fts.fts_table
+        )
+        boosted = self.duckdb.con.execute(
+            "select count(*) from species where search_boost > 0 and species_id in (select unnest(?::INTEGER[]))",
+            [inserted],
+        ).fetchone()[0]
+        if boosted:
+            logging.info("Boosted rows were inserted. Rebuilding the species FTS")
+            sqlite_con.execute("DROP TABLE IF EXISTS species_trigram_fts")
+            sqlite_con.execute("DROP TABLE species_fts")
+            sqlite_con.commit()
+            self.species_fts.run()
+            if self.species_trigram_fts:
+                self.species_trigram_fts.run()
+            return "rebuilt"
+
+        rowids = (
+            [
+                row[0]
+                for row in sqlite_con.execute(
+                    f"SELECT rowid FROM species_fts WHERE species_id IN ({', '.join('?' * len(deleted))})",
+                    deleted,
+                ).fetchall()
+            ]
+            if deleted
+            else []
+        )
+        for table in (
+            ("species_trigram_fts", "species_fts") if trigram else ("species_fts",)
+        ):
+            sqlite_con.executemany(
+                f"DELETE FROM {table} WHERE rowid = ?", [(rowid,) for rowid in rowids]
+            )
+        # Committed before DuckDB writes to the file
+        sqlite_con.commit()
+        last_rowid = sqlite_con.execute(
+            "SELECT coalesce(max(rowid), 0) FROM species_fts"
+        ).fetchone()[0]
+        if inserted:
+            # The FTS population SQL reads species, so the new rows are copied into
+            # SQLite under that name
+            self.duckdb.con.execute(
+                "create or replace temp table species_inserted AS SELECT * FROM species WHERE species_id IN (SELECT unnest(?::INTEGER[]))",
+                [inserted],
+            )
+            CopyTable(
+                self.duckdb.con,
+                "temp",
+                self.sqlite.name,
+                "species_inserted",
+                "species",
+                index_columns=[],
+            ).run()
+            sqlite_con.execute(self.species_fts.fts_sql())
+            sqlite_con.execute("DROP TABLE species")
+            if trigram:
+                sqlite_con.execute(
+                    f"{self.species_trigram_fts.fts_sql()} WHERE rowid > ?",
+                    (last_rowid,),
+                )
+            self.duckdb.con.execute("drop table species_inserted")
+        sqlite_con.commit()
+        return "updated"
+
+    def _update_lineages(self):
+        """
+        Copy organism again and rebuild the lineage tables computed from it
+        """
+        logging.info("Rebuilding the organism lineages")
+        self.duckdb.drop_tables(
+            [
+                "organism",
+                "computed_hierarchy",
+                "taxonomy_ancestors",
+                "taxonomy_nested_set",
+            ]
+        )
+        self.taxonomy._copy_tables()
+        self.taxonomy._create_ncbi_hierarchy_lookup()
+        self.taxonomy._create_taxonomy_ancestors()
+        self.taxonomy._create_taxonomy_nested_set()
+        self.taxonomy._cleanup()
@@ -0,0 +1,253 @@
+from contextlib import contextmanager
+from typing import Callable, Optional, Tuple
+from .cache import lookups_version
+from .db import DuckDb, SQLiteDb
+from .hierarchy import TaxonomyHierarchy, TaxonomyTree
+from .hot_clades import HotClades
+import asyncio
+import logging
+import os
+import threading
+import time
+
+
+class Lookups:
+    """
+    One build of the lookups: the DuckDB and SQLite pair, their connection pools and
+    what the server loads from them into memory. Requests hold a reference to the build
+    while they use it so it is only closed once they have finished
+    """
+
+    def __init__(
+        self, version: str, duckdb_path: str, sqlite_path: str, config
+    ) -> None:
+        logging.info(f"Opening lookups {version} from {duckdb_path} and {sqlite_path}")
+        self.version = version
+        self.duckdb_path = duckdb_path
+        self.sqlite_path = sqlite_path
+        self.duckdb = DuckDb.create(duckdb_path, read_only=True)
+        self.sqlite = SQLiteDb.create(
+            sqlite_path,
+            sqlite_path,
+            check_same_thread=False,
+            cached_statements=config.server.sqlite_cached_statements,
+            read_only=config.lookups.sqlite_read_only,
+            mmap_size=config.lookups.sqlite_mmap_size,
+            cache_size=config.lookups.sqlite_cache_size,
+        )
+        self.duckdb_pool = self.duckdb.cursor_pool(config.server.duckdb_pool_size)
+        self.sqlite_pool = self.sqlite.connection_pool(config.server.sqlite_pool_size)
+        self.taxonomy_hierarchy = TaxonomyHierarchy.create(self.duckdb)
+        self.taxonomy_tree = TaxonomyTree.create(self.duckdb)
+        self.hot_clades, self.hot_intersects = HotClades.served(self.duckdb)
+        self.taxonomy_fts_available = self.sqlite.has_table("taxonomy_fts")
+        self.species_trigram_fts_available = self.sqlite.has_table(
+            "species_trigram_fts"
+        )
+        self.loaded_at = time.time()
+        self._users = 0
+        self._idle = threading.Condition()
+
+    def warm(
+        self, touch: bool = True, queries: Optional[Callable[["Lookups"], None]] = None
+    ) -> None:
+        """
+        Get the build ready to take traffic. Reads the SQLite file into the page cache
+        and every column of the DuckDB tables requests use into its buffers (touch), runs
+        representative requests (queries) and opens every pooled connection
+        """
+        logging.info(f"Warming lookups {self.version}")
+        start = time.perf_counter()
+        if touch:
+            with open(self.sqlite_path, "rb") as fh:
+                while fh.read(1048576):
+                    pass
+            with self.duckdb_pool.connection() as cursor:
+                cursor.execute(
+                    "select table_name from duckdb_tables() where table_name in ('species', 'computed_hierarchy', 'taxonomy_nested_set', 'taxonomy_ancestors', 'taxonomy_tree', 'hot_clade_results', 'hot_intersect_results')"
+                )
+                for (table,) in cursor.fetchall():
+                    cursor.execute(f"select max(columns(*)) from {table}").fetchall()
+        if queries:
+            queries(self)
+        self.duckdb_pool.fill()
+        self.sqlite_pool.fill()
+        logging.info(
+            f"Warmed lookups {self.version} in {time.perf_counter() - start:.2f}s"
+        )
+
+    def enter(self) -> None:
+        with self._idle:
+            self._users += 1
+
+    def exit(self) -> None:
+        with self._idle:
+            self._users -= 1
+            if self._users == 0:
+                self._idle.notify_all()
+
+    def close(self, drain_timeout: float = 0) -> None:
+        """
+        Wait up to drain_timeout seconds for requests using the build to finish and
+        close it
+        """
+        with self._idle:
+            if not self._idle.wait_for(lambda: self._users == 0, drain_timeout):
+                logging.warning(
+                    f"Closing lookups {self.version} with {self._users} requests still using them"
+                )
+        logging.info(f"Closing lookups {self.version}")
+        self.duckdb_pool.close()
+        self.sqlite_pool.close()
+        self.sqlite.con.close()
+        self.duckdb.con.close()
+
+
+class LookupsUnavailable(RuntimeError):
+    """
+    Raised when a request arrives before the first build of the lookups is ready
+    """
+
+
+class LookupManager:
+    """
+    Serves requests from the active build of the lookups and swaps in new builds
+    without downtime. With lookups.directory set each build is a subdirectory holding
+    the DuckDB and SQLite files named by lookups.duckdb_search and lookups.sqlite_fts,
+    and the subdirectory sorting last is the one served. Publish a build by copying it
+    into a subdirectory starting with . (which are ignored) and renaming it into place.
+    A new build is opened and warmed in the background, new requests are switched to
+    it and the previous build is closed once its requests have drained. Without
+    lookups.directory the files are served as configured and cannot be swapped, as
+    DuckDB shares one instance per open file path. No build is opened until start()
+    """
+
+    def __init__(
+        self,
+        config,
+        on_switch: Optional[Callable[[Lookups], None]] = None,
+        warm_up: Optional[Callable[[Lookups], None]] = None,
+    ):
+        self.config = config
+        self.on_switch = on_switch
+        self.warm_up = warm_up
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self.current: Optional[Lookups] = None
+
+    def start(self) -> None:
+        """
+        Open and warm the latest build. Requests are refused until it is ready
+        """
+        with self._reload_lock:
+            self._switch(self._open(*self.locate()))
+
+    @property
+    def ready(self) -> bool:
+        return self.current is not None
+
+    @property
+    def versioned(self) -> bool:
+        return self.config.lookups.directory is not None
+
+    def locate(self, version: Optional[str] = None) -> Tuple[str, str, str]:
+        """
+        Version and file paths of the build to serve. Defaults to the latest build
+        """
+        lookups = self.config.lookups
+        if not self.versioned:
+            return (
+                lookups_version(lookups.duckdb_search, lookups.sqlite_fts),
+                lookups.duckdb_search,
+                lookups.sqlite_fts,
+            )
+        duckdb_name = os.path.basename(lookups.duckdb_search)
+        sqlite_name = os.path.basename(lookups.sqlite_fts)
+        versions = sorted(
+            entry
+            for entry in os.listdir(lookups.directory)
+            if not entry.startswith(".")
+            and os.path.isfile(os.path.join(lookups.directory, entry, duckdb_name))
+            and os.path.isfile(os.path.join(lookups.directory, entry, sqlite_name))
+        )
+        if version is None:
+            if not versions:
+                raise FileNotFoundError(f"No lookups found in {lookups.directory}")
+            version = versions[-1]
+        elif version not in versions:
+            raise FileNotFoundError(
+                f"Lookups {version} not found in {lookups.directory}"
+            )
+        path = os.path.join(lookups.directory, version)
+        return (
+            version,
+            os.path.join(path, duckdb_name),
+            os.path.join(path, sqlite_name),
+        )
+
+    def _open(self, version: str, duckdb_path: str, sqlite_path: str) -> Lookups:
+        lookups = Lookups(version, duckdb_path, sqlite_path, self.config)
+        try:
+            if self.config.lookups.warm_up:
+                lookups.warm(queries=self.warm_up)
+            else:
+                lookups.warm(touch=False)
+        except Exception:
+            lookups.close()
+            raise
+        return lookups
+
+    def _switch(self, lookups: Lookups) -> None:
+        with self._lock:
+            previous, self.current = self.current, lookups
+        if self.on_switch:
+            self.on_switch(lookups)
+        if previous:
+            logging.info(
+                f"Switched from lookups {previous.version} to {lookups.version}"
+            )
+            previous.close(self.config.lookups.drain_timeout)
+
+    @contextmanager
+    def acquire(self):
+        """
+        Use the active build for the duration of a request
+        """
+        with self._lock:
+            lookups = self.current
+            if lookups is None:
+                raise LookupsUnavailable("Lookups are still loading")
+            lookups.enter()
+        try:
+            yield lookups
+        finally:
+            lookups.exit()
+
+    def reload(self, version: Optional[str] = None) -> bool:
+        """
+        Switch to the given or latest build if it is not the one being served. Blocks
+        until the new build is warm and the previous one has been closed
+        """
+        if not self.versioned:
+            raise ValueError("Lookups can only be reloaded from lookups.directory")
+        with self._reload_lock:
+            location = self.locate(version)
+            if self.current and location[0] == self.current.version:
+                return False
+            self._switch(self._open(*location))
+            return True
+
+    async def watch(self, interval: float) -> None:
+        """
+        Poll lookups.directory for new builds, switching to them as they appear
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.reload)
+            except Exception:
+                logging.exception("Failed to reload lookups")
+
+    def close(self) -> None:
+        if self.current:
+            self.current.close()
@@ -0,0 +1,284 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+import threading
+import time
+
+# Latency buckets in seconds, from sub-millisecond cache hits to slow OLS calls
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+def _labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Histogram:
+    """
+    Prometheus histogram with a fixed set of label names. Observing takes a lock
+    and a bisect so it is cheap enough to do several times per request
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Per label values: counts per bucket (the last being +Inf) and the sum
+        self._series: Dict[Tuple, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = (
+                    [0] * (len(self.buckets) + 1),
+                    [0.0],
+                )
+            series[0][index] += 1
+            series[1][0] += value
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = [
+                (values, list(counts), total[0])
+                for values, (counts, total) in sorted(self._series.items())
+            ]
+        names = self.labels + ("le",)
+        for values, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _labels(names, values + (bound,))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _labels(self.labels, values)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Counter:
+    """
+    Prometheus counter with a fixed set of label names
+    """
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield f"{self.name}{_labels(self.labels, label_values)} {value}"
+
+
+class Collected:
+    """
+    Counters or gauges read from elsewhere (e.g. cache or pool stats) when scraped.
+    collect returns the label values and value of each series
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        type: str,
+        collect: Callable[[], Iterable[Tuple[Tuple, float]]],
+        labels: Sequence[str] = (),
+    ):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.collect = collect
+        self.labels = tuple(labels)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        for label_values, value in self.collect():
+            yield f"{self.name}{_labels(self.labels, label_values)} {value}"
+
+
+class RequestMetrics:
+    """
+    Time spent in each stage of a request and the rows it returned
+    """
+
+    __slots__ = ("stages", "rows")
+
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+        self.rows: Optional[int] = None
+
+
+_request: ContextVar[Optional[RequestMetrics]] = ContextVar(
+    "request_metrics", default=None
+)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Add the time spent in the block to the named stage of the current request. Does
+    nothing outside of a request
+    """
+    request = _request.get()
+    if request is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        request.stages[name] = (
+            request.stages.get(name, 0.0) + time.perf_counter() - start
+        )
+
+
+def record_rows(rows: int) -> None:
+    """
+    Add to the rows returned by the current request
+    """
+    request = _request.get()
+    if request is not None:
+        request.rows = (request.rows or 0) + rows
+
+
+class Metrics:
+    """
+    Registry of the server's metrics, rendered in the Prometheus text format
+    """
+
+    def __init__(self, prefix: str = "species_search"):
+        self.prefix = prefix
+        self.requests = Counter(
+            f"{prefix}_requests_total",
+            "Requests by endpoint and response status",
+            ("endpoint", "status"),
+        )
+        self.request_seconds = Histogram(
+            f"{prefix}_request_duration_seconds",
+            "Time to respond to a request, including streaming the response",
+            ("endpoint",),
+        )
+        self.stage_seconds = Histogram(
+            f"{prefix}_request_stage_duration_seconds",
+            "Time spent by a request in each stage: hierarchy (local or OLS), query (executing), fetch (reading rows) and serialize (building the response)",
+            ("endpoint", "stage"),
+        )
+        self.rows = Histogram(
+            f"{prefix}_response_rows",
+            "Rows returned by the queries of a request",
+            ("endpoint",),
+            buckets=ROW_BUCKETS,
+        )
+        self.collected: List[Collected] = []
+
+    def collect(
+        self,
+        name: str,
+        help: str,
+        type: str,
+        collect: Callable[[], Iterable[Tuple[Tuple, float]]],
+        labels: Sequence[str] = (),
+    ) -> None:
+        self.collected.append(
+            Collected(f"{self.prefix}_{name}", help, type, collect, labels)
+        )
+
+    def observe(self, endpoint: str, status: int, seconds: float, request) -> None:
+        self.requests.inc(endpoint, status)
+        self.request_seconds.observe(seconds, endpoint)
+        for name, stage_seconds in request.stages.items():
+            self.stage_seconds.observe(stage_seconds, endpoint, name)
+        if request.rows is not None:
+            self.rows.observe(request.rows, endpoint)
+
+    def render(self) -> str:
+        lines = []
+        for metric in (
+            self.requests,
+            self.request_seconds,
+            self.stage_seconds,
+            self.rows,
+            *self.collected,
+        ):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing each HTTP request and its stages. Requests are labelled
+    by the path template of the route they matched (e.g. /species/taxonomy/{taxonomy_id})
+    so the number of series stays bounded
+    """
+
+    def __init__(self, app, metrics: Metrics, exclude: Sequence[str] = ("/metrics",)):
+        self.app = app
+        self.metrics = metrics
+        self.exclude = set(exclude)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exclude:
+            await self.app(scope, receive, send)
+            return
+        request = RequestMetrics()
+        token = _request.set(request)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            _request.reset(token)
+            route = scope.get("route")
+            endpoint = getattr(route, "path", None) or "unmatched"
+            self.metrics.observe(endpoint, status, time.perf_counter() - start, request)
@@ -0,0 +1,35 @@
+from typing import Any, List
+import base64
+import binascii
+import orjson
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(endpoint: str, *values: Any) -> str:
+    """
+    Encode the sort key of the last row returned into an opaque token. The next page
+    starts strictly after this key (keyset pagination) rather than rescanning with OFFSET
+    """
+    token = orjson.dumps([endpoint, *values])
+    return base64.urlsafe_b64encode(token).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token: str, endpoint: str, length: int) -> List[Any]:
+    """
+    Decode a token made by encode_cursor for the same endpoint back into its sort key
+    """
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        values = orjson.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, binascii.Error, UnicodeEncodeError):
+        raise InvalidCursor(f"Cannot decode cursor {token}")
+    if (
+        not isinstance(values, list)
+        or len(values) != length + 1
+        or values[0] != endpoint
+    ):
+        raise InvalidCursor(f"Cursor {token} was not issued by {endpoint}")
+    return values[1:]
@@ -0,0 +1,506 @@
+from typing import Any, Callable, Dict, List, Optional, Sequence
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from .db import CopyTable, CreateIndex, CreateSQLiteFTS, DuckDb, SQLiteDb
+from .hot_clades import HotClades
+from .incremental import SourceFingerprints
+from .species import Species, SpeciesFts, SpeciesTrigramFts
+from .taxonomy import Taxonomy, TaxonomySQLiteFts
+from . import queries
+import hashlib
+import inspect
+import logging
+import time
+
+
+class Stage:
+    """
+    A step of building the lookups. run is called with a DuckDb on its own cursor and
+    a SQLiteDb on its own connection. tables are the DuckDB tables and fts_tables the
+    SQLite tables the stage creates. fingerprint returns anything which, along with
+    the fingerprints of the stages depended on, identifies the stage's outputs. code
+    are the classes, functions or modules which build the outputs. Their source is part
+    of the stage's key so a change to how the outputs are built reruns the stage
+    """
+
+    def __init__(
+        self,
+        name: str,
+        run: Callable[[DuckDb, SQLiteDb], Any],
+        depends_on: Sequence[str] = (),
+        tables: Sequence[str] = (),
+        fts_tables: Sequence[str] = (),
+        fingerprint: Optional[Callable[[DuckDb], Any]] = None,
+        code: Sequence[Any] = (),
+    ):
+        self.name = name
+        self.run = run
+        self.depends_on = list(depends_on)
+        self.tables = list(tables)
+        self.fts_tables = list(fts_tables)
+        self.fingerprint = fingerprint
+        self.code = list(code)
+
+    def code_fingerprint(self) -> str:
+        digest = hashlib.sha256()
+        for code in self.code:
+            digest.update(inspect.getsource(code).encode())
+        return digest.hexdigest()
+
+    @property
+    def outputs(self) -> bool:
+        return bool(self.tables or self.fts_tables)
+
+
+class Pipeline:
+    """
+    Run stages once the stages they depend on are done, running up to workers of them
+    concurrently. Stages run on threads each with their own DuckDB cursor, so they share
+    the database being built. SQLite allows one writer so stages writing to it run one
+    at a time.
+
+    Each stage with outputs is keyed by its fingerprint and the keys of the stages it
+    depends on, recorded in build_stages in DuckDB and SQLite. A stage whose key matches
+    that recorded by the previous build is not run: its DuckDB tables are copied from
+    the previous build, attached as the catalog previous, and its SQLite tables are left
+    in place. The previous build is detached once no stage left to run needs it.
+
+    Servers open the SQLite file immutable, so it is never changed in place. The stages
+    write to a new file, a copy of the previous one when reusing the previous build,
+    which replaces it once every stage is done and the file vacuumed. The file is
+    marked as being built until then, and if the previous build left the mark every
+    stage is run
+    """
+
+    def __init__(
+        self,
+        duckdb: DuckDb,
+        sqlite: SQLiteDb,
+        stages: Sequence[Stage],
+        workers: int = 1,
+        previous: Optional[str] = None,
+    ):
+        self.duckdb = duckdb
+        self.sqlite = sqlite
+        self.stages = list(stages)
+        self.workers = workers
+        self.previous = previous
+        self.keys = {}
+        self.plan = {}
+        self.timings = []
+        self._check()
+
+    def _check(self):
+        """
+        Stage names must be unique, dependencies known and the stages free of cycles
+        """
+        names = [stage.name for stage in self.stages]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Stage names must be unique: {names}")
+        stages = {stage.name: stage for stage in self.stages}
+        for stage in self.stages:
+            unknown = set(stage.depends_on) - set(stages)
+            if unknown:
+                raise ValueError(
+                    f"Stage {stage.name} depends on unknown stages {sorted(unknown)}"
+                )
+        ordered, visiting = [], set()
+
+        def visit(name, path):
+            if name in ordered:
+                return
+            if name in visiting:
+                raise ValueError(f"Stages depend on each other: {' -> '.join(path)}")
+            visiting.add(name)
+            for dependency in stages[name].depends_on:
+                visit(dependency, path + [dependency])
+            visiting.discard(name)
+            ordered.append(name)
+
+        for name in names:
+            visit(name, [name])
+        self._order = [stages[name] for name in ordered]
+
+    def run(self) -> List[dict]:
+        """
+        Run the stages and return the timing of each
+        """
+        start = time.perf_counter()
+        reuse = True
+        if self.sqlite.interrupted():
+            logging.warning(
+                f"The previous build of {self.sqlite.path} did not finish. Running every stage"
+            )
+            reuse = False
+        with self.sqlite.building():
+            with self.sqlite.replacing(copy=reuse and self.previous is not None):
+                self._plan(reuse)
+                self._run_stages(start)
+                self.sqlite.vacuum()
+        self.report(time.perf_counter() - start)
+        return self.timings
+
+    def _run_stages(self, start: float):
+        done, running, pending = set(), {}, list(self.stages)
+        error = None
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="stage"
+        ) as executor:
+            while pending or running:
+                for stage in self._ready(pending, done, running.values()):
+                    pending.remove(stage)
+                    future = executor.submit(self._run_stage, stage, start)
+                    running[future] = stage
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    try:
+                        self.timings.append(future.result())
+                    except Exception as e:
+                        logging.error(f"Stage {stage.name} failed: {e}")
+                        # Let running stages finish but start no more
+                        error = error or e
+                        pending.clear()
+                        continue
+                    done.add(stage.name)
+                    if stage.outputs:
+                        self.duckdb.con.execute(
+                            "insert into build_stages values (?, ?)",
+                            [stage.name, self.keys[stage.name]],
+                        )
+                if self.previous and not any(
+                    self.plan[s.name] == "copied"
+                    for s in pending + list(running.values())
+                ):
+                    self.duckdb.detach(self.previous)
+                    self.previous = None
+        if error:
+            raise error
+
+    def _plan(self, reuse: bool = True):
+        """
+        Key every stage and decide whether it is run, has its tables copied from the
+        previous build or is skipped as its SQLite tables are up to date. Nothing is
+        reused unless reuse is set
+        """
+        previous_keys = {}
+        if self.previous and reuse:
+            found = self.duckdb.con.execute(
+                "select count(*) from duckdb_tables() where database_name = ? and table_name = 'build_stages'",
+                [self.previous],
+            ).fetchone()[0]
+            if found:
+                previous_keys = dict(
+                    self.duckdb.con.execute(
+                        f"select stage, key from {self.previous}.build_stages"
+                    ).fetchall()
+                )
+        self.duckdb.con.execute(
+            "create or replace table build_stages (stage VARCHAR, key VARCHAR)"
+        )
+        fts_keys = self._sqlite_stages()
+
+        for stage in self._order:
+            fingerprint = stage.fingerprint(self.duckdb) if stage.fingerprint else None
+            parents = [self.keys[name] for name in stage.depends_on]
+            self.keys[stage.name] = hashlib.sha256(
+                repr(
+                    (stage.name, fingerprint, stage.code_fingerprint(), parents)
+                ).encode()
+            ).hexdigest()
+            key = self.keys[stage.name]
+            up_to_date = stage.outputs
+            if stage.tables:
+                up_to_date = up_to_date and previous_keys.get(stage.name) == key
+            if stage.fts_tables:
+                up_to_date = (
+                    up_to_date
+                    and fts_keys.get(stage.name) == key
+                    and all(self.sqlite.has_table(t) for t in stage.fts_tables)
+                )
+            if not up_to_date:
+                self.plan[stage.name] = "ran"
+            elif stage.tables:
+                self.plan[stage.name] = "copied"
+            else:
+                self.plan[stage.name] = "skipped"
+        logging.info(
+            "Build plan: "
+            + ", ".join(
+                f"{stage.name} {self.plan[stage.name]}" for stage in self._order
+            )
+        )
+
+    def _sqlite_stages(self) -> Dict[str, str]:
+        """
+        Keys of the stages recorded in SQLite. Tables of recorded stages no longer
+        in the pipeline are dropped
+        """
+        con = self.sqlite.con
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS build_stages (stage TEXT PRIMARY KEY, key TEXT, tables TEXT)"
+        )
+        names = {stage.name for stage in self.stages if stage.fts_tables}
+        keys = {}
+        for name, key, tables in con.execute(
+            "SELECT stage, key, tables FROM build_stages"
+        ).fetchall():
+            if name in names:
+                keys[name] = key
+                continue
+            logging.info(f"Dropping the tables of stage {name}")
+            for table in tables.split(","):
+                con.execute(f"DROP TABLE IF EXISTS {table}")
+            con.execute("DELETE FROM build_stages WHERE stage = ?", (name,))
+        con.commit()
+        return keys
+
+    def _ready(self, pending, done, running) -> List[Stage]:
+        """
+        Pending stages whose dependencies are done, up to the number of free workers.
+        Only one stage writing to SQLite runs at a time
+        """
+        writing = any(self._writes_sqlite(stage) for stage in running)
+        ready = []
+        for stage in pending:
+            if len(ready) + len(running) >= self.workers:
+                break
+            if not set(stage.depends_on) <= done:
+                continue
+            if self._writes_sqlite(stage):
+                if writing:
+                    continue
+                writing = True
+            ready.append(stage)
+        return ready
+
+    def _writes_sqlite(self, stage: Stage) -> bool:
+        return bool(stage.fts_tables) and self.plan[stage.name] == "ran"
+
+    def _run_stage(self, stage: Stage, pipeline_start: float) -> dict:
+        start = time.perf_counter()
+        status = self.plan[stage.name]
+        duckdb = DuckDb(self.duckdb.con.cursor(), self.duckdb.name)
+        sqlite = SQLiteDb(self.sqlite.name, self.sqlite.path)
+        try:
+            if status == "copied":
+                logging.info(f"Stage {stage.name} is up to date. Copying its tables")
+                self._copy_tables(duckdb, stage)
+            elif status == "skipped":
+                logging.info(f"Stage {stage.name} is up to date. Skipping")
+            else:
+                logging.info(f"Running stage {stage.name}")
+                self._drop_outputs(duckdb, sqlite, stage)
+                stage.run(duckdb, sqlite)
+                if stage.fts_tables:
+                    sqlite.con.execute(
+                        "INSERT INTO build_stages VALUES (?, ?, ?)",
+                        (stage.name, self.keys[stage.name], ",".join(stage.fts_tables)),
+                    )
+                    sqlite.con.commit()
+        finally:
+            sqlite.close()
+            duckdb.con.close()
+        seconds = time.perf_counter() - start
+        logging.info(f"Stage {stage.name} {status} in {seconds:.2f}s")
+        return {
+            "stage": stage.name,
+            "status": status,
+            "start": round(start - pipeline_start, 3),
+            "seconds": round(seconds, 3),
+        }
+
+    def _copy_tables(self, duckdb: DuckDb, stage: Stage):
+        """
+        Copy the stage's tables and their indexes from the previous build
+        """
+        con = duckdb.con
+        for table in stage.tables:
+            con.execute(
+                f"create table {table} AS SELECT * FROM {self.previous}.{table}"
+            )
+            indexes = con.execute(
+                "select sql from duckdb_indexes() where database_name = ? and table_name = ?",
+                [self.previous, table],
+            ).fetchall()
+            for (sql,) in indexes:
+                con.execute(sql)
+
+    def _drop_outputs(self, duckdb: DuckDb, sqlite: SQLiteDb, stage: Stage):
+        """
+        Drop tables left by an earlier run of the stage. The stage's SQLite key is
+        removed first so its tables are not taken as up to date if it fails
+        """
+        for table in stage.tables:
+            duckdb.con.execute(f"drop table if exists {table}")
+        if stage.fts_tables:
+            sqlite.con.execute(
+                "DELETE FROM build_stages WHERE stage = ?", (stage.name,)
+            )
+            for table in stage.fts_tables:
+                sqlite.con.execute(f"DROP TABLE IF EXISTS {table}")
+            sqlite.con.commit()
+
+    def report(self, seconds: float):
+        """
+        Log the status, start and duration of each stage
+        """
+        lines = [f"{'stage':<24}{'status':<10}{'start':>10}{'seconds':>10}"]
+        for timing in sorted(self.timings, key=lambda t: t["start"]):
+            lines.append(
+                f"{timing['stage']:<24}{timing['status']:<10}{timing['start']:>10.2f}{timing['seconds']:>10.2f}"
+            )
+        busy = sum(timing["seconds"] for timing in self.timings)
+        lines.append(
+            f"Built in {seconds:.2f}s with {self.workers} workers. Stages took {busy:.2f}s in total"
+        )
+        logging.info("Build stages\n" + "\n".join(lines))
+
+
+def lookup_stages(
+    source_schema: str = "mysqldb",
+    taxonomy_source: str = "taxonomy",
+    species_fts_prefix: Sequence[int] = (2, 3, 4),
+    species_fts_unindexed: Sequence[str] = SpeciesFts._default_unindexed,
+    species_fts_weights: Dict[str, float] = SpeciesFts._default_weights,
+    build_species_trigram_fts: bool = True,
+    build_taxonomy_fts: bool = False,
+    build_taxonomy_tree: bool = True,
+    hot_taxa: Sequence[int] = (),
+    hot_taxa_top: int = 0,
+    hot_intersect_levels: Sequence[str] = ("order",),
+    fts_bulk_load: bool = False,
+) -> List[Stage]:
+    """
+    Stages of a full build of the lookups. The species FTS is built while the taxonomy
+    is computed and the hot clades once both species and taxonomy are done
+    """
+    species = Stage(
+        "species",
+        lambda duckdb, sqlite: Species(
+            duckdb=duckdb, source_schema=source_schema
+        ).run(),
+        tables=["species"],
+        code=[Species, CreateIndex],
+        fingerprint=lambda duckdb: (
+            SourceFingerprints(duckdb, source_schema).compute(),
+            Species._default_boost,
+        ),
+    )
+    species_fts = Stage(
+        "species_fts",
+        lambda duckdb, sqlite: SpeciesFts(
+            duckdb=duckdb,
+            sqlite=sqlite,
+            indexed_table="species",
+            prefix_lengths=species_fts_prefix,
+            bulk_load=fts_bulk_load,
+            unindexed_columns=species_fts_unindexed,
+            column_weights=species_fts_weights,
+        ).run(),
+        depends_on=["species"],
+        fts_tables=["species_fts"],
+        code=[SpeciesFts, CreateSQLiteFTS, CopyTable],
+        fingerprint=lambda duckdb: (
+            list(species_fts_prefix),
+            sorted(species_fts_unindexed),
+            sorted(species_fts_weights.items()),
+        ),
+    )
+    stages = [species, species_fts]
+    if build_species_trigram_fts:
+        stages.append(
+            Stage(
+                "species_trigram_fts",
+                lambda duckdb, sqlite: SpeciesTrigramFts(
+                    duckdb=duckdb, sqlite=sqlite, bulk_load=fts_bulk_load
+                ).run(),
+                depends_on=["species_fts"],
+                fts_tables=["species_trigram_fts"],
+                code=[SpeciesTrigramFts, CreateSQLiteFTS],
+            )
+        )
+    else:
+        logging.info("Skipping building the species trigram FTS")
+
+    taxonomy_tables = [
+        "organism",
+        "computed_hierarchy",
+        "taxonomy_ancestors",
+        "taxonomy_nested_set",
+    ]
+    if build_taxonomy_fts:
+        taxonomy_tables.append("taxonomy_names")
+    if build_taxonomy_tree:
+        taxonomy_tables.extend(["taxonomy_tree", "taxonomy_parents"])
+    stages.append(
+        Stage(
+            "taxonomy",
+            lambda duckdb, sqlite: Taxonomy(
+                duckdb=duckdb,
+                taxonomy_source=taxonomy_source,
+                source_schema=source_schema,
+                build_taxonomy_fts=build_taxonomy_fts,
+                build_taxonomy_tree=build_taxonomy_tree,
+            ).run(),
+            tables=taxonomy_tables,
+            code=[Taxonomy, CopyTable, CreateIndex],
+            fingerprint=lambda duckdb: [
+                SourceFingerprints.table_fingerprint(duckdb, table)
+                for table in (
+                    f"{taxonomy_source}.ncbi_taxa_node",
+                    f"{taxonomy_source}.ncbi_taxa_name",
+                    f"{source_schema}.organism",
+                )
+            ]
+            + [build_taxonomy_fts, build_taxonomy_tree],
+        )
+    )
+    if build_taxonomy_fts:
+        stages.append(
+            Stage(
+                "taxonomy_fts",
+                lambda duckdb, sqlite: TaxonomySQLiteFts(
+                    duckdb=duckdb,
+                    sqlite=sqlite,
+                    indexed_table="taxonomy_names",
+                    bulk_load=fts_bulk_load,
+                ).run(),
+                depends_on=["taxonomy"],
+                fts_tables=["taxonomy_fts"],
+                code=[TaxonomySQLiteFts, CreateSQLiteFTS, CopyTable],
+            )
+        )
+    else:
+        logging.info("Skipping building the Taxonomy FTS")
+
+    stages.append(
+        Stage(
+            "hot_clades",
+            lambda duckdb, sqlite: HotClades(
+                duckdb=duckdb,
+                hot_taxa=hot_taxa,
+                top=hot_taxa_top,
+                intersect_levels=hot_intersect_levels,
+            ).run(),
+            depends_on=["species", "taxonomy"],
+            tables=["hot_clade_results", "hot_intersect_results"],
+            code=[HotClades, queries],
+            fingerprint=lambda duckdb: (
+                list(hot_taxa),
+                hot_taxa_top,
+                list(hot_intersect_levels),
+            ),
+        )
+    )
+    stages.append(
+        Stage(
+            "fingerprints",
+            lambda duckdb, sqlite: SourceFingerprints(
+                duckdb=duckdb, source_schema=source_schema
+            ).record(),
+            depends_on=["species"],
+            tables=["build_fingerprints", "species_fingerprints"],
+            code=[SourceFingerprints],
+        )
+    )
+    return stages
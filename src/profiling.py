@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from typing import Any, List, Optional, Sequence
+import logging
+import sqlite3
+import orjson
+
+# Profiles of the queries run by a request that asked to be profiled
+_profile: ContextVar[Optional[List[dict]]] = ContextVar("query_profile", default=None)
+_slow_query_log: Optional["SlowQueryLog"] = None
+
+
+@contextmanager
+def profiling(enabled: bool = True):
+    """
+    Collect a profile of each query run within the block, including those run on
+    the executor's threads. Yields None when not enabled
+    """
+    if not enabled:
+        yield None
+        return
+    queries = []
+    token = _profile.set(queries)
+    try:
+        yield queries
+    finally:
+        _profile.reset(token)
+
+
+class SlowQueryLog:
+    """
+    Writes queries slower than the threshold to a rotating file as JSON lines holding
+    the SQL, its parameters, the elapsed time and the query plan
+    """
+
+    def __init__(
+        self, path: str, threshold_ms: int, max_bytes: int, backups: int
+    ) -> None:
+        self.threshold = threshold_ms / 1000
+        self.logger = logging.getLogger("species_search.slow_queries")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.handler = RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backups
+        )
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+        self.logger.addHandler(self.handler)
+
+    def close(self) -> None:
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+
+    def write(self, cursor, query: str, params: Sequence[Any], seconds: float) -> None:
+        entry = {
+            "sql": " ".join(query.split()),
+            "params": params,
+            "ms": round(seconds * 1000, 3),
+            "plan": query_plan(cursor, query, params),
+        }
+        self.logger.info(orjson.dumps(entry, default=str).decode())
+
+
+def configure_slow_query_log(
+    path: str, threshold_ms: int, max_bytes: int, backups: int
+) -> None:
+    """
+    Log queries taking at least threshold_ms to path. A threshold of 0 disables the log
+    """
+    global _slow_query_log
+    if _slow_query_log:
+        _slow_query_log.close()
+    _slow_query_log = None
+    if threshold_ms > 0:
+        _slow_query_log = SlowQueryLog(path, threshold_ms, max_bytes, backups)
+
+
+def query_plan(cursor, query: str, params: Sequence[Any], analyze=False) -> str:
+    """
+    Plan of a query from DuckDB's EXPLAIN (or EXPLAIN ANALYZE, which runs the query
+    again) or SQLite's EXPLAIN QUERY PLAN
+    """
+    if isinstance(cursor, sqlite3.Cursor):
+        rows = cursor.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+        return "\n".join(row[3] for row in rows)
+    explain = "EXPLAIN ANALYZE" if analyze else "EXPLAIN"
+    rows = cursor.execute(f"{explain} {query}", params).fetchall()
+    return "\n".join(row[1] for row in rows)
+
+
+def profile_query(cursor, query: str, params: Sequence[Any], seconds: float) -> None:
+    """
+    Record a query run by the current request in its profile, if profiled, and in
+    the slow query log, if slow. The query's results must have been fetched already
+    """
+    profile = _profile.get()
+    if profile is not None:
+        profile.append(
+            {
+                "sql": " ".join(query.split()),
+                "params": params,
+                "ms": round(seconds * 1000, 3),
+                "plan": query_plan(cursor, query, params, analyze=True),
+            }
+        )
+    if _slow_query_log and seconds >= _slow_query_log.threshold:
+        try:
+            _slow_query_log.write(cursor, query, params, seconds)
+        except Exception:
+            logging.exception("Failed to write to the slow query log")
@@ -0,0 +1,125 @@
+from typing import List, Optional, Sequence, Tuple
+
+# Queries shared by the server and by the build of the hot clade tables. Columns
+# starting with _ are used to order and page through results and are not reported
+
+# Sort key of the genomes found under a taxon
+INTERSECTING_ITEMS_KEYSET = ("_left_index", "_species_id")
+
+
+def intersecting_items_query(
+    cursor, taxonomy_id: int, limit, after: Optional[Sequence] = None
+) -> Optional[Tuple[str, list]]:
+    """
+    Build the query for the genomes within a taxon's interval of the nested set
+    or None if the taxon is not in the lookups
+    """
+    cursor.execute(
+        "SELECT left_index, right_index, depth FROM taxonomy_nested_set WHERE taxon_id = ?",
+        (taxonomy_id,),
+    )
+    interval = cursor.fetchone()
+    if interval is None:
+        return None
+    left_index, right_index, depth = interval
+    query = """
+      SELECT s.name, s.accession, s.scientific_name, s.assembly_default, s.tol_id, s.common_name, s.biosample_id, s.strain, s.taxonomy_id, s.species_taxonomy_id, s.is_current, s.release_label, s.release_type, s.genome_uuid, ch.depth - ? as taxonomy_step, ch.left_index AS _left_index, s.species_id AS _species_id
+from computed_hierarchy ch
+join species s on s.taxonomy_id = ch.organism_taxonomy_id
+where ch.left_index between ? and ?
+"""
+    params = [depth, left_index, right_index]
+    if after:
+        after_left_index, after_species_id = after
+        query = f"""{query}and (ch.left_index > ? or (ch.left_index = ? and s.species_id > ?))
+"""
+        params.extend([after_left_index, after_left_index, after_species_id])
+    query = f"{query}order by ch.left_index, s.species_id\n"
+    if limit:
+        query = f"{query}limit ?\n"
+        params.append(limit)
+    return query, params
+
+
+def hot_intersecting_items_query(
+    taxonomy_id: int, limit, after: Optional[Sequence] = None
+) -> Tuple[str, list]:
+    """
+    Build the query for the genomes under a taxon from its precomputed results in
+    hot_clade_results. Gives the same results as intersecting_items_query
+    """
+    query = """
+      SELECT * EXCLUDE (hot_taxonomy_id)
+from hot_clade_results
+where hot_taxonomy_id = ?
+"""
+    params = [taxonomy_id]
+    if after:
+        after_left_index, after_species_id = after
+        query = f"""{query}and (_left_index > ? or (_left_index = ? and _species_id > ?))
+"""
+        params.extend([after_left_index, after_left_index, after_species_id])
+    query = f"{query}order by _left_index, _species_id\n"
+    if limit:
+        query = f"{query}limit ?\n"
+        params.append(limit)
+    return query, params
+
+
+def nearest_items_query(
+    ancestors: List[dict], integrated_only: bool, limit
+) -> Tuple[str, list]:
+    """
+    Build the query finding the genomes intersecting any of the given ancestors. A genome
+    is reported once against the nearest ancestor it intersects and results are ordered by
+    their total distance from the queried taxon
+    """
+    query = """
+    WITH ancestors AS (
+        SELECT unnest(?::BIGINT[]) AS taxon_id, unnest(?::BIGINT[]) AS distance
+    ),
+    lineage AS (
+        SELECT organism_taxonomy_id, organism_taxonomy_id AS taxon_id, 0 AS taxonomy_step
+        FROM computed_hierarchy
+        UNION ALL
+        SELECT organism_taxonomy_id, unnest(ancestor_taxon_ids) AS taxon_id, generate_subscripts(ancestor_taxon_ids, 1) AS taxonomy_step
+        FROM computed_hierarchy
+    ),
+    hits AS (
+        SELECT a.taxon_id AS intersecting_taxon_id, a.distance AS intersecting_distance, l.taxonomy_step, s.*
+        FROM ancestors a
+        JOIN lineage l ON l.taxon_id = a.taxon_id
+        JOIN species s ON s.taxonomy_id = l.organism_taxonomy_id
+        WHERE NOT ? OR s.release_type = 'integrated'
+        QUALIFY row_number() OVER (PARTITION BY s.genome_uuid ORDER BY a.distance, s.species_id) = 1
+    )
+    SELECT taxonomy_step + intersecting_distance AS total_distance, name, accession, scientific_name, assembly_default, tol_id, common_name, biosample_id, strain, taxonomy_id, species_taxonomy_id, is_current, release_label, release_type, genome_uuid, taxonomy_step, intersecting_taxon_id,
+        row_number() OVER (ORDER BY total_distance, accession, intersecting_distance, species_id) AS _position
+    FROM hits
+    ORDER BY _position
+    LIMIT ?
+"""
+    params = [
+        [taxon["id"] for taxon in ancestors],
+        [taxon["distance"] for taxon in ancestors],
+        integrated_only,
+        limit,
+    ]
+    return query, params
+
+
+def hot_nearest_items_query(
+    taxonomy_id: int, max_taxon_level: str, integrated_only: bool, limit
+) -> Tuple[str, list]:
+    """
+    Build the query for the nearest genomes to a taxon from its precomputed results in
+    hot_intersect_results. Gives the same results as nearest_items_query
+    """
+    query = """
+    SELECT * EXCLUDE (hot_taxonomy_id, max_taxon_level, integrated_only)
+    FROM hot_intersect_results
+    WHERE hot_taxonomy_id = ? AND max_taxon_level = ? AND integrated_only = ?
+    ORDER BY _position
+    LIMIT ?
+"""
+    return query, [taxonomy_id, max_taxon_level, integrated_only, limit]
@@ -0,0 +1,75 @@
+from typing import Any, Iterator, Sequence
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+from .metrics import record_rows, stage
+from .profiling import profile_query
+import orjson
+import time
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response encoded straight to bytes with orjson. Returning one of these from
+    an endpoint skips FastAPI's jsonable_encoder pass over the content. Types orjson
+    cannot serialise natively (e.g. Decimal) are handed to jsonable_encoder
+    """
+
+    def render(self, content: Any) -> bytes:
+        with stage("serialize"):
+            return orjson.dumps(content, default=jsonable_encoder)
+
+
+def results_to_hash_list(results: Sequence[Sequence[Any]], cursor) -> list:
+    """
+    Convert fetched rows into a list of dicts keyed by the cursor's column names
+    """
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in results]
+
+
+def query_to_hash_list(cursor, query: str, params: Sequence[Any] = ()) -> list:
+    """
+    Run a query and return its rows as a list of dicts, timing the query, fetch and
+    serialize stages of the request. The query is profiled if the request asked for
+    it and logged if slow
+    """
+    start = time.perf_counter()
+    with stage("query"):
+        cursor.execute(query, params)
+    with stage("fetch"):
+        results = cursor.fetchall()
+    seconds = time.perf_counter() - start
+    with stage("serialize"):
+        items = results_to_hash_list(results, cursor)
+    record_rows(len(items))
+    profile_query(cursor, query, params, seconds)
+    return items
+
+
+def ndjson_lines(
+    cursor, exclude: Sequence[str] = (), batch_size: int = 1000
+) -> Iterator[bytes]:
+    """
+    Yield the rows of an executed cursor as newline delimited JSON, fetching them in
+    batches so only one batch is held in memory at a time. Columns named in exclude
+    are left out of the output
+    """
+    columns = [column[0] for column in cursor.description]
+    keep = [i for i, column in enumerate(columns) if column not in exclude]
+    columns = [columns[i] for i in keep]
+    while True:
+        with stage("fetch"):
+            rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        record_rows(len(rows))
+        with stage("serialize"):
+            lines = b"".join(
+                orjson.dumps(
+                    dict(zip(columns, [row[i] for i in keep])),
+                    default=jsonable_encoder,
+                )
+                + b"\n"
+                for row in rows
+            )
+        yield lines
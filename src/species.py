@@ -61,11 +61,22 @@ class Species:
     def species_sql(self, db="mysqldb"):
         sql = f"""
     insert into species
+    select nextval('species_sequence'), *, 0 as search_boost
+    from ({self.species_select(db)})
+"""
+        logging.debug(f"Generated SQL: {sql}")
+        return sql
+
+    def species_select(self, db="mysqldb"):
+        """
+        Species rows from the metadata, holding every column of species except
+        species_id and search_boost, in order
+        """
+        return f"""
     select
-        nextval('species_sequence'),
         a.accession, a.name, a.assembly_default, a.tol_id, a.ensembl_name, a.assembly_uuid, 
         a.url_name, g.genome_uuid, g.production_name, o.common_name, o.scientific_name, 
-        o.biosample_id, o.strain, er.is_current, er.label, er.release_type, o.taxonomy_id, o.species_taxonomy_id, 0 as search_boost
+        o.biosample_id, o.strain, er.is_current, er.label, er.release_type, o.taxonomy_id, o.species_taxonomy_id
     from {db}.assembly a
     join {db}.genome g on a.assembly_id = g.assembly_id
     join {db}.organism o on g.organism_id = o.organism_id
@@ -74,8 +85,6 @@ class Species:
     where (er.release_type = 'integrated' and er.is_current = 1) 
     or (gr.is_current = 1 and er.release_type= 'partial')
 """
-        logging.debug(f"Generated SQL: {sql}")
-        return sql
 
     def apply_boost(self):
         logging.info("Applying boosted values")
@@ -93,33 +102,97 @@ class Species:
 
 
 class SpeciesFts(CreateSQLiteFTS):
-    def __init__(self, duckdb: DuckDb, sqlite: SQLiteDb, indexed_table="species"):
-        super().__init__(duckdb=duckdb, sqlite=sqlite, indexed_table=indexed_table)
+    """
+    FTS5 index of species. Columns in unindexed_columns are stored for display and
+    filtering but left out of the inverted index, so they cannot be matched. Matches
+    are ranked by bm25 with the weights of column_weights (1.0 for other columns),
+    which are stored as the table's rank function for queries to use through rank
+    """
+
+    fts_table = "species_fts"
+    columns = (
+        "species_id",
+        "genome_uuid",
+        "accession",
+        "name",
+        "assembly_default",
+        "tol_id",
+        "ensembl_name",
+        "production_name",
+        "common_name",
+        "scientific_name",
+        "biosample_id",
+        "strain",
+        "release_label",
+        "release_type",
+        "taxonomy_id",
+        "search_boost",
+    )
+    _default_unindexed = (
+        "species_id",
+        "genome_uuid",
+        "release_type",
+        "taxonomy_id",
+        "search_boost",
+    )
+    _default_weights = {
+        "scientific_name": 10.0,
+        "common_name": 10.0,
+        "biosample_id": 0.5,
+    }
+
+    def __init__(
+        self,
+        duckdb: DuckDb,
+        sqlite: SQLiteDb,
+        indexed_table="species",
+        prefix_lengths=(2, 3, 4),
+        bulk_load: bool = False,
+        unindexed_columns=_default_unindexed,
+        column_weights=_default_weights,
+    ):
+        super().__init__(
+            duckdb=duckdb,
+            sqlite=sqlite,
+            indexed_table=indexed_table,
+            bulk_load=bulk_load,
+        )
+        self.prefix_lengths = prefix_lengths
+        for column in [*unindexed_columns, *column_weights]:
+            if column not in self.columns:
+                raise ValueError(f"species_fts has no column {column}")
+        self.unindexed_columns = unindexed_columns
+        self.column_weights = column_weights
 
     def fts_ddl(self):
-        return """
+        # Prefix indexes let FTS5 answer prefix queries of these lengths (e.g. typeahead)
+        # without scanning every term in the index which starts with the prefix
+        prefix = ""
+        if self.prefix_lengths:
+            prefix = "prefix='{}',".format(
+                " ".join(str(x) for x in self.prefix_lengths)
+            )
+        columns = "\n    ".join(
+            f"{column} UNINDEXED," if column in self.unindexed_columns else f"{column},"
+            for column in self.columns
+        )
+        return f"""
     CREATE VIRTUAL TABLE species_fts USING fts5(
-    species_id,
-    genome_uuid,
-    accession,
-    name,
-    assembly_default,
-    tol_id,
-    ensembl_name,
-    production_name,
-    common_name,
-    scientific_name,
-    biosample_id,
-    strain,
-    release_label,
-    release_type,
-    taxonomy_id,
-    search_boost,
+    {columns}
+    {prefix}
     tokenize='unicode61'
 )
 """
 
+    def fts_options(self):
+        weights = ", ".join(
+            str(float(self.column_weights.get(column, 1.0))) for column in self.columns
+        )
+        return {"rank": f"bm25({weights})"}
+
     def fts_sql(self):
+        # Rows are inserted in boost order so the rowid order of matches puts boosted
+        # genomes first. Typeahead relies on this to avoid sorting every match
         return """
     INSERT INTO species_fts (
         species_id,
@@ -156,4 +229,51 @@ class SpeciesFts(CreateSQLiteFTS):
         taxonomy_id,
         search_boost
     FROM species
+    ORDER BY search_boost DESC, species_id
+"""
+
+
+class SpeciesTrigramFts(CreateSQLiteFTS):
+    """
+    Trigram index over the name-like columns of species_fts, used to find near matches
+    for misspelt searches. Rows share their rowid with species_fts so matches are joined
+    back to it for the full record. Must be built after SpeciesFts
+    """
+
+    fts_table = "species_trigram_fts"
+
+    def __init__(self, duckdb: DuckDb, sqlite: SQLiteDb, bulk_load: bool = False):
+        super().__init__(
+            duckdb=duckdb, sqlite=sqlite, indexed_table=None, bulk_load=bulk_load
+        )
+
+    def fts_ddl(self):
+        # Only single trigrams are queried so positions are not needed (detail=none)
+        return """
+    CREATE VIRTUAL TABLE species_trigram_fts USING fts5(
+    scientific_name,
+    common_name,
+    strain,
+    tol_id,
+    tokenize='trigram',
+    detail=none
+)
+"""
+
+    def fts_sql(self):
+        return """
+    INSERT INTO species_trigram_fts (
+        rowid,
+        scientific_name,
+        common_name,
+        strain,
+        tol_id
+    )
+    SELECT
+        rowid,
+        scientific_name,
+        common_name,
+        strain,
+        tol_id
+    FROM species_fts
 """
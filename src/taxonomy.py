@@ -1,30 +1,45 @@
 from .db import DuckDb, SQLiteDb, CopyTable, CreateIndex, CreateSQLiteFTS
+from .hierarchy import encode_parents
 import logging
 
 
 class Taxonomy:
+    # Deeper lineages than this can only come from a cycle in ncbi_taxa_node
+    max_lineage_depth = 1000
+
     def __init__(
         self,
         duckdb: DuckDb,
         ignore_genbank_hidden: bool = False,
         taxonomy_source: str = "mysqldb",
         build_taxonomy_fts: bool = False,
+        source_schema: str = "mysqldb",
+        build_taxonomy_tree: bool = False,
     ):
         self.duckdb = duckdb
         self.ignore_genbank_hidden = ignore_genbank_hidden
         self.taxonomy_source = taxonomy_source
         self.build_taxonomy_fts = build_taxonomy_fts
+        self.source_schema = source_schema
+        self.build_taxonomy_tree = build_taxonomy_tree
 
     def run(self):
         logging.info("Copying taxonomy and organism tables from MySQL")
         self._copy_tables()
         logging.info("Computing Taxonomy hierarchy")
         self._create_ncbi_hierarchy_lookup()
+        logging.info("Computing taxonomy ancestors")
+        self._create_taxonomy_ancestors()
+        logging.info("Computing taxonomy nested set")
+        self._create_taxonomy_nested_set()
         if self.build_taxonomy_fts:
             logging.info("Creating taxonomy names lookup")
             self._create_taxonomy_names()
         else:
             logging.info("Skipping building taxonomy names lookup")
+        if self.build_taxonomy_tree:
+            logging.info("Creating taxonomy tree lookup")
+            self._create_taxonomy_tree()
         logging.info("Cleaning up imported unused tables")
         self._cleanup()
 
@@ -32,7 +47,7 @@ class Taxonomy:
         current_catalog = self.duckdb.current_catalog()
         CopyTable(
             self.duckdb.con,
-            "mysqldb",
+            self.source_schema,
             current_catalog,
             "organism",
             "organism",
@@ -60,66 +75,191 @@ class Taxonomy:
     def _cleanup(self):
         self.duckdb.drop_tables(["ncbi_taxa_node", "ncbi_taxa_name"])
 
+    def _create_ancestor_closure(self, table: str, taxa_sql: str):
+        """
+        Create a temp table holding (taxonomy_id, ancestor_id, distance) for every taxon
+        returned by taxa_sql and each of its ancestors up to and including the root.
+        Lineages are walked a level at a time, joining the ancestors found at the last
+        distance to ncbi_taxa_node, so each step is one join of a narrow frontier
+        rather than a recursive CTE carrying ever longer lists. NCBI's lineages are
+        at most a few dozen deep which bounds the number of steps
+        """
+        con = self.duckdb.con
+        con.execute(
+            f"""
+    create temp table {table} AS
+    SELECT t.taxon_id AS taxonomy_id, n.parent_id AS ancestor_id, 1 AS distance
+    FROM ({taxa_sql}) t
+    JOIN ncbi_taxa_node n ON n.taxon_id = t.taxon_id
+    WHERE n.parent_id IS NOT NULL AND n.parent_id <> n.taxon_id
+"""
+        )
+        distance = 1
+        while True:
+            added = con.execute(
+                f"""
+    INSERT INTO {table}
+    SELECT c.taxonomy_id, n.parent_id, c.distance + 1
+    FROM {table} c
+    JOIN ncbi_taxa_node n ON n.taxon_id = c.ancestor_id
+    WHERE c.distance = ? AND n.parent_id IS NOT NULL AND n.parent_id <> n.taxon_id
+""",
+                [distance],
+            ).fetchone()[0]
+            if not added:
+                break
+            distance += 1
+            if distance > self.max_lineage_depth:
+                raise ValueError(
+                    f"Lineages are deeper than {self.max_lineage_depth}. ncbi_taxa_node has a cycle"
+                )
+
     def _create_ncbi_hierarchy_lookup(self):
         logging.info("Creating the NCBI hierarchy lookup")
+        self._create_ancestor_closure(
+            "organism_ancestors",
+            "SELECT DISTINCT taxonomy_id AS taxon_id FROM organism",
+        )
         sql = """
     create table computed_hierarchy AS
-    WITH RECURSIVE TaxonHierarchy AS (
     SELECT
-        n.taxon_id,
-        n.parent_id,
-        ARRAY[o.taxonomy_id] AS path_array,
-        CASE
-            WHEN n.taxon_id = o.taxonomy_id AND n.parent_id IS NOT NULL AND n.parent_id <> o.taxonomy_id
-            THEN ARRAY[n.parent_id]
-            ELSE ARRAY[]::INTEGER[]
-        END AS ancestor_array
+        o.taxonomy_id AS organism_taxonomy_id,
+        COALESCE(
+            list(a.ancestor_id ORDER BY a.distance) FILTER (WHERE a.ancestor_id IS NOT NULL),
+            ARRAY[]::INTEGER[]
+        ) AS ancestor_taxon_ids
     FROM
-        ncbi_taxa_node n
-    INNER JOIN
-        (SELECT DISTINCT taxonomy_id FROM organism) o ON n.taxon_id = o.taxonomy_id
-
-    UNION ALL
+        (SELECT DISTINCT taxonomy_id FROM organism) o
+    LEFT JOIN
+        organism_ancestors a ON a.taxonomy_id = o.taxonomy_id
+    GROUP BY o.taxonomy_id
+"""
+        self.duckdb.con.execute(sql)
+        self.duckdb.con.execute("drop table organism_ancestors")
+        CreateIndex(
+            con=self.duckdb.con,
+            table="computed_hierarchy",
+            columns=["organism_taxonomy_id"],
+        ).run()
+        logging.info("Finished building names")
 
+    def _create_taxonomy_ancestors(self):
+        """
+        Precompute the ancestors of every taxon found in the lineage of an Ensembl
+        organism along with the rank, label and distance of each ancestor. This mirrors
+        the response of OLS' hierarchicalAncestors endpoint so it can be served without
+        a remote call. Ranks are reported as OLS does i.e. no rank becomes NULL
+        """
+        logging.info("Creating the taxonomy ancestors lookup")
+        # Every lineage taxon sits in an organism's ancestor list followed by its own
+        # ancestors, so the lists give them all without walking the taxonomy again
+        sql = """
+    create table taxonomy_ancestors AS
+    WITH Lineages AS (
+        SELECT
+            organism_taxonomy_id AS taxonomy_id,
+            unnest(ancestor_taxon_ids) AS ancestor_id,
+            generate_subscripts(ancestor_taxon_ids, 1) AS distance
+        FROM computed_hierarchy
+    ),
+    Holders AS (
+        SELECT ancestor_id AS taxon_id, min(taxonomy_id) AS organism_taxonomy_id
+        FROM Lineages
+        WHERE ancestor_id NOT IN (SELECT organism_taxonomy_id FROM computed_hierarchy)
+        GROUP BY ancestor_id
+    ),
+    Ancestors AS (
+        SELECT taxonomy_id, ancestor_id, distance FROM Lineages
+        UNION ALL
+        SELECT h.taxon_id, l.ancestor_id, l.distance - s.distance
+        FROM Holders h
+        JOIN Lineages s ON (s.taxonomy_id = h.organism_taxonomy_id AND s.ancestor_id = h.taxon_id)
+        JOIN Lineages l ON (l.taxonomy_id = h.organism_taxonomy_id AND l.distance > s.distance)
+    )
     SELECT
-        n.taxon_id,
-        n.parent_id,
-        array_append(th.path_array, n.taxon_id) AS path_array,
-        CASE
-            WHEN n.parent_id IS NOT NULL AND NOT array_contains(th.ancestor_array, n.parent_id) AND n.parent_id <> th.taxon_id
-            THEN array_append(th.ancestor_array, n.parent_id)
-            ELSE th.ancestor_array
-        END AS ancestor_array
-    FROM
-        ncbi_taxa_node n
-    INNER JOIN
-        TaxonHierarchy th ON n.taxon_id = th.parent_id
-    WHERE
-        n.parent_id IS NOT NULL AND n.parent_id <> th.taxon_id
+        a.taxonomy_id,
+        a.ancestor_id,
+        a.distance::INTEGER AS distance,
+        replace(nullif(n.rank, 'no rank'), ' ', '_') AS rank,
+        tn.name AS label,
+        a.distance = max(a.distance) OVER (PARTITION BY a.taxonomy_id) AS is_root
+    FROM Ancestors a
+    JOIN ncbi_taxa_node n ON n.taxon_id = a.ancestor_id
+    LEFT JOIN ncbi_taxa_name tn ON (tn.taxon_id = a.ancestor_id AND tn.name_class = 'scientific name')
+    ORDER BY a.taxonomy_id, a.distance
+"""
+        self.duckdb.con.execute(sql)
+        CreateIndex(
+            con=self.duckdb.con,
+            table="taxonomy_ancestors",
+            columns=["taxonomy_id"],
+        ).run()
+        logging.info("Finished building ancestors")
+
+    def _create_taxonomy_nested_set(self):
+        """
+        Number every taxon in the organism lineages in pre-order, giving each an interval
+        [left_index, right_index] containing the left_index of all of its descendants,
+        and its depth from the root. computed_hierarchy is then rebuilt carrying the
+        interval and depth of its organism and sorted by left_index, so finding all
+        organisms under a taxon is a range predicate which can be pruned via zone maps
+        """
+        logging.info("Creating the taxonomy nested set")
+        sql = """
+    create table taxonomy_nested_set AS
+    WITH Paths AS (
+        SELECT taxonomy_id AS taxon_id, list(ancestor_id ORDER BY distance DESC) || [taxonomy_id] AS path
+        FROM taxonomy_ancestors
+        GROUP BY taxonomy_id
+        UNION
+        SELECT ancestor_id AS taxon_id, [ancestor_id] AS path
+        FROM taxonomy_ancestors
+        WHERE is_root
+        UNION
+        SELECT organism_taxonomy_id AS taxon_id, [organism_taxonomy_id] AS path
+        FROM computed_hierarchy
+        WHERE organism_taxonomy_id NOT IN (SELECT taxonomy_id FROM taxonomy_ancestors)
     ),
-    RankedHierarchy AS (
-        SELECT
-            taxon_id,
-            path_array[1] AS start_taxon_id,
-            ancestor_array,
-            array_length(path_array) AS depth,
-            ROW_NUMBER() OVER (PARTITION BY path_array[1] ORDER BY array_length(path_array) DESC) AS rn
-        FROM
-            TaxonHierarchy
+    Numbered AS (
+        SELECT taxon_id, row_number() OVER (ORDER BY path) AS left_index, len(path) - 1 AS depth
+        FROM Paths
     )
     SELECT
-        o.taxonomy_id AS organism_taxonomy_id,
-        COALESCE((SELECT rh.ancestor_array FROM RankedHierarchy rh WHERE rh.start_taxon_id = o.taxonomy_id AND rh.rn = 1), ARRAY[]::INTEGER[]) AS ancestor_taxon_ids
-    FROM
-        (SELECT DISTINCT taxonomy_id FROM organism) o;
+        n.taxon_id,
+        n.left_index::INTEGER AS left_index,
+        (n.left_index + count(a.taxonomy_id))::INTEGER AS right_index,
+        n.depth::INTEGER AS depth
+    FROM Numbered n
+    LEFT JOIN taxonomy_ancestors a ON a.ancestor_id = n.taxon_id
+    GROUP BY n.taxon_id, n.left_index, n.depth
+    ORDER BY n.left_index
+"""
+        self.duckdb.con.execute(sql)
+        CreateIndex(
+            con=self.duckdb.con,
+            table="taxonomy_nested_set",
+            columns=["taxon_id"],
+        ).run()
+
+        logging.info("Ordering the NCBI hierarchy lookup by nested set")
+        sql = """
+    create table computed_hierarchy_nested AS
+    SELECT ch.organism_taxonomy_id, ch.ancestor_taxon_ids, ns.left_index, ns.right_index, ns.depth
+    FROM computed_hierarchy ch
+    JOIN taxonomy_nested_set ns ON ns.taxon_id = ch.organism_taxonomy_id
+    ORDER BY ns.left_index
 """
         self.duckdb.con.execute(sql)
+        self.duckdb.drop_tables(["computed_hierarchy"])
+        self.duckdb.con.execute(
+            "alter table computed_hierarchy_nested rename to computed_hierarchy"
+        )
         CreateIndex(
             con=self.duckdb.con,
             table="computed_hierarchy",
             columns=["organism_taxonomy_id"],
         ).run()
-        logging.info("Finished building names")
+        logging.info("Finished building nested set")
 
     def _create_taxonomy_names(self):
         logging.info("Creating the taxonomy names")
@@ -138,34 +278,65 @@ LEFT JOIN ncbi_taxa_name n4 on (n1.taxon_id = n4.taxon_id and n4.name_class = 'e
         self.duckdb.con.execute(sql)
         logging.info("Finished building names")
 
+    def _create_taxonomy_tree(self):
+        """
+        Store the parent, rank and label of every NCBI taxon in taxonomy_tree, sorted and
+        indexed by taxon ID so taxa are found by point lookups, and the parents again in
+        taxonomy_parents encoded as a dense array indexed by taxon ID. The server walks
+        the array in memory to find the lineage of any taxon, not only those of Ensembl
+        organisms, and fetches the ranks and labels of its taxa from taxonomy_tree
+        """
+        logging.info("Creating the taxonomy tree")
+        sql = """
+    create table taxonomy_tree AS
+    SELECT
+        n.taxon_id,
+        n.parent_id,
+        replace(nullif(n.rank, 'no rank'), ' ', '_') AS rank,
+        tn.name AS label
+    FROM ncbi_taxa_node n
+    LEFT JOIN ncbi_taxa_name tn ON (tn.taxon_id = n.taxon_id AND tn.name_class = 'scientific name')
+    ORDER BY n.taxon_id
+"""
+        self.duckdb.con.execute(sql)
+        CreateIndex(
+            con=self.duckdb.con,
+            table="taxonomy_tree",
+            columns=["taxon_id"],
+        ).run()
+        sql = """
+    SELECT list(coalesce(t.parent_id, 0) ORDER BY r.taxon_id)
+    FROM range(0, (SELECT coalesce(max(taxon_id), 0) + 1 FROM taxonomy_tree)) r(taxon_id)
+    LEFT JOIN taxonomy_tree t ON t.taxon_id = r.taxon_id
+"""
+        parents = encode_parents(self.duckdb.con.execute(sql).fetchone()[0])
+        self.duckdb.con.execute(
+            "create table taxonomy_parents AS SELECT ?::BLOB AS parents", [parents]
+        )
+        taxa = self.duckdb.con.execute("select count(*) from taxonomy_tree").fetchone()[
+            0
+        ]
+        logging.info(
+            f"Taxonomy tree holds {taxa} taxa. Its parent array takes {len(parents) / 1048576:.1f}MiB on disk and in memory"
+        )
+
 
 class TaxonomySQLiteFts(CreateSQLiteFTS):
+    fts_table = "taxonomy_fts"
+
     def __init__(
-        self, duckdb: DuckDb, sqlite: SQLiteDb, indexed_table="taxonomy_names"
+        self,
+        duckdb: DuckDb,
+        sqlite: SQLiteDb,
+        indexed_table="taxonomy_names",
+        bulk_load: bool = False,
     ):
-        super().__init__(duckdb=duckdb, sqlite=sqlite, indexed_table=indexed_table)
-
-    def run(self):
-        logging.info(f"Building SQLite full-text search for {self.__class__.__name__}")
-        current_catalog = self.duckdb.current_catalog()
-        logging.info("Creating FTS schema in SQLite")
-        indexed_table = self.indexed_table
-        CopyTable(
-            self.duckdb.con,
-            current_catalog,
-            self.sqlite.name,
-            indexed_table,
-            indexed_table,
-            index_columns=[],
-        ).run()
-        sqlite_con = self.sqlite.con
-        sqlite_con.execute(self.fts_ddl())
-        logging.info("Populating FTS schema from DuckDB")
-        sqlite_con.execute(self.fts_sql())
-        sqlite_con.execute(f"DROP TABLE {indexed_table}")
-        logging.info("Committing")
-        sqlite_con.commit()
-        logging.info("Finished")
+        super().__init__(
+            duckdb=duckdb,
+            sqlite=sqlite,
+            indexed_table=indexed_table,
+            bulk_load=bulk_load,
+        )
 
     def fts_ddl(self):
         return """
@@ -0,0 +1,156 @@
+import unittest
+import tempfile
+from unittest import mock
+from starlette.testclient import TestClient
+from tests.util import LookupsFixture
+import main
+
+
+class TestBatchLookup(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.fixture = LookupsFixture(tempfile.mkdtemp())
+        cls.fixture.build()
+        cls.manager = cls.fixture.manager()
+        cls.client = TestClient(main.app)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.manager.close()
+
+    def setUp(self):
+        patcher = mock.patch.object(main, "lookup_manager", self.manager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        main.result_cache.set_version(None)
+        main.result_cache.set_version(self.manager.current.version)
+
+    def batch(self, **keys):
+        response = self.client.post("/species/batch", json=keys)
+        self.assertEqual(first=200, second=response.status_code)
+        return response.json()
+
+    def species(self, where, params):
+        with self.manager.acquire() as lookups:
+            with lookups.duckdb_pool.connection() as cursor:
+                return cursor.execute(
+                    f"select genome_uuid, accession from species where {where} order by species_id",
+                    params,
+                ).fetchall()
+
+    def test_grouping(self):
+        """
+        Results are grouped under each key given, keys of each kind being separate
+        """
+        genome_uuid = "a7335667-93e7-11ec-a39d-005056b38ce3"
+        accession = "GCA_000001405.14"
+        json = self.batch(
+            taxonomy_ids=[9598, 10090],
+            genome_uuids=[genome_uuid],
+            accessions=[accession],
+        )
+        self.assertEqual(first="success", second=json["meta"]["status"])
+        self.assertEqual(first=4, second=json["meta"]["keys"])
+        self.assertEqual(
+            first=["9598", "10090"], second=list(json["taxonomy_ids"].keys())
+        )
+        # Including the genomes of the subspecies Mus musculus domesticus
+        self.assertEqual(
+            first=sorted(self.species("taxonomy_id in (10090, 10092)", [])),
+            second=sorted(
+                (item["genome_uuid"], item["accession"])
+                for item in json["taxonomy_ids"]["10090"]
+            ),
+        )
+        self.assertEqual(
+            first=self.species("genome_uuid = ?", [genome_uuid]),
+            second=[
+                (item["genome_uuid"], item["accession"])
+                for item in json["genome_uuids"][genome_uuid]
+            ],
+        )
+        self.assertEqual(
+            first=self.species("accession = ?", [accession]),
+            second=[
+                (item["genome_uuid"], item["accession"])
+                for item in json["accessions"][accession]
+            ],
+        )
+        # An accession can be shared by several genomes
+        self.assertGreater(len(json["accessions"][accession]), 1)
+        self.assertEqual(
+            first=json["meta"]["items"],
+            second=sum(
+                len(items)
+                for group in ("taxonomy_ids", "genome_uuids", "accessions")
+                for items in json[group].values()
+            ),
+        )
+        item = json["genome_uuids"][genome_uuid][0]
+        self.assertNotIn(member="key", container=item)
+        self.assertNotIn(member="key_type", container=item)
+        self.assertIsNone(item["taxonomy_step"])
+
+    def test_unmatched_and_duplicate_keys(self):
+        """
+        Keys matching nothing are reported with no results and keys given more than once
+        are reported once
+        """
+        json = self.batch(
+            taxonomy_ids=[99999999, 10090, 10090],
+            genome_uuids=["unknown"],
+            accessions=["GCA_000001405.14", "GCA_000001405.14", "9606"],
+        )
+        self.assertEqual(first="success", second=json["meta"]["status"])
+        self.assertEqual(first=[], second=json["taxonomy_ids"]["99999999"])
+        self.assertEqual(first={"unknown": []}, second=json["genome_uuids"])
+        self.assertEqual(first=[], second=json["accessions"]["9606"])
+        self.assertEqual(
+            first=len(self.species("taxonomy_id in (10090, 10092)", [])),
+            second=len(json["taxonomy_ids"]["10090"]),
+        )
+        self.assertEqual(
+            first=len(self.species("accession = ?", ["GCA_000001405.14"])),
+            second=len(json["accessions"]["GCA_000001405.14"]),
+        )
+
+        json = self.batch()
+        self.assertEqual(
+            first={
+                "meta": {"status": "success", "keys": 0, "items": 0},
+                "taxonomy_ids": {},
+                "genome_uuids": {},
+                "accessions": {},
+            },
+            second=json,
+        )
+
+    def test_max_keys(self):
+        with mock.patch.object(main.config.server, "batch_max_keys", 3):
+            json = self.batch(taxonomy_ids=[9606, 10090], genome_uuids=["a"])
+            self.assertEqual(first="success", second=json["meta"]["status"])
+            json = self.batch(
+                taxonomy_ids=[9606, 10090], genome_uuids=["a"], accessions=["b"]
+            )
+        self.assertEqual(first="error", second=json["meta"]["status"])
+        self.assertIn(member="4 keys", container=json["meta"]["error"])
+
+    def test_matches_taxonomy(self):
+        """
+        Taxonomy IDs give what /species/taxonomy does for the taxon
+        """
+        json = self.batch(taxonomy_ids=[9443, 9606, 7742])
+        for taxonomy_id in (9443, 9606, 7742):
+            with self.subTest(taxonomy_id=taxonomy_id):
+                response = self.client.get(
+                    f"/species/taxonomy/{taxonomy_id}", params={"limit": 0}
+                )
+                expected = response.json()["items"]
+                self.assertGreater(len(expected), 0)
+                self.assertEqual(
+                    first=expected, second=json["taxonomy_ids"][str(taxonomy_id)]
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+from src.db import DuckDb
+from src.hierarchy import TaxonomyHierarchy, ancestors_up_to
+from src.hot_clades import HotClades
+from src.queries import (
+    hot_intersecting_items_query,
+    hot_nearest_items_query,
+    intersecting_items_query,
+    nearest_items_query,
+)
+from src.species import Species
+from src.taxonomy import Taxonomy
+from tests.util import DatabaseFixture, TaxonomyFixture
+
+
+class TestCreateHotClades(unittest.TestCase):
+    def setUp(self):
+        self.duckdb = DuckDb.create()
+        # Load the metadata into its own schema as Taxonomy copies organism
+        self.duckdb.con.execute("create schema metadata")
+        DatabaseFixture(duckdb=self.duckdb).load_tables(schema="metadata")
+        Species(duckdb=self.duckdb, source_schema="metadata").run()
+        fixture = TaxonomyFixture(duckdb=self.duckdb)
+        fixture.load_tables()
+        Taxonomy(
+            duckdb=self.duckdb,
+            taxonomy_source=fixture.schema,
+            source_schema=fixture.schema,
+        ).run()
+        HotClades(duckdb=self.duckdb, hot_taxa=[9604, 424242], top=1).run()
+
+    def test_hot_taxa(self):
+        """
+        Configured taxa in the lookups are hot along with those with the most genomes
+        """
+        taxa, intersects = HotClades.served(self.duckdb)
+        self.assertEqual(first={1, 9604}, second=taxa)
+        self.assertEqual(
+            first={(9604, "order", False), (9604, "order", True)}, second=intersects
+        )
+
+    def test_hot_results(self):
+        """
+        Precomputed results are the same as those computed on request
+        """
+        con = self.duckdb.con
+        for limit, after in ((None, None), (10, None), (10, (0, 0))):
+            computed = con.execute(
+                *intersecting_items_query(con, 9604, limit, after)
+            ).fetchall()
+            hot = con.execute(
+                *hot_intersecting_items_query(9604, limit, after)
+            ).fetchall()
+            self.assertGreater(a=len(computed), b=0)
+            self.assertEqual(first=computed, second=hot)
+
+        hierarchy = TaxonomyHierarchy.create(self.duckdb)
+        ancestors = ancestors_up_to(hierarchy.ancestors(9604), "order")
+        self.assertEqual(first=[9443], second=[taxon["id"] for taxon in ancestors])
+        for integrated_only in (False, True):
+            computed = con.execute(
+                *nearest_items_query(ancestors, integrated_only, 100)
+            ).fetchall()
+            hot = con.execute(
+                *hot_nearest_items_query(9604, "order", integrated_only, 100)
+            ).fetchall()
+            self.assertEqual(first=computed, second=hot)
+
+
+if __name__ == "__main__":
+    unittest.main()
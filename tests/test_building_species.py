@@ -1,8 +1,10 @@
 import unittest
 import os
+import sqlite3
 import tempfile
+import threading
 from src.db import DuckDb, SQLiteDb
-from src.species import Species, SpeciesFts
+from src.species import Species, SpeciesFts, SpeciesTrigramFts
 from tests.util import DatabaseFixture
 
 
@@ -40,3 +42,209 @@ class TestCreateSpeciesLookup(unittest.TestCase):
         )
         self.assertEqual(first=416, second=cursor.fetchone()[0])
         cursor.close()
+
+    def test_trigram_fts(self):
+        """
+        Misspelt names match on their trigrams and share their rowid with species_fts.
+        Building reports the rows and index size
+        """
+        duckdb = DuckDb.create()
+        DatabaseFixture(duckdb=duckdb).load_tables()
+        Species(duckdb=duckdb, source_schema="memory").run()
+        sqlite = SQLiteDb.create(
+            os.path.join(tempfile.mkdtemp(), "species_fts.sqlite"), "sqlitedb"
+        )
+        stats = SpeciesFts(duckdb=duckdb, sqlite=sqlite).run()
+        self.assertEqual(first=6423, second=stats["rows"])
+        self.assertGreater(a=stats["index_bytes"], b=0)
+        stats = SpeciesTrigramFts(duckdb=duckdb, sqlite=sqlite).run()
+        self.assertEqual(first=6423, second=stats["rows"])
+        self.assertGreater(a=stats["index_bytes"], b=0)
+        cursor = sqlite.con.execute(
+            """
+            SELECT DISTINCT s.scientific_name
+            FROM species_trigram_fts t JOIN species_fts s ON s.rowid = t.rowid
+            WHERE t.species_trigram_fts MATCH ? ORDER BY t.rank LIMIT 1
+            """,
+            ('"zeb" OR "eba" OR "baf" OR "afi" OR "fis" OR "ish"',),
+        )
+        self.assertEqual(first=("Danio rerio",), second=cursor.fetchone())
+        sqlite.close()
+
+    def test_prefix_index(self):
+        """
+        Prefix queries use the prefix index and rowid order puts boosted genomes first
+        """
+        duckdb = DuckDb.create()
+        DatabaseFixture(duckdb=duckdb).load_tables()
+        Species(duckdb=duckdb, source_schema="memory").run()
+        sqlite = SQLiteDb.create(
+            os.path.join(tempfile.mkdtemp(), "species_fts.sqlite"), "sqlitedb"
+        )
+        SpeciesFts(duckdb=duckdb, sqlite=sqlite).run()
+        con = sqlite.con
+        self.assertIn(
+            member="prefix='2 3 4'",
+            container=con.execute(
+                "SELECT sql FROM sqlite_master WHERE name = 'species_fts'"
+            ).fetchone()[0],
+        )
+        boosts = [
+            boost
+            for (boost,) in con.execute(
+                "SELECT s.search_boost FROM species_fts s WHERE s.species_fts MATCH ? ORDER BY s.rowid",
+                ('"ho"*',),
+            ).fetchall()
+        ]
+        self.assertEqual(first=1000, second=boosts[0])
+        self.assertEqual(first=sorted(boosts, reverse=True), second=boosts)
+        sqlite.close()
+
+    def test_serving_connection(self):
+        """
+        Serving connections are immutable, memory-mapped and can be used from any thread
+        """
+        duckdb = DuckDb.create()
+        DatabaseFixture(duckdb=duckdb).load_tables()
+        Species(duckdb=duckdb, source_schema="memory").run()
+        sqlite_path = os.path.join(tempfile.mkdtemp(), "species_fts.sqlite")
+        sqlite = SQLiteDb.create(sqlite_path, "sqlitedb")
+        SpeciesFts(duckdb=duckdb, sqlite=sqlite).run()
+        sqlite.close()
+
+        serving = SQLiteDb.create(
+            sqlite_path, "sqlitedb", read_only=True, mmap_size=1048576
+        )
+        con = serving.create_sqlite_connection()
+        self.assertEqual(
+            first=1048576, second=con.execute("PRAGMA mmap_size").fetchone()[0]
+        )
+        with self.assertRaises(sqlite3.OperationalError):
+            con.execute("DELETE FROM species_fts")
+        counts = []
+        thread = threading.Thread(
+            target=lambda: counts.append(
+                con.execute("SELECT count(*) FROM species_fts").fetchone()[0]
+            )
+        )
+        thread.start()
+        thread.join()
+        self.assertEqual(first=[6423], second=counts)
+        con.close()
+
+    def test_fts_bulk_load(self):
+        """
+        A bulk load builds the same index as a normal load and leaves the connection
+        and FTS settings as they were
+        """
+        tmpdir = tempfile.mkdtemp()
+        duckdb = DuckDb.create()
+        DatabaseFixture(duckdb=duckdb).load_tables()
+        Species(duckdb=duckdb, source_schema="memory").run()
+
+        contents = []
+        for bulk_load in (False, True):
+            sqlite = SQLiteDb.create(
+                os.path.join(tmpdir, f"{bulk_load}.sqlite"), "sqlitedb"
+            )
+            species_fts = SpeciesFts(duckdb=duckdb, sqlite=sqlite, bulk_load=bulk_load)
+            stats = species_fts.run()
+            self.assertGreater(a=stats["rows_per_second"], b=0)
+            self.assertFalse(os.path.exists(species_fts.staging_path()))
+            SpeciesTrigramFts(duckdb=duckdb, sqlite=sqlite, bulk_load=bulk_load).run()
+            contents.append(
+                [
+                    sqlite.con.execute(sql).fetchall()
+                    for sql in (
+                        "SELECT rowid, * FROM species_fts ORDER BY rowid",
+                        "SELECT rowid, * FROM species_trigram_fts ORDER BY rowid",
+                        "SELECT rowid FROM species_fts WHERE species_fts MATCH 'homo sap*'",
+                    )
+                ]
+            )
+            self.assertEqual(
+                first="delete",
+                second=sqlite.con.execute("PRAGMA journal_mode").fetchone()[0],
+            )
+            self.assertEqual(
+                first=2, second=sqlite.con.execute("PRAGMA synchronous").fetchone()[0]
+            )
+            if bulk_load:
+                # Left for the build to vacuum the pages freed by optimize
+                self.assertGreater(
+                    a=sqlite.con.execute("PRAGMA freelist_count").fetchone()[0], b=0
+                )
+                sqlite.vacuum()
+                self.assertEqual(
+                    first=0,
+                    second=sqlite.con.execute("PRAGMA freelist_count").fetchone()[0],
+                )
+            sqlite.close()
+        self.assertEqual(first=contents[0], second=contents[1])
+
+        # The index is merged into a single segment and FTS5's merge settings restored
+        con = sqlite.create_sqlite_connection()
+        self.assertEqual(
+            first=[
+                ("automerge", 4),
+                ("crisismerge", 16),
+                ("rank", species_fts.fts_options()["rank"]),
+                ("version", 4),
+            ],
+            second=con.execute(
+                "SELECT k, v FROM species_fts_config ORDER BY k"
+            ).fetchall(),
+        )
+        con.execute(
+            "INSERT INTO species_fts(species_fts, rank) VALUES('integrity-check', 1)"
+        )
+        con.close()
+
+    def test_fts_schema(self):
+        """
+        Unindexed columns are stored but cannot be matched and matches are ranked with
+        the column weights
+        """
+        duckdb = DuckDb.create()
+        DatabaseFixture(duckdb=duckdb).load_tables()
+        Species(duckdb=duckdb, source_schema="memory").run()
+        # Two genomes which only match on their scientific name and biosample ID
+        duckdb.con.execute(
+            "update species set scientific_name = 'Testus weightus' where species_id = 1"
+        )
+        duckdb.con.execute(
+            "update species set biosample_id = 'weightus' where species_id = 2"
+        )
+        sqlite = SQLiteDb.create(
+            os.path.join(tempfile.mkdtemp(), "species_fts.sqlite"), "sqlitedb"
+        )
+        SpeciesFts(duckdb=duckdb, sqlite=sqlite).run()
+        con = sqlite.con
+        genome_uuid, taxonomy_id = duckdb.con.execute(
+            "select genome_uuid, taxonomy_id from species where species_id = 1"
+        ).fetchone()
+        for value in (genome_uuid, str(taxonomy_id)):
+            self.assertEqual(
+                first=0,
+                second=con.execute(
+                    "SELECT count(*) FROM species_fts WHERE species_fts MATCH ?",
+                    (f'"{value}"',),
+                ).fetchone()[0],
+            )
+        self.assertEqual(
+            first=(genome_uuid,),
+            second=con.execute(
+                "SELECT genome_uuid FROM species_fts WHERE species_fts MATCH 'testus'"
+            ).fetchone(),
+        )
+        # The scientific name match outranks the biosample ID one
+        self.assertEqual(
+            first=[(1,), (2,)],
+            second=con.execute(
+                "SELECT species_id FROM species_fts WHERE species_fts MATCH 'weightus' ORDER BY rank"
+            ).fetchall(),
+        )
+        sqlite.close()
+
+        with self.assertRaises(ValueError):
+            SpeciesFts(duckdb=duckdb, sqlite=sqlite, column_weights={"missing": 1.0})
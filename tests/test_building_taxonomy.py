@@ -0,0 +1,219 @@
+import unittest
+import os
+import tempfile
+from src.db import DuckDb, SQLiteDb
+from src.hierarchy import TaxonomyHierarchy, TaxonomyTree
+from src.taxonomy import Taxonomy, TaxonomySQLiteFts
+from tests.util import TaxonomyFixture
+
+
+class TestCreateTaxonomyLookup(unittest.TestCase):
+    def setUp(self):
+        self.duckdb = DuckDb.create()
+        fixture = TaxonomyFixture(duckdb=self.duckdb)
+        fixture.load_tables()
+        Taxonomy(
+            duckdb=self.duckdb,
+            taxonomy_source=fixture.schema,
+            source_schema=fixture.schema,
+            build_taxonomy_tree=True,
+        ).run()
+
+    def test_computed_hierarchy(self):
+        con = self.duckdb.con
+        con.execute(
+            "select ancestor_taxon_ids from computed_hierarchy where organism_taxonomy_id = 9606"
+        )
+        self.assertEqual(
+            first=[9605, 9604, 9443, 40674, 7742, 2759, 131567, 1],
+            second=con.fetchone()[0],
+        )
+
+    def test_ancestor_closure(self):
+        """
+        Lineages match walking the parents of each node
+        """
+        parents = {
+            taxon_id: parent_id for taxon_id, parent_id, *_ in TaxonomyFixture.nodes
+        }
+
+        def lineage(taxon_id):
+            ancestors = []
+            while parents[taxon_id] != taxon_id:
+                taxon_id = parents[taxon_id]
+                ancestors.append(taxon_id)
+            return ancestors
+
+        con = self.duckdb.con
+        con.execute(
+            "select organism_taxonomy_id, ancestor_taxon_ids from computed_hierarchy"
+        )
+        hierarchy = dict(con.fetchall())
+        self.assertEqual(
+            first={
+                taxonomy_id: lineage(taxonomy_id)
+                for _, taxonomy_id, _ in TaxonomyFixture.organisms
+            },
+            second=hierarchy,
+        )
+        con.execute(
+            "select taxonomy_id, list(ancestor_id order by distance) from taxonomy_ancestors group by taxonomy_id"
+        )
+        lineage_taxa = set(hierarchy) | {
+            a for ancestors in hierarchy.values() for a in ancestors
+        }
+        self.assertEqual(
+            first={
+                taxon_id: lineage(taxon_id)
+                for taxon_id in lineage_taxa
+                if taxon_id != 1
+            },
+            second=dict(con.fetchall()),
+        )
+
+    def test_ancestor_closure_cycle(self):
+        duckdb = DuckDb.create()
+        fixture = TaxonomyFixture(duckdb=duckdb)
+        fixture.load_tables()
+        duckdb.con.execute(
+            f"update {fixture.schema}.ncbi_taxa_node set parent_id = 9606 where taxon_id = 9604"
+        )
+        taxonomy = Taxonomy(
+            duckdb=duckdb, taxonomy_source=fixture.schema, source_schema=fixture.schema
+        )
+        taxonomy._copy_tables()
+        with self.assertRaises(ValueError):
+            taxonomy._create_ncbi_hierarchy_lookup()
+
+    def test_nested_set(self):
+        """
+        Descendants of a node sit within its interval and depth differences give
+        the same steps as positions in the ancestor lists
+        """
+        con = self.duckdb.con
+        con.execute(
+            "select left_index, right_index, depth from taxonomy_nested_set where taxon_id = 9604"
+        )
+        left_index, right_index, depth = con.fetchone()
+        self.assertEqual(first=4, second=right_index - left_index)
+        self.assertEqual(first=6, second=depth)
+        con.execute(
+            """
+            select organism_taxonomy_id, depth - ?, list_position(ancestor_taxon_ids, 9604)
+            from computed_hierarchy
+            where left_index between ? and ?
+            order by organism_taxonomy_id
+            """,
+            (depth, left_index, right_index),
+        )
+        self.assertEqual(first=[(9598, 2, 2), (9606, 2, 2)], second=con.fetchall())
+
+    def test_hierarchy(self):
+        """
+        Ancestors are served from memory in the same shape as OLS hierarchicalAncestors
+        """
+        hierarchy = TaxonomyHierarchy.create(self.duckdb)
+        ancestors = hierarchy.ancestors(9606)
+        self.assertEqual(first=7, second=len(ancestors))
+        self.assertEqual(
+            first={
+                "iri": "http://purl.obolibrary.org/obo/NCBITaxon_9605",
+                "id": 9605,
+                "rank": "genus",
+                "label": "Homo",
+                "distance": 1,
+            },
+            second=ancestors[0],
+        )
+        self.assertEqual(first="order", second=ancestors[2]["rank"])
+        self.assertEqual(first="cellular organisms", second=ancestors[-1]["label"])
+        self.assertIsNone(ancestors[-1]["rank"])
+
+        with_root = hierarchy.ancestors(9606, include_root=True)
+        self.assertEqual(first=8, second=len(with_root))
+        self.assertEqual(first=1, second=with_root[-1]["id"])
+        self.assertEqual(first=8, second=with_root[-1]["distance"])
+
+        # Ancestors of organisms are served too but unrelated taxa are not
+        self.assertEqual(first=9604, second=hierarchy.ancestors(9605)[0]["id"])
+        self.assertIsNone(hierarchy.ancestors(63221))
+
+    def test_taxonomy_tree(self):
+        """
+        Every taxon is served from the tree in the same shape as from the organism
+        lineages
+        """
+        tree = TaxonomyTree.create(self.duckdb)
+        hierarchy = TaxonomyHierarchy.create(self.duckdb)
+        self.assertEqual(first=len(TaxonomyFixture.nodes), second=tree.taxa)
+        cursor = self.duckdb.con.cursor()
+        for include_root in (False, True):
+            self.assertEqual(
+                first=hierarchy.ancestors(9606, include_root=include_root),
+                second=tree.ancestors(cursor, 9606, include_root=include_root),
+            )
+        # Neither an organism nor an ancestor of one
+        self.assertIsNone(hierarchy.ancestors(63221))
+        ancestors = tree.ancestors(cursor, 63221)
+        self.assertEqual(
+            first=[9606, 9605, 9604, 9443, 40674, 7742, 2759, 131567],
+            second=[taxon["id"] for taxon in ancestors],
+        )
+        self.assertEqual(
+            first={
+                "iri": "http://purl.obolibrary.org/obo/NCBITaxon_9606",
+                "id": 9606,
+                "rank": "species",
+                "label": "Homo sapiens",
+                "distance": 1,
+            },
+            second=ancestors[0],
+        )
+        self.assertEqual(first=[], second=tree.ancestors(cursor, 1))
+        self.assertIsNone(tree.ancestors(cursor, 12345))
+        self.assertIsNone(tree.ancestors(cursor, 99999999))
+
+
+class TestCreateTaxonomyFts(unittest.TestCase):
+    def test_taxonomy_fts(self):
+        """
+        Taxonomy names are searchable by scientific and common names and
+        report their taxon
+        """
+        tmpdir = tempfile.mkdtemp()
+        sqlite_db_name = "sqlitedb"
+        duckdb = DuckDb.create()
+        sqlite = SQLiteDb.create(
+            os.path.join(tmpdir, "taxonomy_fts.sqlite"), sqlite_db_name
+        )
+        fixture = TaxonomyFixture(duckdb=duckdb)
+        fixture.load_tables()
+        Taxonomy(
+            duckdb=duckdb,
+            taxonomy_source=fixture.schema,
+            source_schema=fixture.schema,
+            build_taxonomy_fts=True,
+        ).run()
+        self.assertFalse(sqlite.has_table("taxonomy_fts"))
+        duckdb.connect_to_sqlite(sqlite_db_name, sqlite.path)
+        TaxonomySQLiteFts(
+            duckdb=duckdb, sqlite=sqlite, indexed_table="taxonomy_names"
+        ).run()
+        self.assertTrue(sqlite.has_table("taxonomy_fts"))
+
+        cursor = sqlite.con.cursor()
+        cursor.execute(
+            "SELECT taxonomy_id FROM taxonomy_fts t WHERE t.taxonomy_fts MATCH ? ORDER BY t.rank",
+            ("chimpanzee",),
+        )
+        self.assertEqual(first=[(9598,)], second=cursor.fetchall())
+        cursor.execute(
+            "SELECT taxonomy_id FROM taxonomy_fts t WHERE t.taxonomy_fts MATCH ? ORDER BY t.rank",
+            ("homo",),
+        )
+        self.assertEqual(first=[(9605,), (9606,), (63221,)], second=cursor.fetchall())
+        cursor.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+from src.cache import ResultCache
+
+
+class TestResultCache(unittest.TestCase):
+    def test_lru_and_size_bounds(self):
+        cache = ResultCache(max_entries=2, max_bytes=10, version="v1")
+        cache.put("a", b"1234")
+        cache.put("b", b"1234")
+        self.assertEqual(first=b"1234", second=cache.get("a"))
+        # Evicts b as a was used more recently
+        cache.put("c", b"1234")
+        self.assertIsNone(cache.get("b"))
+        # Too large for the remaining budget so evicts the oldest entry as well
+        cache.put("d", b"12345678")
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNone(cache.get("c"))
+        self.assertEqual(first=b"12345678", second=cache.get("d"))
+        stats = cache.stats()
+        self.assertEqual(first=3, second=stats["evictions"])
+        self.assertEqual(first=8, second=stats["bytes"])
+        self.assertEqual(first=2, second=stats["hits"])
+        self.assertEqual(first=3, second=stats["misses"])
+
+    def test_version_invalidates(self):
+        cache = ResultCache(max_entries=10, max_bytes=100, version="v1")
+        key = ResultCache.key("search", q="homo", limit=10)
+        self.assertEqual(
+            first=key, second=ResultCache.key("search", limit=10, q="homo")
+        )
+        cache.put(key, b"{}")
+        cache.set_version("v1")
+        self.assertEqual(first=b"{}", second=cache.get(key))
+        cache.set_version("v2")
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(first=0, second=cache.stats()["bytes"])
+        # Results computed from the previous lookups during a switch are not stored
+        cache.put(key, b"{}", version="v1")
+        self.assertIsNone(cache.get(key))
+        cache.put(key, b"{}", version="v2")
+        self.assertEqual(first=b"{}", second=cache.get(key))
+
+
+if __name__ == "__main__":
+    unittest.main()
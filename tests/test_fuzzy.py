@@ -0,0 +1,132 @@
+import unittest
+import tempfile
+from unittest import mock
+from starlette.testclient import TestClient
+from src.fuzzy import similarity, trigram_match, trigrams
+from tests.util import LookupsFixture
+import main
+
+
+class TestFuzzy(unittest.TestCase):
+    def test_trigrams(self):
+        self.assertEqual(
+            first={"  d", " da", "dan", "ani", "nio", "io "}, second=trigrams("Danio")
+        )
+        self.assertEqual(
+            first={"dan", "ani", "nio"}, second=trigrams("Danio", padded=False)
+        )
+        self.assertEqual(first=set(), second=trigrams(None))
+
+    def test_trigram_match(self):
+        self.assertEqual(
+            first='"ani" OR "dan" OR "nio"', second=trigram_match("danio!")
+        )
+        self.assertEqual(first="", second=trigram_match("ab"))
+
+    def test_similarity(self):
+        query = trigrams("zebafish")
+        self.assertAlmostEqual(
+            first=0.583,
+            second=similarity(query, ["Danio rerio", "Zebrafish", None]),
+            places=3,
+        )
+        self.assertEqual(
+            first=1.0, second=similarity(trigrams("Homo sapiens"), ["homo sapiens"])
+        )
+        self.assertEqual(first=0.0, second=similarity(query, [None, ""]))
+
+
+class TestFuzzySearch(unittest.TestCase):
+    # Fields of the items /species/search returned before near matches were added
+    fields = {
+        "name",
+        "accession",
+        "scientific_name",
+        "assembly_default",
+        "tol_id",
+        "common_name",
+        "biosample_id",
+        "strain",
+        "genome_uuid",
+        "release_label",
+        "release_type",
+        "taxonomy_id",
+        "score",
+        "search_boost",
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fixture = LookupsFixture(tempfile.mkdtemp())
+        cls.fixture.build()
+        cls.manager = cls.fixture.manager()
+        cls.client = TestClient(main.app)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.manager.close()
+
+    def setUp(self):
+        patcher = mock.patch.object(main, "lookup_manager", self.manager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        main.result_cache.set_version(None)
+        main.result_cache.set_version(self.manager.current.version)
+
+    def search(self, q, **params):
+        response = self.client.get("/species/search", params={"q": q, **params})
+        self.assertEqual(first=200, second=response.status_code)
+        return response.json()
+
+    def test_item_shape(self):
+        """
+        Exact and near matches have the same fields in the same order, those returned
+        before near matches were added plus match and similarity
+        """
+        json = self.search("plasmodium falciparum", limit=10)
+        self.assertTrue(json["meta"]["fallback"])
+        exact = [item for item in json["items"] if item["match"] == "exact"]
+        fuzzy = [item for item in json["items"] if item["match"] == "fuzzy"]
+        self.assertEqual(first=2, second=len(exact))
+        self.assertEqual(first=exact + fuzzy, second=json["items"])
+        self.assertGreater(len(fuzzy), 0)
+        for item in json["items"]:
+            self.assertEqual(first=list(exact[0].keys()), second=list(item.keys()))
+        self.assertEqual(
+            first=self.fields | {"match", "similarity"}, second=set(exact[0].keys())
+        )
+        for item in exact:
+            self.assertIsNotNone(item["score"])
+            self.assertIsNone(item["similarity"])
+        for item in fuzzy:
+            self.assertIsNone(item["score"])
+            self.assertGreaterEqual(
+                item["similarity"], main.config.server.fuzzy_min_similarity
+            )
+        similarities = [item["similarity"] for item in fuzzy]
+        self.assertEqual(first=sorted(similarities, reverse=True), second=similarities)
+
+        # Searches with enough exact hits are not topped up and have the same fields
+        json = self.search("homo sapiens", limit=10)
+        self.assertFalse(json["meta"]["fallback"])
+        self.assertEqual(first={"exact"}, second={i["match"] for i in json["items"]})
+        self.assertEqual(
+            first=list(exact[0].keys()), second=list(json["items"][0].keys())
+        )
+
+    def test_misspelt(self):
+        json = self.search("zebrafsh danio rerrio")
+        self.assertTrue(json["meta"]["fallback"])
+        self.assertEqual(first="fuzzy", second=json["items"][0]["match"])
+        self.assertEqual(
+            first="Danio rerio", second=json["items"][0]["scientific_name"]
+        )
+
+        with mock.patch.object(main.config.server, "fuzzy_min_hits", 0):
+            json = self.search("zebrafsh danio rerrio", limit=20)
+        self.assertFalse(json["meta"]["fallback"])
+        self.assertEqual(first=[], second=json["items"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,186 @@
+import unittest
+import os
+import tempfile
+from src.db import DuckDb, SQLiteDb
+from src.hot_clades import HotClades
+from src.incremental import IncrementalBuild, SourceFingerprints
+from src.species import Species, SpeciesFts, SpeciesTrigramFts
+from src.taxonomy import Taxonomy
+from tests.util import DatabaseFixture, TaxonomyFixture
+
+
+class TestIncrementalBuild(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.changes = []
+        self.duckdb, self.sqlite = self.open("previous")
+        self.full_build(self.duckdb, self.builders(self.duckdb, self.sqlite))
+
+    def open(self, name):
+        """
+        Create a build holding its own copy of the metadata and taxonomy fixtures,
+        with the changes made so far
+        """
+        duckdb = DuckDb.create(os.path.join(self.tmpdir, f"{name}.duckdb"))
+        duckdb.con.execute("create schema metadata")
+        DatabaseFixture(duckdb=duckdb).load_tables(schema="metadata")
+        TaxonomyFixture(duckdb=duckdb).load_tables()
+        self.change(duckdb, *self.changes)
+        sqlite = SQLiteDb.create(
+            os.path.join(self.tmpdir, f"{name}.sqlite"), "sqlitedb"
+        )
+        duckdb.connect_to_sqlite("sqlitedb", sqlite.path)
+        return duckdb, sqlite
+
+    def change(self, duckdb, *changes):
+        for sql in changes:
+            duckdb.con.execute(sql)
+
+    def builders(self, duckdb, sqlite):
+        return dict(
+            species=Species(duckdb=duckdb, source_schema="metadata"),
+            species_fts=SpeciesFts(duckdb=duckdb, sqlite=sqlite),
+            species_trigram_fts=SpeciesTrigramFts(duckdb=duckdb, sqlite=sqlite),
+            taxonomy=Taxonomy(
+                duckdb=duckdb,
+                taxonomy_source="taxonomy_source",
+                source_schema="metadata",
+            ),
+            hot_clades=HotClades(duckdb=duckdb, hot_taxa=[9606]),
+        )
+
+    def full_build(self, duckdb, builders):
+        for name in ("species", "species_fts", "species_trigram_fts", "taxonomy"):
+            builders[name].run()
+        builders["hot_clades"].run()
+        SourceFingerprints(duckdb=duckdb, source_schema="metadata").record()
+
+    def incremental_build(self):
+        return IncrementalBuild(
+            duckdb=self.duckdb,
+            sqlite=self.sqlite,
+            **self.builders(self.duckdb, self.sqlite),
+        ).run()
+
+    def assertSameBuild(self, expected_duckdb, expected_sqlite):
+        """
+        The species, FTS and lineage tables match those of a full build, ignoring IDs
+        """
+        columns = ", ".join(SourceFingerprints.species_columns)
+        for duckdb_query in (
+            f"select {columns}, search_boost from species order by all",
+            "select * from computed_hierarchy order by all",
+            "select count(*) from hot_clade_results",
+        ):
+            self.assertEqual(
+                first=expected_duckdb.con.execute(duckdb_query).fetchall(),
+                second=self.duckdb.con.execute(duckdb_query).fetchall(),
+            )
+        for sqlite_query in (
+            "select * from species_fts order by genome_uuid, release_label, scientific_name",
+            "select t.* from species_trigram_fts t join species_fts s on s.rowid = t.rowid order by s.genome_uuid, s.release_label, s.scientific_name",
+        ):
+            expected = expected_sqlite.con.execute(sqlite_query).fetchall()
+            actual = self.sqlite.con.execute(sqlite_query).fetchall()
+            if sqlite_query.startswith("select *"):
+                expected = [row[1:] for row in expected]
+                actual = [row[1:] for row in actual]
+            self.assertEqual(first=expected, second=actual)
+        # Boosted rows still come first in rowid order
+        boosts = [
+            int(boost)
+            for (boost,) in self.sqlite.con.execute(
+                "select search_boost from species_fts order by rowid"
+            ).fetchall()
+        ]
+        self.assertEqual(first=sorted(boosts, reverse=True), second=boosts)
+
+    def rebuild(self):
+        duckdb, sqlite = self.open("expected")
+        self.full_build(duckdb, self.builders(duckdb, sqlite))
+        return duckdb, sqlite
+
+    def test_unchanged(self):
+        stats = self.incremental_build()
+        self.assertEqual(first=[], second=stats["changed_tables"])
+        self.assertEqual(first=0, second=stats["inserted"] + stats["deleted"])
+
+    def test_changed_rows(self):
+        """
+        Changing an organism and dropping a genome from its release only rewrites the
+        affected species rows
+        """
+        self.changes = [
+            "update metadata.organism set common_name = 'updated name' where taxonomy_id = 9598",
+            """
+            delete from metadata.genome_release where genome_id in (
+                select g.genome_id from metadata.genome g
+                join metadata.organism o using (organism_id)
+                where o.taxonomy_id = 10090
+            )
+            """,
+        ]
+        self.change(self.duckdb, *self.changes)
+        previous_ids = self.duckdb.con.execute(
+            "select species_id from species where taxonomy_id = 7955"
+        ).fetchall()
+        stats = self.incremental_build()
+        self.assertEqual(
+            first=["organism", "genome_release"], second=stats["changed_tables"]
+        )
+        self.assertEqual(first="updated", second=stats["fts"])
+        self.assertGreater(stats["inserted"], 0)
+        self.assertGreater(stats["deleted"], stats["inserted"])
+        # Untouched rows keep their IDs
+        self.assertEqual(
+            first=previous_ids,
+            second=self.duckdb.con.execute(
+                "select species_id from species where taxonomy_id = 7955"
+            ).fetchall(),
+        )
+        self.assertSameBuild(*self.rebuild())
+        self.assertEqual(first=[], second=self.incremental_build()["changed_tables"])
+
+    def test_boosted_rows(self):
+        """
+        Boosted rows must come first in the FTS so inserting one rebuilds it
+        """
+        self.changes = [
+            "update metadata.assembly set tol_id = 'updated' where ensembl_name like 'GRCh38.p14'"
+        ]
+        self.change(self.duckdb, *self.changes)
+        stats = self.incremental_build()
+        self.assertEqual(first="rebuilt", second=stats["fts"])
+        self.assertSameBuild(*self.rebuild())
+
+    def test_open_reader(self):
+        """
+        Updating copies of the files, as generate_lookups.py does, leaves a server
+        holding the previous SQLite file open reading it
+        """
+        reader = SQLiteDb.create(self.sqlite.path, "sqlitedb", read_only=True)
+        self.addCleanup(reader.close)
+        query = "select * from species_fts order by rowid"
+        expected = reader.con.execute(query).fetchall()
+
+        self.changes = [
+            "update metadata.assembly set tol_id = 'updated' where ensembl_name like 'GRCh38.p14'"
+        ]
+        self.change(self.duckdb, *self.changes)
+        self.duckdb.detach("sqlitedb")
+        with self.sqlite.replacing():
+            self.duckdb.connect_to_sqlite("sqlitedb", self.sqlite.path)
+            stats = self.incremental_build()
+            self.duckdb.detach("sqlitedb")
+        self.assertEqual(first="rebuilt", second=stats["fts"])
+        self.assertEqual(first=expected, second=reader.con.execute(query).fetchall())
+        self.assertEqual(
+            first=[("ok",)],
+            second=reader.con.execute("PRAGMA integrity_check").fetchall(),
+        )
+        self.assertFalse(os.path.exists(f"{self.sqlite.path}.new"))
+        self.assertSameBuild(*self.rebuild())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+import unittest
+import tempfile
+from unittest import mock
+from starlette.testclient import TestClient
+from tests.util import LookupsFixture
+import main
+
+
+class TestIntersect(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.fixture = LookupsFixture(tempfile.mkdtemp())
+        cls.fixture.build()
+        cls.manager = cls.fixture.manager()
+        cls.client = TestClient(main.app)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.manager.close()
+
+    def setUp(self):
+        patcher = mock.patch.object(main, "lookup_manager", self.manager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        main.result_cache.set_version(None)
+        main.result_cache.set_version(self.manager.current.version)
+
+    def intersect(self, taxonomy_id, **params):
+        response = self.client.get(f"/species/intersect/{taxonomy_id}", params=params)
+        self.assertEqual(first=200, second=response.status_code)
+        json = response.json()
+        self.assertEqual(first="success", second=json["meta"]["status"])
+        return json["items"]
+
+    def per_ancestor(self, taxonomy_id, max_taxon_level, integrated_only):
+        """
+        The genomes found by querying each ancestor in turn, nearest first, keeping the
+        first hit of each genome. How /species/intersect was answered before it was a
+        single query
+        """
+        query = """
+          SELECT s.accession, s.release_type, s.genome_uuid, coalesce(list_position(ch.ancestor_taxon_ids, ?), 0) as taxonomy_step
+    from species s
+    join computed_hierarchy ch on s.taxonomy_id = ch.organism_taxonomy_id
+    where list_contains(ch.ancestor_taxon_ids, ?)
+    or s.taxonomy_id = ?
+    """
+        with self.manager.acquire() as lookups:
+            hierarchy = main._get_hierarchy(lookups, taxonomy_id, include_root=False)
+            genomes, seen_genome = [], set()
+            with lookups.duckdb_pool.connection() as cursor:
+                for taxon in hierarchy["items"]:
+                    cursor.execute(query, (taxon["id"], taxon["id"], taxon["id"]))
+                    columns = [column[0] for column in cursor.description]
+                    for row in cursor.fetchall():
+                        candidate = dict(zip(columns, row))
+                        if candidate["genome_uuid"] in seen_genome:
+                            continue
+                        if (
+                            integrated_only
+                            and candidate["release_type"] != "integrated"
+                        ):
+                            continue
+                        seen_genome.add(candidate["genome_uuid"])
+                        candidate["intersecting_taxon_id"] = taxon["id"]
+                        candidate["total_distance"] = (
+                            candidate["taxonomy_step"] + taxon["distance"]
+                        )
+                        genomes.append(candidate)
+                    if taxon["rank"] == max_taxon_level:
+                        break
+        genomes.sort(key=lambda x: (x["total_distance"], x["accession"]))
+        return genomes
+
+    def assertSameGenomes(self, expected, items):
+        """
+        Genomes, the ancestor each intersects and their distances match and they are in
+        the same order. Which of the rows of a genome is reported is not compared
+        """
+        self.assertEqual(
+            first=[(g["total_distance"], g["accession"]) for g in expected],
+            second=[(i["total_distance"], i["accession"]) for i in items],
+        )
+        self.assertEqual(
+            first={
+                g["genome_uuid"]: (
+                    g["intersecting_taxon_id"],
+                    g["taxonomy_step"],
+                    g["total_distance"],
+                )
+                for g in expected
+            },
+            second={
+                i["genome_uuid"]: (
+                    i["intersecting_taxon"]["id"],
+                    i["taxonomy_step"],
+                    i["total_distance"],
+                )
+                for i in items
+            },
+        )
+
+    def test_matches_per_ancestor(self):
+        """
+        The single query finds what querying each ancestor did
+        """
+        for taxonomy_id, max_taxon_level in (
+            (9606, "order"),
+            (63221, "genus"),
+            (9598, "order"),
+            (10090, "class"),
+            (7955, "clade"),
+        ):
+            for integrated_only in (False, True):
+                with self.subTest(
+                    taxonomy_id=taxonomy_id,
+                    max_taxon_level=max_taxon_level,
+                    integrated_only=integrated_only,
+                ):
+                    expected = self.per_ancestor(
+                        taxonomy_id, max_taxon_level, integrated_only
+                    )
+                    self.assertGreater(len(expected), 0)
+                    items = self.intersect(
+                        taxonomy_id,
+                        max_taxon_level=max_taxon_level,
+                        integrated_only=integrated_only,
+                        limit=100000,
+                    )
+                    self.assertSameGenomes(expected, items)
+
+    def test_deduplication(self):
+        """
+        Genomes with several species rows, such as an integrated and a partial release,
+        are reported once against the nearest ancestor
+        """
+        with self.manager.acquire() as lookups:
+            with lookups.duckdb_pool.connection() as cursor:
+                rows, genomes = cursor.execute(
+                    "select count(*), count(distinct genome_uuid) from species where taxonomy_id = 9606"
+                ).fetchone()
+        self.assertGreater(rows, genomes)
+        items = self.intersect(9606, max_taxon_level="genus", limit=100000)
+        self.assertEqual(first=genomes, second=len(items))
+        self.assertEqual(first=genomes, second=len({i["genome_uuid"] for i in items}))
+
+    def test_integrated_only(self):
+        items = self.intersect(9606, integrated_only=True, limit=100000)
+        self.assertEqual(
+            first={"integrated"}, second={i["release_type"] for i in items}
+        )
+        everything = self.intersect(9606, integrated_only=False, limit=100000)
+        self.assertIn(
+            member="partial", container={i["release_type"] for i in everything}
+        )
+
+    def test_max_taxon_level(self):
+        """
+        Ancestors above max_taxon_level are not searched
+        """
+        items = self.intersect(9606, max_taxon_level="genus", limit=100000)
+        self.assertEqual(
+            first={9605}, second={i["intersecting_taxon"]["id"] for i in items}
+        )
+        items = self.intersect(9606, max_taxon_level="class", limit=100000)
+        self.assertIn(
+            member=40674, container={i["intersecting_taxon"]["id"] for i in items}
+        )
+        self.assertIn(member=10090, container={i["taxonomy_id"] for i in items})
+
+        # A limit keeps the nearest genomes
+        limited = self.intersect(9606, max_taxon_level="class", limit=10)
+        self.assertEqual(first=items[:10], second=limited)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+import unittest
+import os
+import tempfile
+import threading
+from src.config import LookupSettings, TomlSettings
+from src.db import DuckDb, SQLiteDb
+from src.lookups import LookupManager, LookupsUnavailable
+
+
+class TestLookupManager(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = TomlSettings()
+        self.config.lookups = LookupSettings(
+            duckdb_search="search.duckdb",
+            sqlite_fts="search_fts.sqlite",
+            directory=self.dir,
+            drain_timeout=5,
+        )
+        self.publish("20240101", 1)
+
+    def publish(self, version, species):
+        """
+        Write a minimal build whose species table holds the given number of rows
+        """
+        path = os.path.join(self.dir, version)
+        os.mkdir(path)
+        duckdb = DuckDb.create(os.path.join(path, "search.duckdb"))
+        duckdb.con.execute(
+            "create table species as select range as species_id from range(?)",
+            (species,),
+        )
+        duckdb.con.close()
+        sqlite = SQLiteDb.create(os.path.join(path, "search_fts.sqlite"), "sqlitedb")
+        sqlite.con.execute("create virtual table species_fts using fts5(name)")
+        sqlite.con.close()
+
+    def species(self, lookups):
+        with lookups.duckdb_pool.connection() as cursor:
+            return cursor.execute("select count(*) from species").fetchone()[0]
+
+    def test_reload(self):
+        """
+        Serves the latest build and switches to new builds as they are published
+        """
+        switched, warmed = [], []
+        manager = LookupManager(
+            self.config,
+            on_switch=switched.append,
+            warm_up=lambda lookups: warmed.append(self.species(lookups)),
+        )
+        self.assertTrue(manager.versioned)
+        # Nothing is served until the first build has been opened and warmed
+        self.assertFalse(manager.ready)
+        with self.assertRaises(LookupsUnavailable):
+            with manager.acquire():
+                pass
+        manager.start()
+        self.assertTrue(manager.ready)
+        self.assertEqual(first=[1], second=warmed)
+        self.assertEqual(first="20240101", second=manager.current.version)
+        self.assertFalse(manager.reload())
+
+        # Builds being copied into place are ignored
+        os.mkdir(os.path.join(self.dir, ".20240301"))
+        self.publish("20240201", 2)
+        self.assertTrue(manager.reload())
+        self.assertEqual(first=[1, 2], second=warmed)
+        self.assertEqual(
+            first=["20240101", "20240201"], second=[l.version for l in switched]
+        )
+        with manager.acquire() as lookups:
+            self.assertEqual(first=2, second=self.species(lookups))
+
+        # Roll back to a given build
+        self.assertTrue(manager.reload("20240101"))
+        with manager.acquire() as lookups:
+            self.assertEqual(first=1, second=self.species(lookups))
+        with self.assertRaises(FileNotFoundError):
+            manager.reload("20240301")
+        manager.close()
+
+    def test_drain(self):
+        """
+        Requests using the previous build finish on it before it is closed
+        """
+        manager = LookupManager(self.config)
+        manager.start()
+        self.publish("20240201", 2)
+        acquired, release = threading.Event(), threading.Event()
+        counts = []
+
+        def request():
+            with manager.acquire() as lookups:
+                acquired.set()
+                release.wait()
+                counts.append(self.species(lookups))
+
+        thread = threading.Thread(target=request)
+        thread.start()
+        acquired.wait()
+        reload = threading.Thread(target=manager.reload)
+        reload.start()
+        # The switch happens while the request is running but its build stays open
+        reload.join(timeout=1)
+        self.assertTrue(reload.is_alive())
+        self.assertEqual(first="20240201", second=manager.current.version)
+        release.set()
+        thread.join()
+        reload.join()
+        self.assertEqual(first=[1], second=counts)
+        manager.close()
+
+    def test_failed_warm_up(self):
+        """
+        A build which fails to warm up is closed and not served
+        """
+        opened = []
+
+        def warm_up(lookups):
+            opened.append(lookups)
+            raise RuntimeError("warm up failed")
+
+        manager = LookupManager(self.config, warm_up=warm_up)
+        with self.assertRaises(RuntimeError):
+            manager.start()
+        self.assertFalse(manager.ready)
+        with self.assertRaises(Exception):
+            opened[0].duckdb.con.execute("select 1")
+
+    def test_flat(self):
+        """
+        Without a directory the configured files are served and cannot be reloaded
+        """
+        path = os.path.join(self.dir, "20240101")
+        self.config.lookups = LookupSettings(
+            duckdb_search=os.path.join(path, "search.duckdb"),
+            sqlite_fts=os.path.join(path, "search_fts.sqlite"),
+        )
+        manager = LookupManager(self.config)
+        manager.start()
+        self.assertFalse(manager.versioned)
+        with self.assertRaises(ValueError):
+            manager.reload()
+        manager.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
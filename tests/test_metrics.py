@@ -0,0 +1,81 @@
+import unittest
+import asyncio
+from src.db import ConnectionPool
+from src.metrics import Histogram, Metrics, MetricsMiddleware, record_rows, stage
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram("latency", "Latency", ("endpoint",), buckets=(0.1, 1))
+        histogram.observe(0.05, "/search")
+        histogram.observe(0.5, "/search")
+        histogram.observe(5, "/search")
+        self.assertEqual(
+            first=[
+                "# HELP latency Latency",
+                "# TYPE latency histogram",
+                'latency_bucket{endpoint="/search",le="0.1"} 1',
+                'latency_bucket{endpoint="/search",le="1"} 2',
+                'latency_bucket{endpoint="/search",le="+Inf"} 3',
+                'latency_sum{endpoint="/search"} 5.55',
+                'latency_count{endpoint="/search"} 3',
+            ],
+            second=list(histogram.render()),
+        )
+
+    def test_middleware(self):
+        """
+        Requests are labelled by their route's path template and record their stages
+        """
+
+        class Route:
+            path = "/species/taxonomy/{taxonomy_id}"
+
+        async def app(scope, receive, send):
+            scope["route"] = Route
+            with stage("query"):
+                pass
+            with stage("query"):
+                pass
+            record_rows(10)
+            await send({"type": "http.response.start", "status": 200})
+
+        async def send(message):
+            pass
+
+        metrics = Metrics(prefix="test")
+        middleware = MetricsMiddleware(app, metrics)
+        asyncio.run(
+            middleware({"type": "http", "path": "/species/taxonomy/9606"}, None, send)
+        )
+        # Outside of a request stages are not recorded
+        with stage("fetch"):
+            record_rows(10)
+        rendered = metrics.render()
+        self.assertIn(
+            member='test_requests_total{endpoint="/species/taxonomy/{taxonomy_id}",status="200"} 1',
+            container=rendered,
+        )
+        self.assertIn(
+            member='test_request_stage_duration_seconds_count{endpoint="/species/taxonomy/{taxonomy_id}",stage="query"} 1',
+            container=rendered,
+        )
+        self.assertIn(
+            member='test_response_rows_sum{endpoint="/species/taxonomy/{taxonomy_id}"} 10',
+            container=rendered,
+        )
+        self.assertNotIn(member='stage="fetch"', container=rendered)
+
+    def test_pool_stats(self):
+        pool = ConnectionPool(object, size=1)
+        with pool.connection():
+            self.assertEqual(
+                first={"size": 1, "in_use": 1, "waits": 0}, second=pool.stats()
+            )
+        self.assertEqual(
+            first={"size": 1, "in_use": 0, "waits": 0}, second=pool.stats()
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,208 @@
+import unittest
+import sqlite3
+import tempfile
+from unittest import mock
+import orjson
+from starlette.testclient import TestClient
+from src.pagination import InvalidCursor, decode_cursor, encode_cursor
+from src.responses import ndjson_lines
+from tests.util import LookupsFixture
+import main
+
+
+class TestPagination(unittest.TestCase):
+    def test_cursor_round_trip(self):
+        token = encode_cursor("search", 1000, -3.7924366989273826, 42)
+        self.assertNotIn(member="=", container=token)
+        self.assertEqual(
+            first=[1000, -3.7924366989273826, 42],
+            second=decode_cursor(token, "search", 3),
+        )
+
+    def test_invalid_cursor(self):
+        token = encode_cursor("search", 1000, -3.79, 42)
+        with self.assertRaises(InvalidCursor):
+            decode_cursor(token, "taxonomy", 2)
+        with self.assertRaises(InvalidCursor):
+            decode_cursor(token, "search", 2)
+        with self.assertRaises(InvalidCursor):
+            decode_cursor("not a cursor", "search", 3)
+
+    def test_ndjson_lines(self):
+        con = sqlite3.connect(":memory:")
+        cursor = con.execute(
+            """
+            WITH RECURSIVE n(id) AS (SELECT 1 UNION ALL SELECT id + 1 FROM n WHERE id < 5)
+            SELECT id, 'genome ' || id AS name, id * 10 AS _key FROM n
+            """
+        )
+        chunks = list(ndjson_lines(cursor, exclude=["_key"], batch_size=2))
+        self.assertEqual(first=3, second=len(chunks))
+        lines = b"".join(chunks).splitlines()
+        self.assertEqual(first=5, second=len(lines))
+        self.assertEqual(first=b'{"id":1,"name":"genome 1"}', second=lines[0])
+        con.close()
+
+
+class TestPaginatedEndpoints(unittest.TestCase):
+    """
+    Paging through the search and taxonomy endpoints, or streaming them, gives what a
+    single unpaged request does
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        # Primates (9443) is a hot clade and its results precomputed
+        cls.fixture = LookupsFixture(tempfile.mkdtemp(), hot_taxa=[9443])
+        cls.fixture.build()
+        cls.manager = cls.fixture.manager()
+        cls.client = TestClient(main.app)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.manager.close()
+
+    def setUp(self):
+        patcher = mock.patch.object(main, "lookup_manager", self.manager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        main.result_cache.set_version(None)
+        main.result_cache.set_version(self.manager.current.version)
+
+    def get(self, url, **params):
+        response = self.client.get(url, params=params)
+        self.assertEqual(first=200, second=response.status_code)
+        return response
+
+    def pages(self, url, limit, **params):
+        """
+        Items of every page, following next_cursor until it is null. Fails rather than
+        looping forever if a cursor does not move on
+        """
+        items, cursor, pages = [], None, 0
+        while pages <= 1000:
+            json = self.get(url, limit=limit, cursor=cursor, **params).json()
+            self.assertEqual(first="success", second=json["meta"]["status"])
+            self.assertLessEqual(len(json["items"]), limit)
+            items.extend(json["items"])
+            pages += 1
+            cursor = json["meta"]["next_cursor"]
+            if cursor is None:
+                return items, pages
+        self.fail(f"Paging through {url} did not end")
+
+    def unpaged(self, url, **params):
+        json = self.get(url, limit=0, **params).json()
+        self.assertIsNone(json["meta"]["next_cursor"])
+        return json["items"]
+
+    def ndjson(self, url, **params):
+        response = self.get(url, format="ndjson", **params)
+        self.assertEqual(
+            first="application/x-ndjson",
+            second=response.headers["content-type"],
+        )
+        return [orjson.loads(line) for line in response.content.splitlines()]
+
+    def test_search(self):
+        """
+        Pages follow search_boost, score and rowid, with ties in boost and score split
+        across pages
+        """
+        expected = self.unpaged("/species/search", q="homo sapiens")
+        self.assertEqual(first=416, second=len(expected))
+        self.assertNotIn(member="_rowid", container=expected[0])
+        for limit in (1, 7, 100, 416):
+            with self.subTest(limit=limit):
+                items, pages = self.pages("/species/search", limit, q="homo sapiens")
+                self.assertEqual(first=expected, second=items)
+                self.assertEqual(first=416 // limit + 1, second=pages)
+        self.assertEqual(
+            first=expected,
+            second=self.ndjson("/species/search", q="homo sapiens", limit=0),
+        )
+
+        # A stream picks up from a page's cursor
+        json = self.get("/species/search", q="homo sapiens", limit=10).json()
+        rest = self.ndjson(
+            "/species/search",
+            q="homo sapiens",
+            limit=0,
+            cursor=json["meta"]["next_cursor"],
+        )
+        self.assertEqual(first=expected[10:], second=rest)
+
+    def test_taxonomy(self):
+        """
+        Clades are paged in nested set order whether or not their results are
+        precomputed
+        """
+        self.assertIn(member=9443, container=self.manager.current.hot_clades)
+        for taxonomy_id in (9443, 9606, 40674):
+            url = f"/species/taxonomy/{taxonomy_id}"
+            with self.subTest(taxonomy_id=taxonomy_id):
+                expected = self.unpaged(url)
+                self.assertGreater(len(expected), 100)
+                self.assertNotIn(member="_left_index", container=expected[0])
+                for limit in (9, 100):
+                    items, _ = self.pages(url, limit)
+                    self.assertEqual(first=expected, second=items)
+                self.assertEqual(first=expected, second=self.ndjson(url, limit=0))
+        # The precomputed results of a clade hold those of the taxa within it
+        self.assertEqual(
+            first=[
+                item["genome_uuid"] for item in self.unpaged("/species/taxonomy/9606")
+            ],
+            second=[
+                item["genome_uuid"]
+                for item in self.unpaged("/species/taxonomy/9443")
+                if item["taxonomy_id"] == 9606
+            ],
+        )
+        self.assertEqual(first=[], second=self.ndjson("/species/taxonomy/99999999"))
+
+    def test_fuzzy_top_up(self):
+        """
+        Near matches only top up a first page which is not full. The cursor follows the
+        exact hits so near matches are never paged
+        """
+        # Streams hold exact hits only
+        exact = self.ndjson("/species/search", q="acomys kempi", limit=0)
+        self.assertEqual(first=2, second=len(exact))
+        json = self.get("/species/search", q="acomys kempi", limit=10).json()
+        self.assertTrue(json["meta"]["fallback"])
+        self.assertIsNone(json["meta"]["next_cursor"])
+        self.assertEqual(first=exact, second=json["items"][:2])
+        self.assertEqual(first=10, second=len(json["items"]))
+        self.assertEqual(first=10, second=json["meta"]["items"])
+        exact_genomes = {(i["genome_uuid"], i["release_type"]) for i in exact}
+        for item in json["items"][2:]:
+            self.assertNotIn(
+                member=(item["genome_uuid"], item["release_type"]),
+                container=exact_genomes,
+            )
+
+        # A full page of exact hits is not topped up and its cursor leads to an empty
+        # page which is not topped up either
+        json = self.get("/species/search", q="acomys kempi", limit=2).json()
+        self.assertFalse(json["meta"]["fallback"])
+        self.assertEqual(first=exact, second=json["items"])
+        cursor = json["meta"]["next_cursor"]
+        self.assertIsNotNone(cursor)
+        json = self.get(
+            "/species/search", q="acomys kempi", limit=2, cursor=cursor
+        ).json()
+        self.assertEqual(first=[], second=json["items"])
+        self.assertFalse(json["meta"]["fallback"])
+        self.assertIsNone(json["meta"]["next_cursor"])
+
+    def test_invalid_cursor(self):
+        cursor = self.get("/species/search", q="homo sapiens", limit=1).json()["meta"][
+            "next_cursor"
+        ]
+        json = self.get("/species/taxonomy/9606", cursor=cursor).json()
+        self.assertEqual(first="error", second=json["meta"]["status"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,346 @@
+import unittest
+import inspect
+import os
+import tempfile
+import threading
+from unittest import mock
+from src.db import DuckDb, SQLiteDb
+from src.pipeline import Pipeline, Stage, lookup_stages
+from src.species import SpeciesTrigramFts
+from tests.util import DatabaseFixture, TaxonomyFixture
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.duckdb = DuckDb.create()
+        self.sqlite = SQLiteDb.create(
+            os.path.join(self.tmpdir, "pipeline.sqlite"), "sqlitedb"
+        )
+
+    def pipeline(self, stages, workers=4):
+        return Pipeline(
+            duckdb=self.duckdb, sqlite=self.sqlite, stages=stages, workers=workers
+        )
+
+    def test_concurrent_stages(self):
+        """
+        Independent stages run at the same time and dependent ones after them
+        """
+        barrier = threading.Barrier(2, timeout=10)
+        finished = []
+
+        def independent(name):
+            def run(duckdb, sqlite):
+                barrier.wait()
+                duckdb.con.execute(f"create table {name} AS SELECT 1 AS id")
+                finished.append(name)
+
+            return run
+
+        def dependent(duckdb, sqlite):
+            count = duckdb.con.execute(
+                "select count(*) from (select * from a union all select * from b)"
+            ).fetchone()[0]
+            finished.append(("c", count))
+
+        timings = self.pipeline(
+            [
+                Stage("a", independent("a"), tables=["a"]),
+                Stage("b", independent("b"), tables=["b"]),
+                Stage("c", dependent, depends_on=["a", "b"]),
+            ]
+        ).run()
+        self.assertEqual(first={"a", "b"}, second=set(finished[:2]))
+        self.assertEqual(first=("c", 2), second=finished[2])
+        self.assertEqual(
+            first=["ran"] * 3, second=[timing["status"] for timing in timings]
+        )
+        self.assertEqual(
+            first=[("a",), ("b",)],
+            second=self.duckdb.con.execute(
+                "select stage from build_stages order by stage"
+            ).fetchall(),
+        )
+
+    def test_sqlite_writers_serialised(self):
+        lock = threading.Lock()
+        writing = []
+        overlapped = []
+
+        def fts(name):
+            def run(duckdb, sqlite):
+                with lock:
+                    overlapped.append(bool(writing))
+                    writing.append(name)
+                sqlite.con.execute(f"CREATE VIRTUAL TABLE {name} USING fts5(text)")
+                sqlite.con.execute(f"INSERT INTO {name} VALUES ('text')")
+                sqlite.con.commit()
+                with lock:
+                    writing.remove(name)
+
+            return run
+
+        self.pipeline(
+            [Stage(name, fts(name), fts_tables=[name]) for name in ("x", "y", "z")]
+        ).run()
+        self.assertEqual(first=[False] * 3, second=overlapped)
+        self.assertEqual(
+            first=[("x",), ("y",), ("z",)],
+            second=self.sqlite.con.execute(
+                "SELECT stage FROM build_stages ORDER BY stage"
+            ).fetchall(),
+        )
+
+    def test_invalid_stages(self):
+        def run(duckdb, sqlite):
+            pass
+
+        with self.assertRaises(ValueError):
+            self.pipeline([Stage("a", run, depends_on=["missing"])])
+        with self.assertRaises(ValueError):
+            self.pipeline(
+                [
+                    Stage("a", run, depends_on=["c"]),
+                    Stage("b", run, depends_on=["a"]),
+                    Stage("c", run, depends_on=["b"]),
+                ]
+            )
+        with self.assertRaises(ValueError):
+            self.pipeline([Stage("a", run), Stage("a", run)])
+
+    def test_failed_stage(self):
+        ran = []
+
+        def fail(duckdb, sqlite):
+            raise RuntimeError("failed")
+
+        def run(duckdb, sqlite):
+            ran.append(True)
+
+        with self.assertRaises(RuntimeError):
+            self.pipeline([Stage("a", fail), Stage("b", run, depends_on=["a"])]).run()
+        self.assertEqual(first=[], second=ran)
+
+
+class TestLookupStages(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "search.duckdb")
+        self.changes = []
+
+    def build(self, **settings):
+        """
+        Run a full build of the fixtures, reusing the previous build if there is one,
+        and return the status of each stage
+        """
+        duckdb = DuckDb.create()
+        duckdb.con.execute("create schema metadata")
+        DatabaseFixture(duckdb=duckdb).load_tables(schema="metadata")
+        TaxonomyFixture(duckdb=duckdb).load_tables()
+        for sql in self.changes:
+            duckdb.con.execute(sql)
+        sqlite = SQLiteDb.create(
+            os.path.join(self.tmpdir, "search_fts.sqlite"), "sqlitedb"
+        )
+        previous = None
+        if os.path.exists(self.path):
+            previous = "previous"
+            duckdb.connect_to_duckdb(previous, self.path, read_only=True)
+        stages = lookup_stages(
+            source_schema="metadata",
+            taxonomy_source="taxonomy_source",
+            build_taxonomy_fts=True,
+            **settings,
+        )
+        stages.append(
+            Stage(
+                "persist",
+                lambda duckdb, sqlite: duckdb.persist_database(self.path),
+                depends_on=[stage.name for stage in stages],
+            )
+        )
+        timings = Pipeline(
+            duckdb=duckdb, sqlite=sqlite, stages=stages, workers=4, previous=previous
+        ).run()
+        duckdb.con.close()
+        sqlite.close()
+        return {timing["stage"]: timing["status"] for timing in timings}
+
+    def contents(self):
+        duckdb = DuckDb.create(self.path, read_only=True)
+        sqlite = SQLiteDb.create(
+            os.path.join(self.tmpdir, "search_fts.sqlite"), "sqlitedb"
+        )
+        contents = {}
+        for table in (
+            "species",
+            "computed_hierarchy",
+            "taxonomy_tree",
+            "hot_clade_results",
+            "species_fingerprints",
+        ):
+            contents[table] = duckdb.con.execute(
+                f"select * from {table} order by all"
+            ).fetchall()
+        contents["indexes"] = duckdb.con.execute(
+            "select index_name from duckdb_indexes() order by all"
+        ).fetchall()
+        for table in ("species_fts", "species_trigram_fts", "taxonomy_fts"):
+            contents[table] = sqlite.con.execute(
+                f"SELECT * FROM {table} ORDER BY rowid"
+            ).fetchall()
+        duckdb.con.close()
+        sqlite.close()
+        return contents
+
+    def test_reuse(self):
+        """
+        Stages whose inputs and settings are unchanged are not run again and give the
+        same lookups
+        """
+        self.assertEqual(
+            first={"ran"},
+            second=set(self.build(hot_taxa=[9606]).values()),
+        )
+        expected = self.contents()
+
+        self.assertEqual(
+            first={
+                "species": "copied",
+                "species_fts": "skipped",
+                "species_trigram_fts": "skipped",
+                "taxonomy": "copied",
+                "taxonomy_fts": "skipped",
+                "hot_clades": "copied",
+                "fingerprints": "copied",
+                "persist": "ran",
+            },
+            second=self.build(hot_taxa=[9606]),
+        )
+        self.assertEqual(first=expected, second=self.contents())
+
+        statuses = self.build(hot_taxa=[9606, 9443])
+        self.assertEqual(
+            first=["hot_clades", "persist"],
+            second=sorted(stage for stage, s in statuses.items() if s == "ran"),
+        )
+
+        # The metadata changing reruns species and the stages depending on it
+        self.changes = [
+            "update metadata.assembly set tol_id = 'updated' where ensembl_name = 'GRCh38.p14'"
+        ]
+        statuses = self.build(hot_taxa=[9606, 9443])
+        self.assertEqual(first="copied", second=statuses["taxonomy"])
+        self.assertEqual(first="skipped", second=statuses["taxonomy_fts"])
+        for stage in ("species", "species_fts", "species_trigram_fts", "hot_clades"):
+            self.assertEqual(first="ran", second=statuses[stage])
+
+        # Tables of stages no longer built are dropped
+        self.build(hot_taxa=[9606, 9443], build_species_trigram_fts=False)
+        sqlite = SQLiteDb.create(
+            os.path.join(self.tmpdir, "search_fts.sqlite"), "sqlitedb"
+        )
+        self.assertFalse(sqlite.has_table("species_trigram_fts"))
+        self.assertTrue(sqlite.has_table("species_fts"))
+        sqlite.close()
+
+    def test_code_changes(self):
+        """
+        A stage whose code has changed since the previous build is run again
+        """
+        self.build(hot_taxa=[9606])
+        getsource = inspect.getsource
+
+        def changed(code):
+            source = getsource(code)
+            return f"{source}\n# changed" if code is SpeciesTrigramFts else source
+
+        with mock.patch.object(inspect, "getsource", side_effect=changed):
+            statuses = self.build(hot_taxa=[9606])
+            self.assertEqual(first="ran", second=statuses["species_trigram_fts"])
+            self.assertEqual(first="skipped", second=statuses["species_fts"])
+            self.assertEqual(first="copied", second=statuses["taxonomy"])
+            statuses = self.build(hot_taxa=[9606])
+            self.assertEqual(first="skipped", second=statuses["species_trigram_fts"])
+
+    def test_open_reader(self):
+        """
+        A server holding the previous SQLite file open, which it does as immutable,
+        keeps reading it while the lookups are built again
+        """
+        self.build(hot_taxa=[9606])
+        sqlite_path = os.path.join(self.tmpdir, "search_fts.sqlite")
+        reader = SQLiteDb.create(sqlite_path, "sqlitedb", read_only=True)
+        self.addCleanup(reader.close)
+        queries = (
+            "SELECT * FROM species_fts ORDER BY rowid",
+            "SELECT rowid FROM species_fts WHERE species_fts MATCH 'homo' ORDER BY rowid",
+            "SELECT * FROM taxonomy_fts ORDER BY rowid",
+            "PRAGMA integrity_check",
+        )
+        expected = [reader.con.execute(query).fetchall() for query in queries]
+        self.assertGreater(len(expected[1]), 0)
+
+        # Rebuilding the species FTS tables of a file reused from the previous build
+        statuses = self.build(hot_taxa=[9606], species_fts_prefix=[2, 3])
+        self.assertEqual(first="ran", second=statuses["species_fts"])
+        self.assertEqual(first="skipped", second=statuses["taxonomy_fts"])
+        self.assertEqual(
+            first=expected, second=[reader.con.execute(q).fetchall() for q in queries]
+        )
+        # And building it again from scratch
+        os.remove(self.path)
+        self.assertEqual(first={"ran"}, second=set(self.build().values()))
+        self.assertEqual(
+            first=expected, second=[reader.con.execute(q).fetchall() for q in queries]
+        )
+        self.assertFalse(os.path.exists(f"{sqlite_path}.new"))
+
+        # Servers opening the file now read the new build
+        sqlite = SQLiteDb.create(sqlite_path, "sqlitedb", read_only=True)
+        self.assertEqual(
+            first=[("ok",)], second=sqlite.con.execute(queries[-1]).fetchall()
+        )
+        self.assertEqual(
+            first=[("species_fts",), ("species_trigram_fts",), ("taxonomy_fts",)],
+            second=sqlite.con.execute(
+                "SELECT stage FROM build_stages ORDER BY stage"
+            ).fetchall(),
+        )
+        sqlite.close()
+
+    def test_interrupted(self):
+        """
+        Nothing is reused from a build which did not finish writing to SQLite
+        """
+        self.build(hot_taxa=[9606], fts_bulk_load=True)
+        sqlite_path = os.path.join(self.tmpdir, "search_fts.sqlite")
+        self.assertFalse(os.path.exists(f"{sqlite_path}.building"))
+        expected = self.contents()
+
+        with mock.patch.object(
+            SpeciesTrigramFts, "fts_sql", side_effect=RuntimeError("interrupted")
+        ):
+            with self.assertRaises(RuntimeError):
+                self.build(
+                    hot_taxa=[9606], fts_bulk_load=True, species_fts_prefix=[2, 3]
+                )
+        self.assertTrue(os.path.exists(f"{sqlite_path}.building"))
+        # The interrupted build never wrote to the previous file
+        self.assertEqual(first=expected, second=self.contents())
+
+        self.assertEqual(
+            first={"ran"},
+            second=set(self.build(hot_taxa=[9606], fts_bulk_load=True).values()),
+        )
+        self.assertFalse(os.path.exists(f"{sqlite_path}.building"))
+        sqlite = SQLiteDb.create(sqlite_path, "sqlitedb")
+        self.assertEqual(
+            first=0, second=sqlite.con.execute("PRAGMA freelist_count").fetchone()[0]
+        )
+        sqlite.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import unittest
+import asyncio
+import shutil
+import signal
+import tempfile
+from unittest import mock
+from starlette.testclient import TestClient
+from src.lookups import LookupManager
+from tests.util import LookupsFixture
+import main
+
+
+class TestProbes(unittest.TestCase):
+    """
+    The server reports ready once the lookups have been opened and warmed, retrying
+    opening them at startup
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fixture = LookupsFixture(tempfile.mkdtemp())
+        cls.fixture.build()
+        cls.client = TestClient(main.app)
+
+    def setUp(self):
+        # Lookups are served from a directory they are published into during the test
+        self.config = LookupsFixture(tempfile.mkdtemp()).config(warm_up=True)
+        self.warmed = []
+        self.manager = LookupManager(self.config, warm_up=self.warm_up)
+        self.addCleanup(self.manager.close)
+        for target, attribute, value in (
+            (main, "lookup_manager", self.manager),
+            (main.config.lookups, "start_attempts", 3),
+            (main.config.lookups, "start_retry_interval", 0),
+        ):
+            patcher = mock.patch.object(target, attribute, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def warm_up(self, lookups):
+        # Not ready while being warmed
+        self.assertEqual(first=503, second=self.readiness())
+        main._warm_up(lookups)
+        self.warmed.append(lookups.version)
+
+    def publish(self):
+        shutil.copy(self.fixture.duckdb_path, self.config.lookups.duckdb_search)
+        shutil.copy(self.fixture.sqlite_path, self.config.lookups.sqlite_fts)
+
+    def readiness(self):
+        response = self.client.get("/probes/readiness")
+        self.assertEqual(
+            first={"readiness": response.status_code == 200}, second=response.json()
+        )
+        return response.status_code
+
+    def test_readiness(self):
+        self.assertEqual(first=503, second=self.readiness())
+        response = self.client.get("/probes/liveness")
+        self.assertEqual(first=200, second=response.status_code)
+        self.assertEqual(first={"liveness": True}, second=response.json())
+        self.assertEqual(
+            first=503, second=self.client.get("/lookups/version").status_code
+        )
+
+        # Nothing has been published to open
+        with self.assertRaises(Exception):
+            self.manager.start()
+        self.assertEqual(first=503, second=self.readiness())
+
+        self.publish()
+        self.manager.start()
+        self.assertEqual(first=1, second=len(self.warmed))
+        self.assertEqual(first=200, second=self.readiness())
+
+    def test_start_retried(self):
+        """
+        Opening the lookups is retried until they are published and warm
+        """
+        attempts = []
+        start = self.manager.start
+
+        def attempt():
+            attempts.append(self.readiness())
+            if len(attempts) == 1:
+                # Not yet published
+                start()
+            elif len(attempts) == 2:
+                self.publish()
+                with mock.patch.object(
+                    main, "_warm_up", side_effect=RuntimeError("Warm up failed")
+                ):
+                    start()
+            else:
+                start()
+
+        with mock.patch.object(self.manager, "start", side_effect=attempt):
+            with mock.patch.object(main.os, "kill") as kill:
+                asyncio.run(main._start_lookups())
+        self.assertEqual(first=[503, 503, 503], second=attempts)
+        kill.assert_not_called()
+        self.assertEqual(first=1, second=len(self.warmed))
+        self.assertEqual(first=200, second=self.readiness())
+
+    def test_start_failed(self):
+        """
+        The server shuts down once every attempt has failed
+        """
+        with mock.patch.object(main.os, "kill") as kill:
+            asyncio.run(main._start_lookups())
+        kill.assert_called_once_with(main.os.getpid(), signal.SIGTERM)
+        self.assertEqual(first=[], second=self.warmed)
+        self.assertEqual(first=503, second=self.readiness())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import os
+import sqlite3
+import tempfile
+import orjson
+from src.db import DuckDb
+from src.profiling import configure_slow_query_log, profiling
+from src.responses import query_to_hash_list
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.duckdb = DuckDb.create()
+        self.duckdb.con.execute(
+            "create table species as select range as species_id from range(1000000)"
+        )
+
+    def test_profile(self):
+        """
+        Profiled queries report their plan from EXPLAIN ANALYZE or EXPLAIN QUERY PLAN
+        """
+        query = "select count(*) as genomes from species where species_id > ?"
+        items = query_to_hash_list(self.duckdb.con, query, (10,))
+        self.assertEqual(first=[{"genomes": 999989}], second=items)
+        with profiling() as queries:
+            query_to_hash_list(self.duckdb.con, query, (10,))
+            con = sqlite3.connect(":memory:")
+            con.execute("create table species (species_id integer primary key)")
+            query_to_hash_list(
+                con.cursor(), "select * from species where species_id = ?", (1,)
+            )
+        self.assertEqual(first=2, second=len(queries))
+        self.assertEqual(first=[10], second=list(queries[0]["params"]))
+        self.assertIn(member="Total Time", container=queries[0]["plan"])
+        self.assertIn(member="INTEGER PRIMARY KEY", container=queries[1]["plan"])
+        with profiling(enabled=False) as queries:
+            self.assertIsNone(queries)
+
+    def test_slow_query_log(self):
+        """
+        Queries over the threshold are logged with their parameters and plan
+        """
+        path = os.path.join(tempfile.mkdtemp(), "slow.log")
+        configure_slow_query_log(path, 1, 1048576, 1)
+        try:
+            query_to_hash_list(
+                self.duckdb.con,
+                "select sum(a.species_id * b.species_id) from species a join species b using (species_id) where a.species_id > ?",
+                (5,),
+            )
+            query_to_hash_list(self.duckdb.con, "select 1 as genomes")
+        finally:
+            configure_slow_query_log(path, 0, 1048576, 1)
+        with open(path) as fh:
+            entries = [orjson.loads(line) for line in fh]
+        self.assertEqual(first=1, second=len(entries))
+        self.assertEqual(first=[5], second=entries[0]["params"])
+        self.assertGreaterEqual(a=entries[0]["ms"], b=1)
+        self.assertIn(member="HASH_JOIN", container=entries[0]["plan"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+import unittest
+import asyncio
+import os
+import tempfile
+from unittest import mock
+import orjson
+from src.config import LookupSettings, TomlSettings
+from src.db import DuckDb, SQLiteDb
+from src.lookups import LookupManager
+from src.pipeline import Pipeline, Stage, lookup_stages
+from tests.util import DatabaseFixture, TaxonomyFixture
+import main
+
+
+class TestTaxonomySearch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        """
+        Build the lookups from the fixtures with further common names for human, so
+        taxonomy_fts holds several rows for it
+        """
+        cls.tmpdir = tempfile.mkdtemp()
+        duckdb_path = os.path.join(cls.tmpdir, "search.duckdb")
+        sqlite_path = os.path.join(cls.tmpdir, "search_fts.sqlite")
+        duckdb = DuckDb.create()
+        duckdb.con.execute("create schema metadata")
+        DatabaseFixture(duckdb=duckdb).load_tables(schema="metadata")
+        TaxonomyFixture(duckdb=duckdb).load_tables()
+        duckdb.con.execute(
+            "insert into taxonomy_source.ncbi_taxa_name values (9606, 'modern human', 'common name'), (9606, 'human being', 'common name')"
+        )
+        sqlite = SQLiteDb.create(sqlite_path, "sqlitedb")
+        stages = lookup_stages(
+            source_schema="metadata",
+            taxonomy_source="taxonomy_source",
+            build_taxonomy_fts=True,
+        )
+        stages.append(
+            Stage(
+                "persist",
+                lambda duckdb, sqlite: duckdb.persist_database(duckdb_path),
+                depends_on=[stage.name for stage in stages],
+            )
+        )
+        Pipeline(duckdb=duckdb, sqlite=sqlite, stages=stages).run()
+        duckdb.con.close()
+        sqlite.close()
+
+        config = TomlSettings()
+        config.lookups = LookupSettings(
+            duckdb_search=duckdb_path, sqlite_fts=sqlite_path, warm_up=False
+        )
+        cls.manager = LookupManager(config)
+        cls.manager.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.manager.close()
+
+    def setUp(self):
+        patcher = mock.patch.object(main, "lookup_manager", self.manager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Empty the result cache
+        main.result_cache.set_version(None)
+        main.result_cache.set_version(self.manager.current.version)
+
+    def call(self, endpoint, **params):
+        response = asyncio.run(endpoint(**params))
+        if isinstance(response, dict):
+            return response
+        return orjson.loads(response.body)
+
+    def search(self, q, intersect=False):
+        return self.call(
+            main.search_taxonomy,
+            q=q,
+            limit=10,
+            intersect=intersect,
+            max_taxon_level="order",
+            integrated_only=False,
+            intersect_limit=100,
+        )
+
+    def intersect(self, taxonomy_id):
+        return self.call(
+            main.intersect_taxonomy,
+            taxonomy_id=taxonomy_id,
+            max_taxon_level="order",
+            integrated_only=False,
+            limit=100,
+            profile=False,
+        )
+
+    def test_search_taxonomy(self):
+        """
+        Each taxon is reported once with the score of its best matching row
+        """
+        with self.manager.acquire() as lookups:
+            items = main._search_taxonomy(lookups, "human", 10)
+            with lookups.sqlite_pool.connection() as con:
+                rows = con.execute(
+                    "SELECT CAST(taxonomy_id AS INTEGER), rank FROM taxonomy_fts t WHERE t.taxonomy_fts MATCH 'human'"
+                ).fetchall()
+        self.assertEqual(first=2, second=len(rows))
+        self.assertEqual(first=[9606], second=[item["taxonomy_id"] for item in items])
+        best = min(rows, key=lambda row: row[1])
+        self.assertEqual(first=best[1], second=items[0]["score"])
+        self.assertEqual(first="Homo sapiens", second=items[0]["scientific_name"])
+        self.assertEqual(first="human", second=items[0]["genbank_common_name"])
+
+        with self.manager.acquire() as lookups:
+            items = main._search_taxonomy(lookups, "homo", 10)
+        self.assertEqual(
+            first={9605, 9606, 63221}, second={item["taxonomy_id"] for item in items}
+        )
+
+    def test_intersect(self):
+        json = self.intersect(9598)
+        self.assertEqual(first="success", second=json["meta"]["status"])
+        self.assertGreater(json["meta"]["items"], 0)
+
+        json = self.search("chimpanzee", intersect=True)
+        self.assertEqual(
+            first=[9598], second=[item["taxonomy_id"] for item in json["items"]]
+        )
+        self.assertEqual(first="success", second=json["intersect"]["meta"]["status"])
+        self.assertEqual(first=9598, second=json["intersect"]["meta"]["taxonomy_id"])
+        self.assertGreater(json["intersect"]["meta"]["items"], 0)
+
+    def test_intersect_errors(self):
+        """
+        Unknown taxa and failed OLS lookups are reported as errors and not cached
+        """
+        with mock.patch.object(main.config.lookups, "ols_fallback", False):
+            json = self.intersect(99999999)
+        self.assertEqual(first="error", second=json["meta"]["status"])
+        self.assertIn(member="99999999", container=json["meta"]["error"])
+
+        ols_error = {"meta": {"status": "error", "error": "OLS is unavailable"}}
+        with mock.patch.object(main.config.lookups, "ols_fallback", True):
+            with mock.patch.object(main, "_get_ols_hierarchy", return_value=ols_error):
+                json = self.intersect(99999999)
+        self.assertEqual(first=ols_error, second=json)
+        self.assertEqual(first=0, second=main.result_cache.stats()["entries"])
+
+        with mock.patch.object(main, "_get_hierarchy", return_value=ols_error):
+            json = self.search("chimpanzee", intersect=True)
+        self.assertEqual(
+            first=[9598], second=[item["taxonomy_id"] for item in json["items"]]
+        )
+        self.assertEqual(
+            first={
+                "status": "error",
+                "error": "OLS is unavailable",
+                "taxonomy_id": 9598,
+            },
+            second=json["intersect"]["meta"],
+        )
+        self.assertEqual(first=0, second=main.result_cache.stats()["entries"])
+
+        # Once the hierarchy is found the results are cached again
+        self.search("chimpanzee", intersect=True)
+        self.assertEqual(first=1, second=main.result_cache.stats()["entries"])
+
+
+if __name__ == "__main__":
+    unittest.main()
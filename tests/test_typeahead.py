@@ -0,0 +1,94 @@
+import unittest
+import tempfile
+from unittest import mock
+from starlette.testclient import TestClient
+from tests.util import LookupsFixture
+import main
+
+
+class TestTypeaheadMatch(unittest.TestCase):
+    def test_typeahead_match(self):
+        """
+        Words are quoted as text and the last one made a prefix
+        """
+        for q, match in (
+            ("h", '"h"*'),
+            ("Homo", '"homo"*'),
+            ("homo  sap", '"homo" "sap"*'),
+            ("mus musculus c", '"mus" "musculus" "c"*'),
+            ('say "hi', '"say" """hi"*'),
+            ("mus-musculus (c57", '"mus-musculus" "(c57"*'),
+            ("AND OR NOT", '"and" "or" "not"*'),
+            ("   ", ""),
+        ):
+            with self.subTest(q=q):
+                self.assertEqual(first=match, second=main._typeahead_match(q))
+
+
+class TestTypeahead(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.fixture = LookupsFixture(tempfile.mkdtemp())
+        cls.fixture.build()
+        cls.manager = cls.fixture.manager()
+        cls.client = TestClient(main.app)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.manager.close()
+
+    def setUp(self):
+        patcher = mock.patch.object(main, "lookup_manager", self.manager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        main.result_cache.set_version(None)
+        main.result_cache.set_version(self.manager.current.version)
+
+    def typeahead(self, q, limit=10):
+        response = self.client.get(
+            "/species/typeahead", params={"q": q, "limit": limit}
+        )
+        self.assertEqual(first=200, second=response.status_code)
+        json = response.json()
+        self.assertEqual(first="success", second=json["meta"]["status"])
+        self.assertEqual(first=len(json["items"]), second=json["meta"]["items"])
+        return json["items"]
+
+    def boosts(self, items):
+        with self.manager.acquire() as lookups:
+            with lookups.duckdb_pool.connection() as cursor:
+                boosts = dict(
+                    cursor.execute(
+                        "select genome_uuid, max(search_boost) from species group by genome_uuid"
+                    ).fetchall()
+                )
+        return [boosts[item["genome_uuid"]] for item in items]
+
+    def test_boosted_first(self):
+        """
+        Boosted genomes are suggested first
+        """
+        items = self.typeahead("homo sa", limit=50)
+        self.assertEqual(first=50, second=len(items))
+        self.assertEqual(
+            first={"Homo sapiens"}, second={i["scientific_name"] for i in items}
+        )
+        boosts = self.boosts(items)
+        self.assertEqual(first=1000, second=boosts[0])
+        self.assertEqual(first=sorted(boosts, reverse=True), second=boosts)
+
+    def test_typed_text(self):
+        """
+        Single characters, punctuation and FTS5 syntax are searched as typed
+        """
+        self.assertEqual(first=10, second=len(self.typeahead("h")))
+        for item in self.typeahead("mus muscu"):
+            self.assertTrue(item["scientific_name"].startswith("Mus musculus"))
+        for q in ('homo "sap', "mus-musculus (c5", "NEAR(", "AND", "*"):
+            with self.subTest(q=q):
+                self.typeahead(q)
+        self.assertEqual(first=[], second=self.typeahead(" "))
+
+
+if __name__ == "__main__":
+    unittest.main()
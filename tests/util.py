@@ -1,4 +1,8 @@
 from os import path
+from src.config import LookupSettings, TomlSettings
+from src.db import DuckDb, SQLiteDb
+from src.lookups import LookupManager
+from src.pipeline import Pipeline, Stage, lookup_stages
 
 
 class TestDataDir:
@@ -19,5 +23,128 @@ class DatabaseFixture:
         else:
             self.dir = dir
 
-    def load_tables(self) -> int:
-        return self.duckdb.load_parquet_directory(dir=self.dir, compression="brotli")
+    def load_tables(self, schema=None) -> int:
+        return self.duckdb.load_parquet_directory(
+            dir=self.dir, compression="brotli", schema=schema
+        )
+
+
+class TaxonomyFixture:
+    """
+    Small hand-built NCBI taxonomy and organism set loaded into its own schema
+    so Taxonomy can be run against it without the full taxonomy dumps
+    """
+
+    nodes = [
+        (1, 1, "no rank", "root", None),
+        (131567, 1, "no rank", "cellular organisms", None),
+        (2759, 131567, "superkingdom", "Eukaryota", None),
+        (7742, 2759, "clade", "Vertebrata", None),
+        (7955, 7742, "species", "Danio rerio", "zebrafish"),
+        (40674, 7742, "class", "Mammalia", None),
+        (9443, 40674, "order", "Primates", None),
+        (9604, 9443, "family", "Hominidae", None),
+        (9605, 9604, "genus", "Homo", None),
+        (9606, 9605, "species", "Homo sapiens", "human"),
+        (63221, 9606, "subspecies", "Homo sapiens neanderthalensis", "Neandertal"),
+        (9596, 9604, "genus", "Pan", None),
+        (9598, 9596, "species", "Pan troglodytes", "chimpanzee"),
+        (9989, 40674, "order", "Rodentia", None),
+        (10088, 9989, "genus", "Mus", None),
+        (10090, 10088, "species", "Mus musculus", "house mouse"),
+        (10092, 10090, "subspecies", "Mus musculus domesticus", None),
+    ]
+
+    organisms = [(1, 9606, 9606), (2, 9598, 9598), (3, 10090, 10090), (4, 7955, 7955)]
+
+    def __init__(self, duckdb, schema="taxonomy_source"):
+        self.duckdb = duckdb
+        self.schema = schema
+
+    def load_tables(self) -> None:
+        con = self.duckdb.con
+        schema = self.schema
+        con.execute(f"create schema {schema}")
+        con.execute(
+            f"create table {schema}.ncbi_taxa_node (taxon_id INTEGER, parent_id INTEGER, rank VARCHAR, genbank_hidden_flag TINYINT)"
+        )
+        con.execute(
+            f"create table {schema}.ncbi_taxa_name (taxon_id INTEGER, name VARCHAR, name_class VARCHAR)"
+        )
+        con.execute(
+            f"create table {schema}.organism (organism_id INTEGER, taxonomy_id INTEGER, species_taxonomy_id INTEGER)"
+        )
+        for taxon_id, parent_id, rank, scientific_name, common_name in self.nodes:
+            con.execute(
+                f"insert into {schema}.ncbi_taxa_node values (?, ?, ?, 0)",
+                (taxon_id, parent_id, rank),
+            )
+            con.execute(
+                f"insert into {schema}.ncbi_taxa_name values (?, ?, 'scientific name')",
+                (taxon_id, scientific_name),
+            )
+            if common_name:
+                con.execute(
+                    f"insert into {schema}.ncbi_taxa_name values (?, ?, 'genbank common name')",
+                    (taxon_id, common_name),
+                )
+        con.executemany(
+            f"insert into {schema}.organism values (?, ?, ?)", self.organisms
+        )
+
+
+class LookupsFixture:
+    """
+    Lookups built from DatabaseFixture and TaxonomyFixture by a full build into a
+    directory, for tests which query them as the server does. changes are SQL run
+    against the sources before building
+    """
+
+    def __init__(self, dir, changes=(), **settings):
+        self.dir = dir
+        self.changes = list(changes)
+        self.settings = settings
+        self.duckdb_path = path.join(dir, "search.duckdb")
+        self.sqlite_path = path.join(dir, "search_fts.sqlite")
+
+    def build(self) -> None:
+        duckdb = DuckDb.create()
+        duckdb.con.execute("create schema metadata")
+        DatabaseFixture(duckdb=duckdb).load_tables(schema="metadata")
+        TaxonomyFixture(duckdb=duckdb).load_tables()
+        for sql in self.changes:
+            duckdb.con.execute(sql)
+        sqlite = SQLiteDb.create(self.sqlite_path, "sqlitedb")
+        stages = lookup_stages(
+            source_schema="metadata", taxonomy_source="taxonomy_source", **self.settings
+        )
+        stages.append(
+            Stage(
+                "persist",
+                lambda duckdb, sqlite: duckdb.persist_database(self.duckdb_path),
+                depends_on=[stage.name for stage in stages],
+            )
+        )
+        Pipeline(duckdb=duckdb, sqlite=sqlite, stages=stages).run()
+        duckdb.con.close()
+        sqlite.close()
+
+    def config(self, **lookups) -> TomlSettings:
+        """
+        Settings serving the lookups, without warming them unless asked to
+        """
+        config = TomlSettings()
+        config.lookups = LookupSettings(
+            duckdb_search=self.duckdb_path,
+            sqlite_fts=self.sqlite_path,
+            **{"warm_up": False, **lookups},
+        )
+        return config
+
+    def manager(self, **lookups) -> LookupManager:
+        """
+        Open the lookups as the server does
+        """
+        manager = LookupManager(self.config(**lookups))
+        manager.start()
+        return manager